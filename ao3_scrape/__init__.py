@@ -1,154 +1,537 @@
-from dataclasses import dataclass
-from datetime import datetime
-from ipaddress import IPv4Network, IPv6Network
-import random
-import sqlite3
-from typing import Any, Optional, Tuple, Type
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Optional, TypeVar
 import aiohttp
 import asyncio
-import socket
+import time
 from ao3_scrape import database
-from ao3_scrape.metrics import PAGE, WORK_UPDATED_TIME
-from ao3_scrape.scrape import work, search
+from ao3_scrape.address_pool import AddressPool
+from ao3_scrape.frontier import Frontier
+from ao3_scrape.html_archive import HtmlArchive
+from ao3_scrape.memory_budget import MemoryBudget
+from ao3_scrape.search_cache import SearchCache
+from ao3_scrape.metrics import (
+    DEAD_LETTERS,
+    IN_FLIGHT,
+    PAGE,
+    RETRIES,
+    SHARDS,
+    SHARDS_DONE,
+    SKIPPED_WORKS,
+    WORK_UPDATED_TIME,
+)
+from ao3_scrape.scrape import HTTPError, RatelimitError, RetryPolicy, work, search
+from ao3_scrape.session_pool import SessionPool
+
+T = TypeVar("T")
 
 
 @dataclass
 class ScrapeTask:
-    search_unit: search.TimeUnit
-    search_time: int
+    query: search.Search
     page: int
 
 
+@dataclass
+class ScrapeContext:
+    db: database.DatabaseWriter
+    sessions: SessionPool
+    # picks the source address of every request
+    addresses: AddressPool
+    # number of works downloaded concurrently from a single search page
+    work_concurrency: int
+    # requests in flight across all page workers
+    in_flight: asyncio.Semaphore
+    # parses works off the event loop if given
+    parse_pool: Optional[Executor] = None
+    parser: work.WorkParser = work.WorkParser.HTML_PARSER
+    # limits the memory taken by works being downloaded at once if given
+    memory_budget: Optional[MemoryBudget] = None
+    # works with at least this many words or chapters are downloaded a chapter
+    # at a time if given
+    chapter_mode_words: Optional[int] = None
+    chapter_mode_chapters: Optional[int] = None
+    # skips works which are already stored and unchanged if given
+    index: Optional[database.WorkIndex] = None
+    # records the progress of the current crawl if given
+    frontier: Optional[Frontier] = None
+    # keeps the raw work pages and chapters downloaded if given
+    archive: Optional[HtmlArchive] = None
+    # keeps search pages to skip downloading them again if given
+    search_cache: Optional[SearchCache] = None
+    retry: RetryPolicy = field(default_factory=RetryPolicy)
+
+
+PageScraper = Callable[[ScrapeContext, search.Search, int], Awaitable[Optional[int]]]
+
+# windows aren't split any finer than this, even if still over the result cap
+MIN_SHARD = timedelta(seconds=1)
+
+
+async def scrape_date_range(
+    ctx: ScrapeContext,
+    shard_concurrency: int,
+    page_concurrency: int,
+    date_range: search.DateRangeSearch,
+    track_progress: bool = True,
+    resume: bool = True,
+    page_scraper: Optional[PageScraper] = None,
+):
+    """
+    Split a date range into shards small enough for all their results to be
+    reachable, and scrape up to `shard_concurrency` of them at a time, each with
+    its own frontier if `track_progress` is set.
+    """
+    shards = await plan_shards(ctx, date_range)
+    print(f"= Split {date_range.describe()} into {len(shards)} shards.")
+    SHARDS.set(len(shards))
+    SHARDS_DONE.set(0)
+
+    shard_slots = asyncio.Semaphore(shard_concurrency)
+
+    async def scrape_shard(shard: search.DateRangeSearch):
+        async with shard_slots:
+            print(f"= Downloading shard of {shard.describe()}.")
+            frontier = (
+                await Frontier.open(ctx.db, str(shard), resume=resume)
+                if track_progress
+                else None
+            )
+            await scrape_works(
+                replace(ctx, frontier=frontier),
+                page_concurrency,
+                shard,
+                1,
+                page_scraper,
+            )
+            SHARDS_DONE.inc()
+
+    await asyncio.gather(*(scrape_shard(shard) for shard in shards))
+
+
+async def plan_shards(
+    ctx: ScrapeContext, date_range: search.DateRangeSearch
+) -> list[search.DateRangeSearch]:
+    """
+    Halve a date range until every part finds fewer works than the result cap,
+    newest first. Parts without any results are left out.
+    """
+    count = await request_search(ctx, search.parse_result_count, date_range, 1)
+
+    if count == 0:
+        return []
+
+    if count < search.RESULT_CAP:
+        return [date_range]
+
+    if date_range.end - date_range.start <= MIN_SHARD:
+        print(f"Can't split {date_range.describe()} to reach all {count} works.")
+        return [date_range]
+
+    older, newer = date_range.split()
+    newer_shards, older_shards = await asyncio.gather(
+        plan_shards(ctx, newer), plan_shards(ctx, older)
+    )
+    return newer_shards + older_shards
+
+
 async def scrape_works(
-    db: sqlite3.Connection,
-    ip_network: Optional[IPv4Network | IPv6Network],
+    ctx: ScrapeContext,
     page_concurrency: int,
-    search_unit: search.TimeUnit,
-    search_time: int,
+    query: search.Search,
     start_page: int,
+    page_scraper: Optional[PageScraper] = None,
 ):
+    """
+    Scrape search pages from `start_page` until the results run out, downloading
+    every listed work unless a different `page_scraper` is given.
+    """
+    if ctx.frontier is not None and ctx.frontier.pending_works:
+        print(f"= Downloading {len(ctx.frontier.pending_works)} unfinished works.")
+        await scrape_work_ids(ctx, ctx.frontier.pending_works)
+
+    pages = (
+        ctx.frontier.pages()
+        if ctx.frontier is not None
+        else range(start_page, search.LAST_PAGE + 1)
+    )
+
     task_queue = asyncio.Queue(maxsize=page_concurrency)
 
     workers = [
-        asyncio.create_task(scrape_page_worker(db, ip_network, task_queue))
+        asyncio.create_task(
+            scrape_page_worker(ctx, task_queue, page_scraper or scrape_page)
+        )
         for _ in range(page_concurrency)
     ]
 
     async def queue_tasks():
-        for page in range(start_page, 5001):
-            await task_queue.put(
-                ScrapeTask(
-                    search_unit=search_unit,
-                    search_time=search_time,
-                    page=page,
-                )
-            )
+        for page in pages:
+            await task_queue.put(ScrapeTask(query=query, page=page))
+
+        # once out of pages, tell every worker to stop
+        for _ in workers:
+            await task_queue.put(None)
 
     queuer = asyncio.create_task(queue_tasks())
 
-    await asyncio.wait(workers, return_when=asyncio.ALL_COMPLETED)
+    done, _ = await asyncio.wait(workers, return_when=asyncio.ALL_COMPLETED)
     queuer.cancel()
 
+    if ctx.frontier is not None and not any(task.exception() for task in done):
+        await ctx.frontier.finish()
+
 
 async def scrape_page_worker(
-    db: sqlite3.Connection,
-    ip_network: Optional[IPv4Network | IPv6Network],
-    task_queue: asyncio.Queue[ScrapeTask],
+    ctx: ScrapeContext,
+    task_queue: asyncio.Queue[Optional[ScrapeTask]],
+    page_scraper: PageScraper,
 ):
     while True:
         task = await task_queue.get()
+        if task is None:
+            break
 
         PAGE.set(task.page)
 
-        page = await scrape_page(
-            db, ip_network, task.search_time, task.search_unit, task.page
-        )
+        page = await page_scraper(ctx, task.query, task.page)
 
         if page is None:
             break
 
 
 async def scrape_page(
-    db: sqlite3.Connection,
-    ip_network: Optional[IPv4Network | IPv6Network],
-    search_time: int,
-    search_unit: search.TimeUnit,
-    page: int,
+    ctx: ScrapeContext, query: search.Search, page: int
+) -> Optional[int]:
+    print(f"= Downloading page {page}.")
+
+    if ctx.frontier is not None:
+        await ctx.frontier.lease_page(page)
+
+    try:
+        results = await request_search(ctx, search.parse_page, query, page)
+    except Exception as error:
+        await give_up(ctx, "page", page, str(query), error)
+        if ctx.frontier is not None:
+            await ctx.frontier.fail_page(page)
+        return page + 1
+
+    work_ids = []
+    blurbs = {}
+    for result in results:
+        if ctx.index is not None and ctx.index.is_unchanged(result):
+            SKIPPED_WORKS.inc()
+        else:
+            work_ids.append(result["id"])
+            blurbs[result["id"]] = result
+
+    if ctx.frontier is not None:
+        await ctx.frontier.complete_page(page, len(results), work_ids)
+
+    if results == []:
+        return None
+
+    await scrape_work_ids(ctx, work_ids, blurbs)
+
+    return page + 1
+
+
+async def scrape_work_ids(
+    ctx: ScrapeContext,
+    work_ids: list[int],
+    blurbs: Optional[dict[int, search.SearchResult]] = None,
+):
+    """
+    Scrape works `work_concurrency` at a time, going by their search `blurbs`
+    where known.
+    """
+    if blurbs is None:
+        blurbs = {}
+
+    work_slots = asyncio.Semaphore(ctx.work_concurrency)
+
+    async def scrape_work_slot(work_id: int):
+        async with work_slots:
+            await scrape_work(ctx, work_id, blurbs.get(work_id))
+
+    await asyncio.gather(*(scrape_work_slot(work_id) for work_id in work_ids))
+
+
+async def refresh_stats_page(
+    ctx: ScrapeContext, query: search.Search, page: int
 ) -> Optional[int]:
-    local_addr = (
-        ip_network and ip_network[random.randint(0, ip_network.num_addresses - 1)]
+    """
+    Update the stats of the stored works on a search page from their blurbs.
+    """
+    print(f"= Refreshing stats from page {page}.")
+
+    try:
+        results = await request(ctx, search.get_page, query, page)
+    except Exception as error:
+        await give_up(ctx, "page", page, str(query), error)
+        return page + 1
+    if results == []:
+        return None
+
+    await ctx.db.update_work_stats(results)
+
+    return page + 1
+
+
+async def scrape_work(
+    ctx: ScrapeContext, work_id: int, blurb: Optional[search.SearchResult] = None
+):
+    print(f"Downloading work {work_id}.")
+
+    if ctx.frontier is not None:
+        await ctx.frontier.lease_work(work_id)
+
+    try:
+        if await by_chapter(ctx, work_id, blurb):
+            parsed = await scrape_work_by_chapter(ctx, work_id)
+        else:
+            async with work_memory(ctx, blurb and blurb["words"]):
+                parsed = await request(
+                    ctx,
+                    work.get_work,
+                    work_id,
+                    parse_pool=ctx.parse_pool,
+                    parser=ctx.parser,
+                    archive=ctx.archive,
+                )
+    except Exception as error:
+        await give_up(ctx, "work", work_id, None, error)
+        if ctx.frontier is not None:
+            await ctx.frontier.fail_work(work_id, error)
+        return
+
+    if parsed is None:
+        print(f"Work {work_id} linked by search but not found upon request.")
+        if ctx.frontier is not None:
+            await ctx.frontier.complete_work(work_id, None)
+        return
+
+    WORK_UPDATED_TIME.set(
+        datetime.fromisoformat(parsed["updated"] or parsed["published"]).timestamp()
     )
-    connector = FreebindTCPConnector(local_addr=local_addr)
 
-    async with aiohttp.ClientSession(connector=connector) as client:
-        print(f"= Downloading page {page} from {local_addr or 'default address'}.")
+    if ctx.frontier is not None:
+        await ctx.frontier.complete_work(work_id, parsed)
+    else:
+        await ctx.db.write_work(parsed)
+    if ctx.index is not None:
+        ctx.index.add(parsed)
 
-        work_ids = await search.get_page(client, search_time, search_unit, page)
-        if work_ids == []:
-            return None
 
-        for work_id in work_ids:
-            print(f"Downloading work {work_id}.")
+async def by_chapter(
+    ctx: ScrapeContext, work_id: int, blurb: Optional[search.SearchResult]
+) -> bool:
+    if ctx.chapter_mode_words is None and ctx.chapter_mode_chapters is None:
+        return False
 
-            parsed = await work.get_work(client, work_id)
-            if parsed is None:
-                print(f"Work {work_id} linked by search but not found upon request.")
-                continue
+    if blurb is None:
+        # a work left over from an earlier run, which may have been partly
+        # downloaded a chapter at a time
+        _, partial, _ = await ctx.db.query(database.stored_chapters, work_id)
+        return partial
+
+    return (
+        ctx.chapter_mode_words is not None and blurb["words"] >= ctx.chapter_mode_words
+    ) or (
+        ctx.chapter_mode_chapters is not None
+        and blurb["chapters_published"] >= ctx.chapter_mode_chapters
+    )
+
+
+class IncompleteWorkError(Exception):
+    work_id: int
+    # the chapters which weren't downloaded
+    missing: list[int]
+
+    def __init__(self, work_id: int, missing: list[int]):
+        super().__init__(
+            f"{len(missing)} chapters of work {work_id} couldn't be downloaded."
+        )
+
+        self.work_id = work_id
+        self.missing = missing
+
+
+async def scrape_work_by_chapter(
+    ctx: ScrapeContext, work_id: int
+) -> Optional[work.Work]:
+    """
+    Download a work from its first page and then a chapter at a time, storing
+    each chapter as soon as it's downloaded so that a failed download picks up
+    where it stopped. Chapters are skipped if they're stored and either the work
+    is partial or they were posted before its stored copy was last updated.
+
+    Returns the work without the chapters which were stored along the way.
+    Raises `IncompleteWorkError` if any chapter couldn't be downloaded, leaving
+    the work stored as partial.
+    """
+    parsed = await request(
+        ctx, work.get_work_page, work_id, parser=ctx.parser, archive=ctx.archive
+    )
+    if parsed is None:
+        return None
+
+    links = await request(ctx, work.get_chapter_links, work_id)
+    if links is None:
+        return None
+    if len(links) <= 1:
+        # the first page already has all of it
+        return parsed
+
+    updated, partial, stored = await ctx.db.query(database.stored_chapters, work_id)
+    wanted = [
+        link["id"]
+        for link in links
+        if link["id"] not in stored
+        or not (partial or updated is None or link["posted"] < updated)
+    ]
+    print(
+        f"Downloading {len(wanted)} of {len(links)} chapters of work {work_id} "
+        "one at a time."
+    )
 
-            WORK_UPDATED_TIME.set(
-                datetime.fromisoformat(
-                    parsed["updated"] or parsed["published"]
-                ).timestamp()
+    # the chapters can only be stored along with the work
+    await ctx.db.begin_partial_work(parsed)
+
+    # the first chapter came with the first page
+    first = parsed["content"][0]
+    if int(first["id"]) in wanted:
+        wanted.remove(int(first["id"]))
+        await ctx.db.write_chapters(work_id, [first])
+
+    chapter_slots = asyncio.Semaphore(max(ctx.work_concurrency, 1))
+
+    async def scrape_chapter(chapter_id: int):
+        async with chapter_slots:
+            chapter = await request(
+                ctx, work.get_chapter, work_id, chapter_id, archive=ctx.archive
             )
 
-            database.write_work(db, parsed)
+        if chapter is None:
+            raise LookupError(f"chapter {chapter_id} not found upon request")
 
-        return page + 1
+        await ctx.db.write_chapters(work_id, [chapter])
+
+    # every chapter is waited for, so that as many as possible are stored for
+    # the next attempt to skip
+    results = await asyncio.gather(
+        *(scrape_chapter(chapter_id) for chapter_id in wanted),
+        return_exceptions=True,
+    )
+    failures = {
+        chapter_id: result
+        for chapter_id, result in zip(wanted, results)
+        if isinstance(result, BaseException)
+    }
+    for chapter_id, error in failures.items():
+        print(f"Failed to download chapter {chapter_id}: {error!r}")
+    if failures:
+        # the work stays partial, to be finished by a later attempt
+        raise IncompleteWorkError(work_id, list(failures))
+
+    return {**parsed, "content": []}
+
+
+@asynccontextmanager
+async def work_memory(ctx: ScrapeContext, words: Optional[int]):
+    """
+    Hold the memory budget for a work of `words` words, if there is a budget.
+    """
+    if ctx.memory_budget is None:
+        yield
+        return
+
+    async with ctx.memory_budget.reserve(words):
+        yield
+
+
+async def request_search(
+    ctx: ScrapeContext,
+    parse: Callable[..., T],
+    query: search.Search,
+    page: int,
+) -> T:
+    """
+    Request a search page and parse it with `parse`, unless the search cache has
+    a fresh copy, which is used without making any request at all.
+    """
+    if ctx.search_cache is not None:
+        cached = ctx.search_cache.fresh(search.cache_key(query, page, parse))
+        if cached is not None:
+            return cached
+
+    return await request(
+        ctx, search.get_parsed, query, page, parse, cache=ctx.search_cache
+    )
+
+
+async def request(
+    ctx: ScrapeContext, func: Callable[..., Awaitable[T]], *args, **kwargs
+) -> T:
+    """
+    Call `func` with a client bound to the address the address pool picks, trying
+    again from another address for as long as it gets ratelimited, and as long as
+    the retry policy allows if it fails in a retryable way.
+    """
+    start = time.monotonic()
+    attempt = 0
+
+    while True:
+        local_addr = await ctx.addresses.acquire()
+
+        async with in_flight(ctx), ctx.sessions.session(local_addr) as session:
+            try:
+                result = await func(session.client, *args, **kwargs)
+            except RatelimitError as error:
+                ctx.addresses.throttled(local_addr, error.retry_after)
+                continue
+            except Exception as error:
+                if not ctx.retry.retryable(error):
+                    raise
+
+                # a server error says nothing about the address it was sent from
+                if not isinstance(error, HTTPError):
+                    ctx.addresses.failed(local_addr, error)
+                attempt += 1
+                backoff = ctx.retry.backoff(attempt, time.monotonic() - start)
+                if backoff is None:
+                    raise
+            else:
+                ctx.addresses.succeeded(local_addr)
+                return result
+
+        RETRIES.inc()
+        await asyncio.sleep(backoff)
+
+
+async def give_up(
+    ctx: ScrapeContext,
+    kind: str,
+    item: int,
+    query: Optional[str],
+    error: BaseException,
+):
+    """
+    Put a page or work which couldn't be downloaded in the dead letter table,
+    rather than letting the error take down its page worker.
+    """
+    print(f"Giving up on {kind} {item}: {error!r}")
+    DEAD_LETTERS.labels(kind=kind).inc()
+    await ctx.db.write_dead_letter(kind, item, query, error)
 
 
-IP_FREEBIND = 15
-
-
-class FreebindTCPConnector(aiohttp.TCPConnector):
-    async def _wrap_create_connection(
-        self,
-        factory,
-        host,
-        port,
-        req: "aiohttp.ClientRequest",
-        timeout: "aiohttp.ClientTimeout",
-        client_error: Type[Exception] = aiohttp.ClientConnectorError,
-        # added
-        ssl=None,
-        family: int = 0,
-        proto: int = 0,
-        flags: int = 0,
-        server_hostname: str | None = None,
-        local_addr=None,
-    ) -> Tuple[asyncio.Transport, Any]:
+@asynccontextmanager
+async def in_flight(ctx: ScrapeContext):
+    async with ctx.in_flight:
+        IN_FLIGHT.inc()
         try:
-            async with aiohttp.helpers.ceil_timeout(timeout.sock_connect):
-                sock = socket.socket(family=family, proto=proto)
-
-                if local_addr:
-                    sock.setsockopt(socket.SOL_IP, IP_FREEBIND, 1)
-                    sock.bind((str(local_addr), 0))
-
-                sock.connect((host, port))
-
-                return await self._loop.create_connection(
-                    factory,
-                    ssl=ssl,
-                    sock=sock,
-                    server_hostname=server_hostname,
-                )  # type: ignore[return-value]  # noqa
-        except aiohttp.client_exceptions.cert_errors as exc:
-            raise aiohttp.ClientConnectorCertificateError(
-                req.connection_key, exc
-            ) from exc
-        except aiohttp.client_exceptions.ssl_errors as exc:
-            raise aiohttp.ClientConnectorSSLError(req.connection_key, exc) from exc
-        except OSError as exc:
-            if exc.errno is None and isinstance(exc, asyncio.TimeoutError):
-                raise
-            raise client_error(req.connection_key, exc) from exc
+            yield
+        finally:
+            IN_FLIGHT.dec()
@@ -1,13 +1,40 @@
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import dataclasses
+from datetime import datetime, timezone
 import ipaddress
-from typing import Annotated, Optional
+import os
+from pathlib import Path
+import socket
+import time
+from typing import Annotated, Iterator, Optional
 import prometheus_client
 import typer
-from ao3_scrape import database, scrape_works, metrics
-from ao3_scrape.metrics import PAGE_CONCURRENCY
-from ao3_scrape.scrape import search
+from ao3_scrape import (
+    ScrapeContext,
+    bench,
+    database,
+    refresh_stats_page,
+    scrape_date_range,
+    scrape_works,
+    metrics,
+)
+from ao3_scrape import coordinator as coordination
+from ao3_scrape import html_archive
+from ao3_scrape import reparse as reparsing
+from ao3_scrape.frontier import Frontier
+from ao3_scrape.maintenance import MaintenanceWorker
+from ao3_scrape.memory_budget import MemoryBudget
+from ao3_scrape.metrics import MAX_IN_FLIGHT, PAGE_CONCURRENCY, WORK_CONCURRENCY
+from ao3_scrape.address_pool import AddressPool
+from ao3_scrape.ratelimit import RateLimiter
+from ao3_scrape.scrape import BASE_URL, RetryPolicy, search
+from ao3_scrape.scrape.work import WorkParser
+from ao3_scrape.search_cache import SearchCache
+from ao3_scrape.session_pool import SessionPool
 
 app = typer.Typer(pretty_exceptions_show_locals=False)
+app.add_typer(bench.app, name="bench")
 
 
 @app.command()
@@ -17,47 +44,334 @@ def scrape(
         Optional[ipaddress.IPv6Network], typer.Option(parser=ipaddress.ip_network)
     ] = None,
     page_concurrency: int = 1,
+    work_concurrency: int = 1,
+    base_url: str = BASE_URL,
+    max_in_flight: int = 16,
+    request_rate: float = 1,
+    max_request_rate: float = 10,
+    address_quarantine_time: float = 300,
+    request_timeout: float = 60,
+    retry_attempts: int = 5,
+    retry_deadline: float = 600,
+    max_sessions: int = 16,
+    session_connections: int = 8,
+    session_idle_timeout: float = 60,
+    session_max_requests: Optional[int] = None,
+    session_max_age: Optional[float] = None,
+    write_queue_size: int = 256,
+    write_batch_size: int = 64,
+    write_flush_interval: float = 5,
+    bulk_load: bool = False,
+    maintenance_interval: float = 300,
+    maintenance_load: float = 0.25,
+    parse_processes: int = 0,
+    parser: WorkParser = WorkParser.HTML_PARSER.value,
+    archive: Optional[Path] = None,
+    search_cache: Optional[Path] = None,
+    search_cache_ttl: float = 3600,
+    search_cache_size: int = 256,
+    memory_budget: int = 0,
+    chapter_mode_words: int = 250_000,
+    chapter_mode_chapters: int = 100,
+    skip_unchanged: bool = True,
+    resume: bool = True,
     search_unit: search.TimeUnit = "day",
     search_time: int = 1,
     start_page: int = 1,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    shard_concurrency: int = 1,
     continue_backwards: bool = False,
+    coordinator: Optional[str] = None,
+    worker_name: str = f"{socket.gethostname()}-{os.getpid()}",
     prometheus_metrics: bool = True,
 ):
+    """
+    Download works updated `search_time` `search_unit`s ago, or in the UTC date
+    range from `since` until `until` (default now), split into shards which are
+    downloaded in parallel. With `continue_backwards`, keep going with earlier
+    ranges of the same length until the start of the archive.
+
+    With `coordinator`, the URL of a running `coordinate` command, download the
+    windows it hands out instead, into this worker's own database.
+
+    With `bulk_load`, the indexes which are only needed for querying are dropped
+    and built again once the scrape is over, and writes trade durability for
+    speed.
+
+    With `archive`, a directory, the raw pages of works are kept there so they
+    can be parsed again with `reparse`. Works parsed with `lxml-stream` aren't
+    kept, as their pages are never held whole.
+
+    With `search_cache`, a file, search pages are kept there and used again
+    without downloading them for `search_cache_ttl` seconds, then only once the
+    site says they're unchanged, in up to `search_cache_size` MiB.
+    """
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
 
-    db_conn = database.open_db(db)
+    if bulk_load:
+        conn = database.open_db(db)
+        database.drop_indexes(conn)
+        conn.close()
+
+    writer = database.DatabaseWriter(
+        db,
+        queue_size=write_queue_size,
+        batch_size=write_batch_size,
+        flush_interval=write_flush_interval,
+        pragmas=database.BULK_LOAD_PRAGMAS if bulk_load else None,
+    )
+    loop.run_until_complete(writer.start())
 
     PAGE_CONCURRENCY.set(page_concurrency)
+    WORK_CONCURRENCY.set(work_concurrency)
+    MAX_IN_FLIGHT.set(max_in_flight)
 
     loop.create_task(metrics.update_database_size_worker(db, period=1))
-    # loop.create_task(
-    #     database.incremental_maintenance_worker(
-    #         db_conn, interval=300, pause=60, load=0.25
-    #     )
-    # )
 
     if prometheus_metrics:
         prometheus_client.start_http_server(8000)
 
-    while True:
-        print(f"== Downloading works updated {search_time} {search_unit.value}s ago.")
+    index = None
+    if skip_unchanged:
+        conn = database.open_db(db)
+        index = database.WorkIndex.load(conn)
+        conn.close()
+        print(f"Loaded {len(index)} stored works to skip if unchanged.")
+
+    sessions = SessionPool(
+        ip_network,
+        max_sessions=max_sessions,
+        connections_per_session=session_connections,
+        idle_timeout=session_idle_timeout,
+        request_timeout=request_timeout,
+        base_url=base_url,
+        max_session_requests=session_max_requests,
+        max_session_age=session_max_age,
+    )
+    ctx = ScrapeContext(
+        db=writer,
+        sessions=sessions,
+        addresses=AddressPool(
+            sessions,
+            RateLimiter(initial_rate=request_rate, max_rate=max_request_rate),
+            size=max_sessions,
+            quarantine_time=address_quarantine_time,
+        ),
+        work_concurrency=work_concurrency,
+        in_flight=asyncio.Semaphore(max_in_flight),
+        parse_pool=ProcessPoolExecutor(parse_processes) if parse_processes else None,
+        parser=parser,
+        memory_budget=(
+            MemoryBudget(memory_budget * 1024 * 1024, parser) if memory_budget else None
+        ),
+        index=index,
+        chapter_mode_words=chapter_mode_words or None,
+        chapter_mode_chapters=chapter_mode_chapters or None,
+        retry=RetryPolicy(attempts=retry_attempts, deadline=retry_deadline),
+        archive=html_archive.HtmlArchive(archive) if archive is not None else None,
+        search_cache=(
+            SearchCache(search_cache, search_cache_ttl, search_cache_size * 1024 * 1024)
+            if search_cache is not None
+            else None
+        ),
+    )
+
+    maintenance = None
+    if maintenance_interval:
+        maintenance = MaintenanceWorker(
+            db,
+            writer,
+            latency=ctx.addresses.latency,
+            interval=maintenance_interval,
+            load=maintenance_load,
+        )
+        loop.run_until_complete(maintenance.start())
+
+    if coordinator is not None:
+
+        async def scrape_leases():
+            client = coordination.LeaseClient(coordinator, worker_name)
+            try:
+                await coordination.scrape_leases(
+                    ctx, client, shard_concurrency, page_concurrency, resume=resume
+                )
+            finally:
+                await client.close()
+
+        loop.run_until_complete(scrape_leases())
+    elif since is None and until is None and not continue_backwards:
+        query = search.RelativeSearch(search_time, search_unit)
+        print(f"== Downloading {query.describe()}.")
+
+        # the window a relative search covers has moved on since any earlier
+        # crawl of it, so that crawl's pages are no longer the same ones and a
+        # new crawl is always started
+        frontier = loop.run_until_complete(
+            Frontier.open(writer, str(query), start_page, resume=False)
+        )
 
         loop.run_until_complete(
             scrape_works(
-                db_conn,
-                ip_network,
+                dataclasses.replace(ctx, frontier=frontier),
                 page_concurrency,
-                search_unit,
-                search_time,
+                query,
                 start_page,
             )
         )
+    else:
+        for date_range in date_ranges(
+            since, until, search_time, search_unit, continue_backwards
+        ):
+            print(f"== Downloading {date_range.describe()}.")
 
-        if not continue_backwards:
-            break
+            loop.run_until_complete(
+                scrape_date_range(
+                    ctx, shard_concurrency, page_concurrency, date_range, resume=resume
+                )
+            )
+
+    loop.run_until_complete(ctx.sessions.close())
+    if maintenance is not None:
+        loop.run_until_complete(maintenance.close())
+    loop.run_until_complete(writer.close())
+    if ctx.parse_pool is not None:
+        ctx.parse_pool.shutdown()
+    if ctx.archive is not None:
+        ctx.archive.close()
+    if ctx.search_cache is not None:
+        ctx.search_cache.close()
 
-        search_time -= 1
+    if bulk_load:
+        build_indexes(db)
+
+
+@app.command()
+def refresh_stats(
+    db: str = "ao3.db",
+    ip_network: Annotated[
+        Optional[ipaddress.IPv6Network], typer.Option(parser=ipaddress.ip_network)
+    ] = None,
+    page_concurrency: int = 1,
+    base_url: str = BASE_URL,
+    max_in_flight: int = 16,
+    request_rate: float = 1,
+    max_request_rate: float = 10,
+    address_quarantine_time: float = 300,
+    max_sessions: int = 16,
+    write_queue_size: int = 256,
+    write_batch_size: int = 64,
+    write_flush_interval: float = 5,
+    search_unit: search.TimeUnit = "day",
+    search_time: int = 1,
+    start_page: int = 1,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    shard_concurrency: int = 1,
+    prometheus_metrics: bool = True,
+):
+    """
+    Update stored works' hits, kudos, comments and bookmarks from search blurbs.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    writer = database.DatabaseWriter(
+        db,
+        queue_size=write_queue_size,
+        batch_size=write_batch_size,
+        flush_interval=write_flush_interval,
+    )
+    loop.run_until_complete(writer.start())
+
+    PAGE_CONCURRENCY.set(page_concurrency)
+    MAX_IN_FLIGHT.set(max_in_flight)
+
+    if prometheus_metrics:
+        prometheus_client.start_http_server(8000)
+
+    sessions = SessionPool(ip_network, max_sessions=max_sessions, base_url=base_url)
+    ctx = ScrapeContext(
+        db=writer,
+        sessions=sessions,
+        addresses=AddressPool(
+            sessions,
+            RateLimiter(initial_rate=request_rate, max_rate=max_request_rate),
+            size=max_sessions,
+            quarantine_time=address_quarantine_time,
+        ),
+        work_concurrency=0,
+        in_flight=asyncio.Semaphore(max_in_flight),
+    )
+
+    if since is None and until is None:
+        query = search.RelativeSearch(search_time, search_unit)
+        print(f"== Refreshing {query.describe()}.")
+
+        loop.run_until_complete(
+            scrape_works(
+                ctx,
+                page_concurrency,
+                query,
+                start_page,
+                page_scraper=refresh_stats_page,
+            )
+        )
+    else:
+        (date_range,) = date_ranges(since, until, search_time, search_unit, False)
+        print(f"== Refreshing {date_range.describe()}.")
+
+        loop.run_until_complete(
+            scrape_date_range(
+                ctx,
+                shard_concurrency,
+                page_concurrency,
+                date_range,
+                track_progress=False,
+                page_scraper=refresh_stats_page,
+            )
+        )
+
+    loop.run_until_complete(ctx.sessions.close())
+    loop.run_until_complete(writer.close())
+
+
+def date_ranges(
+    since: Optional[datetime],
+    until: Optional[datetime],
+    search_time: int,
+    search_unit: search.TimeUnit,
+    continue_backwards: bool,
+) -> Iterator[search.DateRangeSearch]:
+    """
+    The date range from `since` until `until`, defaulting to the last
+    `search_time` `search_unit`s up to the current hour, followed by the ranges
+    before it if `continue_backwards` is set.
+    """
+    if until is None:
+        # whole hours so that a resumed run picks the same ranges
+        until = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    until = as_utc(until)
+    since = (
+        until - search_unit.timedelta(search_time) if since is None else as_utc(since)
+    )
+
+    step = until - since
+    while True:
+        yield search.DateRangeSearch(since, until)
+
+        if not continue_backwards or since <= search.ARCHIVE_START:
+            return
+
+        since, until = since - step, since
+
+
+def as_utc(date: datetime) -> datetime:
+    if date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+
+    return date.astimezone(timezone.utc)
 
 
 @app.command()
@@ -66,5 +380,165 @@ def init_db(db: str = "ao3.db"):
     database.init_db(conn)
 
 
+@app.command()
+def migrate(db: str = "ao3.db"):
+    """
+    Bring a database created by an older version up to date, including changes
+    which rewrite every stored chapter and so aren't made when it's opened.
+    Picks up where it left off if interrupted.
+    """
+    database.open_db(db, rewrite=True).close()
+    print(f"{db} is up to date.")
+
+
+@app.command()
+def coordinate(
+    state: str = "coordinator.db",
+    host: str = "127.0.0.1",
+    port: int = 8100,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    window_time: int = 1,
+    window_unit: search.TimeUnit = "day",
+    lease_time: float = 600,
+    linger: float = 60,
+    prometheus_metrics: bool = False,
+):
+    """
+    Hand out the UTC date range from `since` (default the start of the archive)
+    until `until` (default now) in windows of `window_time` `window_unit`s, to
+    workers started with `scrape --coordinator`. Windows from earlier runs with
+    the same `state` are kept, so a restarted coordinator picks up where it
+    left off.
+    """
+    coordinator = coordination.Coordinator(state, lease_time=lease_time)
+    (date_range,) = date_ranges(
+        since or search.ARCHIVE_START, until, window_time, window_unit, False
+    )
+    coordinator.add_windows(
+        coordination.windows(date_range, window_unit.timedelta(window_time))
+    )
+    print(f"== Coordinating {date_range.describe()}: {coordinator.counts()}.")
+
+    if prometheus_metrics:
+        prometheus_client.start_http_server(8000)
+
+    asyncio.run(coordination.serve(coordinator, host, port, linger))
+
+
+@app.command()
+def merge(shards: list[str], db: str = "ao3.db"):
+    """
+    Combine the works in worker databases into `db`, later shards replacing the
+    works of earlier ones.
+    """
+    conn = database.open_db(db)
+    if not database.has_table(conn, "works"):
+        database.init_db(conn)
+
+    for shard in shards:
+        print(f"Merging {shard}...")
+        database.merge_shard(conn, shard)
+
+    (count,) = conn.execute("SELECT count(*) FROM works;").fetchone()
+    print(f"{db} has {count} works.")
+
+
+@app.command()
+def build_indexes(db: str = "ao3.db"):
+    """
+    Build the indexes left out by a bulk load which didn't finish.
+    """
+    print("Building indexes...")
+    start = time.perf_counter()
+
+    conn = database.open_db(db)
+    database.set_pragmas(conn, database.BULK_LOAD_PRAGMAS)
+    database.build_indexes(conn)
+    conn.close()
+
+    print(f"Built indexes in {time.perf_counter() - start:.0f}s.")
+
+
+@app.command()
+def export(
+    db: str = "ao3.db",
+    out: Path = Path("export"),
+    chapters: bool = False,
+    batch_size: int = 10_000,
+    chapter_batch_size: int = 200,
+    threads: int = 4,
+):
+    """
+    Export works, taggings and optionally chapters to Parquet, partitioned by
+    the month works were published in and their language.
+    """
+    # pyarrow is an optional dependency
+    from ao3_scrape import export
+
+    export.export(db, out, chapters, batch_size, chapter_batch_size, threads)
+
+
+@app.command()
+def reparse(
+    archive: Path,
+    db: str = "ao3.db",
+    processes: Optional[int] = None,
+    parser: WorkParser = WorkParser.HTML_PARSER.value,
+    batch_size: int = 64,
+):
+    """
+    Rebuild the works, chapters and taggings of every work in an archive kept by
+    `scrape --archive` from the pages downloaded last, without downloading
+    anything. Works are parsed across `processes` processes (default one per
+    CPU) and stored over whatever was stored before.
+    """
+    start = time.perf_counter()
+    stored, failed = reparsing.reparse(archive, db, processes, parser, batch_size)
+    print(
+        f"Stored {stored} works in {time.perf_counter() - start:.0f}s; "
+        f"{failed} failed to parse."
+    )
+
+
+@app.command()
+def train_dicts(
+    db: str = "ao3.db",
+    dict_size: int = 100_000,
+    samples: int = 2000,
+    min_works: int = 50,
+    compress_after: bool = False,
+    load: float = 0.5,
+):
+    """
+    Train a compression dictionary for each language from a sample of its
+    chapters, for rows compressed from then on. Languages which already have a
+    dictionary are left alone.
+    """
+    conn = database.open_db(db)
+
+    for language, sampled in database.train_dictionaries(
+        conn, dict_size, samples, min_works
+    ).items():
+        print(f"Trained {language} dictionary on {sampled} chapters.")
+
+    if compress_after:
+        compress(db, load)
+
+
+@app.command()
+def compress(db: str = "ao3.db", load: float = 0.5, duration: float = 60):
+    """
+    Compress chapters until there's nothing left uncompressed, working for
+    `load` of each `duration` seconds so a running scrape can keep writing.
+    """
+    conn = database.open_db(db)
+
+    while database.run_incremental_maintenance(conn, duration, load):
+        print("Compressing...")
+
+    print("Everything is compressed.")
+
+
 if __name__ == "__main__":
     app()
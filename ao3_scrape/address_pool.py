@@ -0,0 +1,241 @@
+import asyncio
+from dataclasses import dataclass
+import random
+import time
+from types import SimpleNamespace
+from typing import Optional
+import aiohttp
+
+from ao3_scrape.metrics import (
+    ADDRESS_ERROR_RATE,
+    ADDRESS_LATENCY,
+    ADDRESS_REPLACEMENTS,
+    ADDRESS_REQUEST_RATE,
+    ADDRESS_REQUESTS,
+    QUARANTINED_ADDRESSES,
+)
+from ao3_scrape.ratelimit import RateLimiter
+from ao3_scrape.session_pool import LocalAddress, SessionPool
+
+OUTCOMES = ["ok", "error", "ratelimited"]
+
+
+@dataclass
+class AddressStats:
+    # moving averages of the time to response headers, and of how often
+    # requests fail
+    latency: Optional[float] = None
+    error_rate: float = 0
+
+    requests: int = 0
+    quarantines: int = 0
+    quarantined_until: float = 0
+
+    def score(self) -> float:
+        """
+        The expected time per successful request, lower being better. Addresses
+        which haven't been measured yet come first, so every one gets tried.
+        """
+        if self.latency is None:
+            return 0
+
+        return self.latency / max(1 - self.error_rate, 0.01)
+
+
+class AddressPool:
+    """
+    The working set of source addresses, `size` of them drawn from the session
+    pool's network, with their latency, error and 429 statistics.
+
+    Each request goes to the best scoring address that the rate limiter lets
+    send right away. An address failing more than `max_error_rate` of its
+    requests is quarantined for `quarantine_time` seconds, and after
+    `max_quarantines` quarantines it is swapped for a fresh one.
+    """
+
+    def __init__(
+        self,
+        sessions: SessionPool,
+        limiter: RateLimiter,
+        size: int = 16,
+        smoothing: float = 0.2,
+        min_requests: int = 5,
+        max_error_rate: float = 0.5,
+        quarantine_time: float = 300,
+        max_quarantines: int = 3,
+    ):
+        self.sessions = sessions
+        self.limiter = limiter
+        self.smoothing = smoothing
+        self.min_requests = min_requests
+        self.max_error_rate = max_error_rate
+        self.quarantine_time = quarantine_time
+        self.max_quarantines = max_quarantines
+
+        self._stats: dict[LocalAddress, AddressStats] = {}
+        for address in sessions.sample_addresses(size):
+            self._add(address)
+
+        sessions.trace_configs.append(self.trace_config())
+
+    async def acquire(self) -> LocalAddress:
+        """
+        Wait until some healthy address may send a request, and take it.
+        """
+        while True:
+            now = time.monotonic()
+            healthy = [
+                address
+                for address, stats in self._stats.items()
+                if stats.quarantined_until <= now
+            ]
+            QUARANTINED_ADDRESSES.set(len(self._stats) - len(healthy))
+
+            if not healthy:
+                await asyncio.sleep(
+                    min(stats.quarantined_until for stats in self._stats.values()) - now
+                )
+                continue
+
+            waits = {address: self.limiter.wait(address, now) for address in healthy}
+            ready = [address for address, wait in waits.items() if wait == 0]
+            if not ready:
+                await asyncio.sleep(min(waits.values()))
+                continue
+
+            random.shuffle(ready)
+            address = min(ready, key=lambda address: self._stats[address].score())
+            self.limiter.take(address)
+            return address
+
+    def succeeded(self, address: LocalAddress):
+        self.limiter.succeeded(address)
+        self._record(address, "ok", error=False)
+
+    def failed(self, address: LocalAddress, error: BaseException):
+        print(f"Request from {address or 'default address'} failed: {error!r}")
+        self._record(address, "error", error=True)
+
+    def throttled(self, address: LocalAddress, retry_after: Optional[float] = None):
+        self.limiter.throttled(address, retry_after)
+        self._record(address, "ratelimited", error=False)
+
+    def latency(self) -> Optional[float]:
+        """
+        The average latency of the measured addresses.
+        """
+        latencies = [
+            stats.latency for stats in self._stats.values() if stats.latency is not None
+        ]
+        return sum(latencies) / len(latencies) if latencies else None
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """
+        Measures each address's latency as the time until response headers, so
+        that it doesn't include reading the body or parsing it.
+        """
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(
+            session: aiohttp.ClientSession, context: SimpleNamespace, params
+        ):
+            context.start = time.monotonic()
+
+        async def on_request_end(
+            session: aiohttp.ClientSession, context: SimpleNamespace, params
+        ):
+            address = session.connector._local_addr
+            if address in self._stats:
+                self._observe_latency(address, time.monotonic() - context.start)
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    def _observe_latency(self, address: LocalAddress, latency: float):
+        stats = self._stats[address]
+        stats.latency = (
+            latency if stats.latency is None else self._smooth(stats.latency, latency)
+        )
+        ADDRESS_LATENCY.labels(address=label(address)).set(stats.latency)
+
+    def _record(self, address: LocalAddress, outcome: str, error: bool):
+        stats = self._stats.get(address)
+        if stats is None:
+            # replaced while the request was in flight
+            return
+
+        stats.requests += 1
+        stats.error_rate = self._smooth(stats.error_rate, float(error))
+
+        ADDRESS_REQUESTS.labels(address=label(address), outcome=outcome).inc()
+        ADDRESS_ERROR_RATE.labels(address=label(address)).set(stats.error_rate)
+        ADDRESS_REQUEST_RATE.labels(address=label(address)).set(
+            self.limiter.rate(address)
+        )
+
+        if (
+            stats.requests >= self.min_requests
+            and stats.error_rate > self.max_error_rate
+        ):
+            self._quarantine(address, stats)
+
+    def _quarantine(self, address: LocalAddress, stats: AddressStats):
+        now = time.monotonic()
+        if not any(
+            other.quarantined_until <= now
+            for other_address, other in self._stats.items()
+            if other_address != address
+        ):
+            # nothing left to send requests from, so keep using it
+            return
+
+        stats.quarantines += 1
+
+        network = self.sessions.ip_network
+        if (
+            stats.quarantines >= self.max_quarantines
+            and network is not None
+            and network.num_addresses > len(self._stats)
+        ):
+            print(f"Replacing failing address {address}.")
+            ADDRESS_REPLACEMENTS.inc()
+            self._remove(address)
+            self._add(self._fresh_address())
+            return
+
+        print(f"Quarantining {address or 'default address'}.")
+        # start over once out of quarantine, rather than going straight back in
+        stats.quarantined_until = now + self.quarantine_time
+        stats.requests = 0
+        stats.error_rate = 0
+
+    def _fresh_address(self) -> LocalAddress:
+        while True:
+            address = self.sessions.random_address()
+            if address not in self._stats:
+                return address
+
+    def _add(self, address: LocalAddress):
+        self._stats[address] = AddressStats()
+        for outcome in OUTCOMES:
+            ADDRESS_REQUESTS.labels(address=label(address), outcome=outcome)
+
+    def _remove(self, address: LocalAddress):
+        del self._stats[address]
+        self.limiter.remove(address)
+
+        for metric in [ADDRESS_LATENCY, ADDRESS_ERROR_RATE, ADDRESS_REQUEST_RATE]:
+            try:
+                metric.remove(label(address))
+            except KeyError:
+                pass
+        for outcome in OUTCOMES:
+            ADDRESS_REQUESTS.remove(label(address), outcome)
+
+    def _smooth(self, average: float, value: float) -> float:
+        return (1 - self.smoothing) * average + self.smoothing * value
+
+
+def label(address: LocalAddress) -> str:
+    return "default" if address is None else str(address)
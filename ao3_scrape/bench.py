@@ -0,0 +1,439 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+import json
+import multiprocessing
+from pathlib import Path
+import random
+import re
+import resource
+import socket
+import sqlite3
+import tempfile
+import time
+from typing import Optional
+import aiohttp
+import prometheus_client
+import typer
+
+from ao3_scrape import ScrapeContext, database, scrape_works
+from ao3_scrape.address_pool import AddressPool
+from ao3_scrape.mock_archive import MockArchive, serve
+from ao3_scrape.ratelimit import RateLimiter
+from ao3_scrape.scrape import BASE_URL, search
+from ao3_scrape.scrape.work import (
+    Work,
+    WorkParser,
+    download_work,
+    parse_work_html,
+)
+from ao3_scrape.session_pool import SessionPool
+
+app = typer.Typer(pretty_exceptions_show_locals=False)
+
+# the days synthetic works are published between
+FIRST_DAY = date(2009, 1, 1).toordinal()
+LAST_DAY = date(2023, 9, 1).toordinal()
+
+
+@app.command()
+def parse(files: list[Path], repeat: int = 3):
+    """
+    Check that every work parser agrees with html.parser on saved work pages
+    (like those written on parse errors) and compare how fast they are.
+    """
+    docs = [(path, path.read_text(), parse_work_id(path)) for path in files]
+    reference = {
+        path: parse_work_html(html, work_id, WorkParser.HTML_PARSER)
+        for path, html, work_id in docs
+    }
+
+    for parser in WorkParser:
+        mismatches = 0
+        for path, html, work_id in docs:
+            parsed = parse_work_html(html, work_id, parser)
+            for field, expected in reference[path].items():
+                if parsed[field] != expected:
+                    mismatches += 1
+                    print(f"{parser.value}: {path} differs in {field}.")
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for path, html, work_id in docs:
+                parse_work_html(html, work_id, parser)
+        elapsed = time.perf_counter() - start
+
+        print(
+            f"{parser.value}: {len(docs) * repeat / elapsed:.1f} works/s, "
+            f"{mismatches} mismatched fields."
+        )
+
+
+def parse_work_id(path: Path) -> int:
+    match = re.search(r"\d+", path.stem)
+    return int(match.group()) if match else 0
+
+
+@app.command()
+def compression(
+    db: str = "ao3.db",
+    levels: list[int] = [3, 9, 15, 19],
+    language: str = "English",
+    samples: int = 1000,
+    dict_size: int = 100_000,
+):
+    """
+    Compress a sample of stored chapters at each level, with and without a
+    dictionary trained on a separate sample, and report the compression ratio
+    and how many MB/s of chapter text can be compressed (and so written).
+    """
+    conn = database.open_db(db)
+    cur = conn.cursor()
+
+    cur.execute(
+        """
+        SELECT chapters.id FROM chapters JOIN works ON works.id = chapters.work_id
+        WHERE language = ? ORDER BY random() LIMIT ?;
+        """,
+        (language, samples * 2),
+    )
+    chapter_ids = [chapter_id for (chapter_id,) in cur]
+    # train on one half and measure on the other, as new chapters would be
+    training, test = chapter_ids[::2], chapter_ids[1::2]
+    if not test:
+        print(f"No {language} chapters stored.")
+        raise typer.Exit(1)
+
+    cur.execute(
+        """
+        CREATE TEMP TABLE bench_chapters AS
+        SELECT CAST(content AS BLOB) AS content FROM chapters
+        WHERE id IN (SELECT value FROM json_each(?));
+        """,
+        (json.dumps(test),),
+    )
+    (size,) = cur.execute("SELECT sum(length(content)) FROM bench_chapters;").fetchone()
+
+    (dictionary,) = cur.execute(
+        """
+        SELECT zstd_train_dict(content, ?, ?) FROM chapters
+        WHERE id IN (SELECT value FROM json_each(?));
+        """,
+        (dict_size, len(training), json.dumps(training)),
+    ).fetchone()
+
+    print(f"{len(test)} chapters, {size / 1e6:.1f} MB.")
+    for level in levels:
+        for name, dict_ in [("no dictionary", None), ("dictionary", dictionary)]:
+            compressed, elapsed = compress_chapters(conn, level, dict_)
+            print(
+                f"level {level}, {name}: ratio {size / compressed:.2f}, "
+                f"{size / elapsed / 1e6:.1f} MB/s."
+            )
+
+
+def compress_chapters(
+    conn: sqlite3.Connection, level: int, dictionary: Optional[bytes]
+) -> tuple[int, float]:
+    start = time.perf_counter()
+    (compressed,) = conn.execute(
+        "SELECT sum(length(zstd_compress(content, ?, ?))) FROM bench_chapters;",
+        (level, dictionary),
+    ).fetchone()
+    return compressed, time.perf_counter() - start
+
+
+@app.command()
+def write(
+    works: int = 20_000,
+    batch_size: int = 64,
+    chapters: int = 3,
+    chapter_words: int = 500,
+):
+    """
+    Store synthetic works into a new database with every index kept up to date,
+    then again as a bulk load which builds them at the end, and compare how many
+    rows a second get written.
+    """
+    rng = random.Random(0)
+    docs = [
+        synthetic_work(rng, work_id, chapters, chapter_words)
+        for work_id in rng.sample(range(1, works * 10), works)
+    ]
+    rows = sum(
+        1
+        + len(work["content"])
+        + sum(len(work[f"{ty}_tags"]) for ty in ["rating", "fandom", "freeform"])
+        for work in docs
+    )
+
+    for name, bulk_load in [("indexed", False), ("bulk load", True)]:
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = database.open_db(f"{tmp}/bench.db")
+            database.init_db(conn)
+            if bulk_load:
+                database.drop_indexes(conn)
+                database.set_pragmas(conn, database.BULK_LOAD_PRAGMAS)
+
+            start = time.perf_counter()
+            for i in range(0, works, batch_size):
+                database.commit(
+                    conn,
+                    [
+                        (database.insert_work, (work,))
+                        for work in docs[i : i + batch_size]
+                    ],
+                )
+            loaded = time.perf_counter()
+            database.build_indexes(conn)
+            elapsed = time.perf_counter() - start
+
+            conn.close()
+
+        print(
+            f"{name}: {rows / elapsed:.0f} rows/s, "
+            f"{loaded - start:.1f}s writing and {start + elapsed - loaded:.1f}s "
+            "building indexes."
+        )
+
+
+def synthetic_work(
+    rng: random.Random, work_id: int, chapters: int, chapter_words: int
+) -> Work:
+    return {
+        "id": work_id,
+        "title": f"Work {work_id}",
+        "author": f"author{rng.randrange(10_000)}",
+        "author_pseud": f"pseud{rng.randrange(10_000)}",
+        "summary": "A summary of the work.",
+        "notes": None,
+        "published": date.fromordinal(rng.randrange(FIRST_DAY, LAST_DAY)).isoformat(),
+        "updated": None,
+        "words": chapters * chapter_words,
+        "chapters_published": chapters,
+        "chapters_total": chapters,
+        "language": rng.choice(["English", "English", "English", "Deutsch", "中文"]),
+        "hits": rng.randrange(100_000),
+        "kudos": rng.randrange(10_000),
+        "comments": rng.randrange(1_000),
+        "bookmarks": rng.randrange(1_000),
+        "rating_tags": [rng.choice(["General Audiences", "Teen", "Mature"])],
+        "warning_tags": [],
+        "category_tags": [],
+        "fandom_tags": [f"Fandom {rng.randrange(1_000)}" for _ in range(2)],
+        "character_tags": [],
+        "relationship_tags": [],
+        "freeform_tags": [
+            f"A fairly long freeform tag number {rng.randrange(20_000)}"
+            for _ in range(rng.randrange(10))
+        ],
+        "content": [
+            {
+                "id": work_id * 100 + chapter,
+                "title": f"Chapter {chapter}",
+                "content": " ".join(
+                    rng.choice(["lorem", "ipsum", "dolor", "sit", "amet"])
+                    for _ in range(chapter_words)
+                ),
+            }
+            for chapter in range(chapters)
+        ],
+    }
+
+
+@app.command()
+def e2e(
+    recordings: Path,
+    pages: int = 20,
+    latency: float = 0.05,
+    ratelimit: float = 0,
+    retry_after: float = 1,
+    padding: int = 0,
+    page_concurrency: int = 1,
+    work_concurrency: int = 8,
+    max_in_flight: int = 16,
+    request_rate: float = 1000,
+    parser: WorkParser = WorkParser.HTML_PARSER.value,
+    parse_processes: int = 0,
+    write_batch_size: int = 64,
+    # the writer waits this long for a batch to fill before the end of the run
+    write_flush_interval: float = 1,
+):
+    """
+    Scrape `pages` search pages from a mock archive serving the recorded pages
+    in `recordings` (see `MockArchive`) into a new database, and report works
+    and bytes downloaded a second, CPU time per work and peak memory.
+    """
+    archive = MockArchive(recordings, pages, latency, ratelimit, retry_after, padding)
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    # in a process of its own, so it doesn't count towards the measurements
+    server = multiprocessing.Process(target=serve, args=(archive, port), daemon=True)
+    server.start()
+    wait_for_port(port)
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = f"{tmp}/bench.db"
+            conn = database.open_db(db)
+            database.init_db(conn)
+            conn.close()
+
+            before = resource.getrusage(resource.RUSAGE_SELF)
+            before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            start = time.perf_counter()
+
+            parse_pool = (
+                ProcessPoolExecutor(parse_processes) if parse_processes else None
+            )
+            asyncio.run(
+                scrape_mock_archive(
+                    db,
+                    f"http://127.0.0.1:{port}",
+                    page_concurrency,
+                    work_concurrency,
+                    max_in_flight,
+                    request_rate,
+                    parser,
+                    parse_pool,
+                    write_batch_size,
+                    write_flush_interval,
+                )
+            )
+            if parse_pool is not None:
+                # so that the workers' usage is counted
+                parse_pool.shutdown()
+
+            elapsed = time.perf_counter() - start
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+            conn = database.open_db(db)
+            (works,) = conn.execute("SELECT count(*) FROM works;").fetchone()
+            conn.close()
+    finally:
+        server.terminate()
+
+    downloaded = sum(
+        prometheus_client.REGISTRY.get_sample_value(
+            "downloaded_bytes_total", {"doc_type": doc_type}
+        )
+        for doc_type in ["page", "work"]
+    )
+    cpu = (
+        cpu_time(after)
+        - cpu_time(before)
+        + cpu_time(after_children)
+        - cpu_time(before_children)
+    )
+
+    print(
+        f"{works} works in {elapsed:.1f}s: {works / elapsed:.1f} works/s, "
+        f"{downloaded / elapsed / 1e6:.2f} MB/s."
+    )
+    print(
+        f"{cpu / max(works, 1) * 1000:.1f}ms CPU per work, "
+        f"peak RSS {after.ru_maxrss / 1024:.0f} MiB"
+        + (
+            f" ({after_children.ru_maxrss / 1024:.0f} MiB per parse process)."
+            if parse_processes
+            else "."
+        )
+    )
+
+
+async def scrape_mock_archive(
+    db: str,
+    base_url: str,
+    page_concurrency: int,
+    work_concurrency: int,
+    max_in_flight: int,
+    request_rate: float,
+    parser: WorkParser,
+    parse_pool: Optional[ProcessPoolExecutor],
+    write_batch_size: int,
+    write_flush_interval: float,
+):
+    writer = database.DatabaseWriter(
+        db, batch_size=write_batch_size, flush_interval=write_flush_interval
+    )
+    await writer.start()
+
+    sessions = SessionPool(
+        None, connections_per_session=max_in_flight, base_url=base_url
+    )
+    ctx = ScrapeContext(
+        db=writer,
+        sessions=sessions,
+        addresses=AddressPool(
+            sessions,
+            RateLimiter(initial_rate=request_rate, max_rate=request_rate),
+            size=1,
+        ),
+        work_concurrency=work_concurrency,
+        in_flight=asyncio.Semaphore(max_in_flight),
+        parse_pool=parse_pool,
+        parser=parser,
+    )
+    await scrape_works(
+        ctx, page_concurrency, search.RelativeSearch(1, search.TimeUnit.DAY), 1
+    )
+
+    await sessions.close()
+    await writer.close()
+
+
+def wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def cpu_time(usage: resource.struct_rusage) -> float:
+    return usage.ru_utime + usage.ru_stime
+
+
+@app.command()
+def record(
+    out: Path,
+    pages: int = 1,
+    search_time: int = 1,
+    search_unit: search.TimeUnit = "day",
+    interval: float = 2,
+):
+    """
+    Save search pages and the works listed on them from the archive into `out`,
+    for `bench e2e` to serve, waiting `interval` seconds between requests.
+    """
+    asyncio.run(
+        record_archive(
+            out, pages, search.RelativeSearch(search_time, search_unit), interval
+        )
+    )
+
+
+async def record_archive(out: Path, pages: int, query: search.Search, interval: float):
+    out.mkdir(parents=True, exist_ok=True)
+
+    async with aiohttp.ClientSession(BASE_URL) as client:
+        for page in range(1, pages + 1):
+            html = await search.download_page(client, query, page)
+            (out / f"page_{page}.html").write_text(html)
+
+            for result in search.parse_html(html, query, page, search.parse_page):
+                await asyncio.sleep(interval)
+
+                html = await download_work(client, result["id"])
+                if html is not None:
+                    (out / f"work_{result['id']}.html").write_text(html)
+
+            print(f"Recorded page {page}.")
+            await asyncio.sleep(interval)
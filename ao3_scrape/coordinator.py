@@ -0,0 +1,325 @@
+import asyncio
+from datetime import datetime, timedelta
+import sqlite3
+import time
+from typing import Iterable, Iterator, Optional
+import aiohttp
+from aiohttp import web
+
+from ao3_scrape import ScrapeContext, scrape_date_range
+from ao3_scrape.metrics import LEASES
+from ao3_scrape.scrape import search
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+
+
+def windows(
+    date_range: search.DateRangeSearch, length: timedelta
+) -> Iterator[search.DateRangeSearch]:
+    """
+    A date range cut into windows of `length`, newest first.
+    """
+    end = date_range.end
+    while end > date_range.start:
+        start = max(date_range.start, end - length)
+        yield search.DateRangeSearch(start, end)
+        end = start
+
+
+class Coordinator:
+    """
+    Hands out the windows of a date range to worker processes as leases, over
+    a small JSON API. Each window is leased to one worker at a time, newest
+    first, and goes back to being pending if its lease isn't renewed within
+    `lease_time` seconds, so that the windows of a worker which died are picked
+    up by another.
+
+    The leases are kept in a database of their own, so that a restarted
+    coordinator carries on where it left off.
+    """
+
+    def __init__(self, path: str, lease_time: float = 600):
+        self.lease_time = lease_time
+
+        self.conn = sqlite3.connect(path)
+        self.conn.isolation_level = None
+        self.conn.executescript(
+            """
+            PRAGMA journal_mode = wal;
+
+            CREATE TABLE IF NOT EXISTS leases (
+                id INTEGER PRIMARY KEY,
+                start TEXT NOT NULL,
+                end TEXT NOT NULL,
+                state TEXT NOT NULL,
+                worker TEXT,
+                expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (start, end)
+            );
+            """
+        )
+
+    def add_windows(self, windows: Iterable[search.DateRangeSearch]):
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO leases (start, end, state) VALUES (?, ?, ?);",
+            [
+                (window.start.isoformat(), window.end.isoformat(), PENDING)
+                for window in windows
+            ],
+        )
+        self._update_metrics()
+
+    def lease(self, worker: str) -> Optional[dict]:
+        now = time.time()
+
+        expired = self.conn.execute(
+            "SELECT id, worker FROM leases WHERE state = ? AND expires < ?;",
+            (LEASED, now),
+        ).fetchall()
+        for lease_id, previous in expired:
+            print(f"Lease {lease_id} held by {previous} expired.")
+            self.conn.execute(
+                "UPDATE leases SET state = ?, worker = NULL WHERE id = ?;",
+                (PENDING, lease_id),
+            )
+
+        row = self.conn.execute(
+            "SELECT id, start, end FROM leases WHERE state = ? ORDER BY end DESC;",
+            (PENDING,),
+        ).fetchone()
+        if row is None:
+            return None
+
+        lease_id, start, end = row
+        self.conn.execute(
+            """
+            UPDATE leases SET state = ?, worker = ?, expires = ?, attempts = attempts + 1
+            WHERE id = ?;
+            """,
+            (LEASED, worker, now + self.lease_time, lease_id),
+        )
+        self._update_metrics()
+        print(f"Leased {start} to {end} to {worker}.")
+
+        return {"id": lease_id, "start": start, "end": end, "ttl": self.lease_time}
+
+    def renew(self, lease_id: int, worker: str) -> bool:
+        cur = self.conn.execute(
+            "UPDATE leases SET expires = ? WHERE id = ? AND worker = ? AND state = ?;",
+            (time.time() + self.lease_time, lease_id, worker, LEASED),
+        )
+        return cur.rowcount > 0
+
+    def complete(self, lease_id: int, worker: str) -> bool:
+        # a window finished by a worker whose lease had expired is still done
+        cur = self.conn.execute(
+            "UPDATE leases SET state = ?, worker = ? WHERE id = ? AND state != ?;",
+            (DONE, worker, lease_id, DONE),
+        )
+        self._update_metrics()
+        return cur.rowcount > 0
+
+    def release(self, lease_id: int, worker: str) -> bool:
+        cur = self.conn.execute(
+            """
+            UPDATE leases SET state = ?, worker = NULL
+            WHERE id = ? AND worker = ? AND state = ?;
+            """,
+            (PENDING, lease_id, worker, LEASED),
+        )
+        self._update_metrics()
+        return cur.rowcount > 0
+
+    def counts(self) -> dict[str, int]:
+        counts = {PENDING: 0, LEASED: 0, DONE: 0}
+        counts.update(
+            self.conn.execute("SELECT state, count(*) FROM leases GROUP BY state;")
+        )
+        return counts
+
+    def done(self) -> bool:
+        counts = self.counts()
+        return counts[PENDING] == counts[LEASED] == 0
+
+    def app(self) -> web.Application:
+        routes = web.RouteTableDef()
+
+        @routes.post("/lease")
+        async def lease(request: web.Request):
+            body = await request.json()
+            return web.json_response(
+                {"lease": self.lease(body["worker"]), "done": self.done()}
+            )
+
+        @routes.post("/leases/{id}/{action}")
+        async def update(request: web.Request):
+            body = await request.json()
+            action = {
+                "renew": self.renew,
+                "complete": self.complete,
+                "release": self.release,
+            }.get(request.match_info["action"])
+            if action is None:
+                raise web.HTTPNotFound()
+
+            if not action(int(request.match_info["id"]), body["worker"]):
+                raise web.HTTPConflict()
+            return web.json_response({})
+
+        @routes.get("/status")
+        async def status(request: web.Request):
+            return web.json_response(self.counts())
+
+        app = web.Application()
+        app.add_routes(routes)
+        return app
+
+    def _update_metrics(self):
+        for state, count in self.counts().items():
+            LEASES.labels(state=state).set(count)
+
+
+async def serve(coordinator: Coordinator, host: str, port: int, linger: float):
+    """
+    Serve leases until every window is done, and for `linger` seconds more so
+    that the workers hear about it.
+    """
+    runner = web.AppRunner(coordinator.app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Coordinating on {host}:{port}.")
+
+    while not coordinator.done():
+        await asyncio.sleep(1)
+
+    print("Every window is done.")
+    await asyncio.sleep(linger)
+    await runner.cleanup()
+
+
+class LeaseClient:
+    """
+    A worker's connection to the coordinator at `url`.
+    """
+
+    def __init__(self, url: str, worker: str):
+        self.url = url.rstrip("/")
+        self.worker = worker
+        self._session = aiohttp.ClientSession(raise_for_status=True)
+
+    async def lease(self) -> tuple[Optional[dict], bool]:
+        """
+        A lease on the next window, if any is left, and whether every window is
+        done.
+        """
+        async with self._session.post(
+            f"{self.url}/lease", json={"worker": self.worker}
+        ) as res:
+            body = await res.json()
+            return body["lease"], body["done"]
+
+    async def update(self, lease_id: int, action: str) -> bool:
+        try:
+            async with self._session.post(
+                f"{self.url}/leases/{lease_id}/{action}", json={"worker": self.worker}
+            ):
+                return True
+        except aiohttp.ClientResponseError as error:
+            if error.status == 409:
+                return False
+            raise
+
+    async def close(self):
+        await self._session.close()
+
+
+async def scrape_leases(
+    ctx: ScrapeContext,
+    client: LeaseClient,
+    shard_concurrency: int,
+    page_concurrency: int,
+    resume: bool = True,
+    poll_interval: float = 10,
+):
+    """
+    Scrape windows leased from the coordinator until it says they're all done,
+    renewing each lease while its window is being scraped.
+    """
+    while True:
+        lease, done = await client.lease()
+        if lease is None:
+            if done:
+                return
+
+            # the rest are leased to other workers, but might yet expire
+            await asyncio.sleep(poll_interval)
+            continue
+
+        window = search.DateRangeSearch(
+            datetime.fromisoformat(lease["start"]), datetime.fromisoformat(lease["end"])
+        )
+        print(f"== Downloading leased {window.describe()}.")
+
+        scraping = asyncio.create_task(
+            scrape_date_range(
+                ctx, shard_concurrency, page_concurrency, window, resume=resume
+            )
+        )
+        renewer = asyncio.create_task(renew(client, lease))
+        try:
+            done, _ = await asyncio.wait(
+                [scraping, renewer], return_when=asyncio.FIRST_COMPLETED
+            )
+        except BaseException:
+            await stop(scraping, renewer)
+            await client.update(lease["id"], "release")
+            raise
+        await stop(scraping, renewer)
+
+        if scraping not in done:
+            # raises whatever went wrong renewing other than losing the lease
+            renewer.result()
+            print(f"Stopped downloading {window.describe()}, whose lease was lost.")
+            continue
+
+        if scraping.exception() is not None:
+            await client.update(lease["id"], "release")
+            raise scraping.exception()
+
+        await client.update(lease["id"], "complete")
+
+
+async def renew(client: LeaseClient, lease: dict):
+    """
+    Renew a lease every third of its time until it's lost, either to another
+    worker or by failing to renew it before it expires. A window being scraped
+    by another worker is left to it.
+    """
+    interval = lease["ttl"] / 3
+    expires = time.monotonic() + lease["ttl"]
+    while True:
+        await asyncio.sleep(interval)
+
+        try:
+            renewed = await client.update(lease["id"], "renew")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            print(f"Failed to renew lease {lease['id']}: {error!r}")
+            if time.monotonic() + interval < expires:
+                continue
+            renewed = False
+
+        if not renewed:
+            print(f"Lost lease {lease['id']}.")
+            return
+        expires = time.monotonic() + lease["ttl"]
+
+
+async def stop(*tasks: asyncio.Task):
+    for task in tasks:
+        task.cancel()
+
+    # waited for so that neither outlives the window, and their errors are seen
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,14 +1,90 @@
 import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import itertools
+import json
 import os
 import sqlite3
+import time
+import traceback
+from typing import Any, Callable, Optional, Tuple, TypeVar
 
-from .scrape.work import Work
+from .metrics import (
+    COMMIT_TIME,
+    DEAD_LETTERS,
+    DEDUPLICATED_CHAPTERS,
+    UNCHANGED_CHAPTERS,
+    WRITE_BATCH_SIZE,
+    WRITE_RETRIES,
+    WRITER_QUEUE_DEPTH,
+)
+from .scrape import RetryPolicy
+from .scrape.search import SearchResult
+from .scrape.work import Chapter, Work
+
+T = TypeVar("T")
 
 SQLITE_ZSTD_PATH = os.environ["SQLITE_ZSTD_PATH"]
 
 
-def open_db(path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(path)
+class TagCache:
+    """
+    The ids of the `size` most recently used tags, so that storing a work's
+    tags doesn't usually need a query for each of them.
+    """
+
+    def __init__(self, size: int = 100_000):
+        self.size = size
+        self._ids: OrderedDict[Tuple[str, str], int] = OrderedDict()
+
+    def get(self, cur: sqlite3.Cursor, name: str, type: str) -> int:
+        key = (name, type)
+
+        tag_id = self._ids.get(key)
+        if tag_id is None:
+            cur.execute("SELECT id FROM tags WHERE name = ? AND type = ?;", key)
+            row = cur.fetchone()
+            if row is None:
+                cur.execute("INSERT INTO tags (name, type) VALUES (?, ?);", key)
+                tag_id = cur.lastrowid
+            else:
+                (tag_id,) = row
+
+            self._ids[key] = tag_id
+            if len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+        else:
+            self._ids.move_to_end(key)
+
+        return tag_id
+
+    def clear(self):
+        self._ids.clear()
+
+
+class Connection(sqlite3.Connection):
+    """
+    A connection with the tag ids it has seen, which have to be forgotten
+    whenever a transaction is rolled back in case it added them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tag_ids = TagCache()
+
+
+def open_db(
+    path: str, check_same_thread: bool = True, rewrite: bool = False
+) -> Connection:
+    """
+    Open the database at `path`, bringing its schema up to date unless that
+    would mean rewriting stored data and `rewrite` isn't set, in which case
+    `OutdatedDatabaseError` is raised.
+    """
+    conn = sqlite3.connect(
+        path, check_same_thread=check_same_thread, factory=Connection
+    )
     conn.isolation_level = None
 
     conn.enable_load_extension(True)
@@ -17,20 +93,302 @@ def open_db(path: str) -> sqlite3.Connection:
     cur = conn.cursor()
     cur.executescript(
         """
-        PRAGMA auto_vacuum = full;
+        PRAGMA auto_vacuum = incremental;
         PRAGMA journal_mode = wal;
         PRAGMA foreign_keys = on;
         """
     )
 
+    if has_table(conn, "works"):
+        try:
+            migrate(conn, rewrite)
+        except OutdatedDatabaseError:
+            conn.close()
+            raise
+
     return conn
 
 
+def has_table(conn: sqlite3.Connection, name: str) -> bool:
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = ?;", (name,))
+    return cur.fetchone() is not None
+
+
+def is_view(conn: sqlite3.Connection, name: str) -> bool:
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = ?;", (name,)
+    )
+    return cur.fetchone() is not None
+
+
+class OutdatedDatabaseError(Exception):
+    def __init__(self, path: str):
+        super().__init__(
+            f"{path} was created by an older version and needs its chapters "
+            "rewritten, which `migrate` does."
+        )
+
+
+# chapters' content, stored once however many chapters have it, and the
+# chapters pointing at it
+CHAPTER_TABLES = """
+    CREATE TABLE chapter_contents (
+        id INTEGER PRIMARY KEY,
+        hash BLOB NOT NULL UNIQUE,
+        -- of the work it was first stored for, which picks its dictionary
+        language TEXT NOT NULL,
+        content TEXT NOT NULL
+    );
+
+    -- no foreign key to chapter_contents, which transparent compression renames
+    CREATE TABLE work_chapters (
+        id INTEGER PRIMARY KEY,
+        work_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        content_id INTEGER NOT NULL,
+        FOREIGN KEY (work_id) REFERENCES works (id)
+    );
+
+    -- looked up while downloading a work a chapter at a time
+    CREATE INDEX work_chapters_by_work_id ON work_chapters (work_id);
+    -- looked up to tell whether content is still used when a chapter changes
+    CREATE INDEX work_chapters_by_content_id ON work_chapters (content_id);
+"""
+
+# run outside of any transaction, like every other use of transparent
+# compression's functions
+COMPRESS_CHAPTER_CONTENTS = """
+    SELECT zstd_enable_transparent('{
+        "table": "chapter_contents",
+        "column": "content",
+        "compression_level": 19,
+        "dict_chooser": "language"
+    }');
+"""
+
+# created only once chapter_contents is compression's view, which renaming the
+# table beneath it would otherwise have bypassed
+CHAPTERS_VIEW = """
+    CREATE VIEW chapters AS
+    SELECT work_chapters.id, work_id, title, content
+    FROM work_chapters JOIN chapter_contents
+    ON chapter_contents.id = work_chapters.content_id;
+"""
+
+
+def share_chapter_contents(conn: sqlite3.Connection, batch_size: int = 1000):
+    """
+    Move the chapters stored before content was shared into `CHAPTER_TABLES`,
+    `batch_size` chapters to a transaction, compressing each batch before the
+    next so that the database never holds much uncompressed. Picks up where it
+    left off if interrupted.
+    """
+    cur = conn.cursor()
+
+    if not has_table(conn, "work_chapters"):
+        cur.executescript(
+            f"""
+            BEGIN TRANSACTION;
+            {CHAPTER_TABLES}
+            COMMIT;
+            """
+        )
+    if not is_view(conn, "chapter_contents"):
+        cur.execute(COMPRESS_CHAPTER_CONTENTS)
+
+    moved = 0
+    while True:
+        cur.execute("BEGIN TRANSACTION;")
+        try:
+            # in order, so that the chapters moved so far are those up to the
+            # last one moved
+            cur.execute(
+                """
+                SELECT id, work_id, title, content FROM chapters
+                WHERE id > (SELECT coalesce(max(id), 0) FROM work_chapters)
+                ORDER BY id LIMIT ?;
+                """,
+                (batch_size,),
+            )
+            batch = cur.fetchall()
+            for work_id, rows in itertools.groupby(batch, key=lambda row: row[1]):
+                insert_chapters(
+                    cur,
+                    work_id,
+                    [
+                        {"id": chapter_id, "title": title, "content": content}
+                        for chapter_id, _, title, content in rows
+                    ],
+                )
+        except BaseException:
+            cur.execute("ROLLBACK;")
+            raise
+        cur.execute("COMMIT;")
+
+        if not batch:
+            break
+        moved += len(batch)
+        print(f"Moved {moved} chapters, compressing...")
+        while run_incremental_maintenance(conn, 60, 1):
+            pass
+
+    cur.execute("BEGIN TRANSACTION;")
+    try:
+        if is_view(conn, "chapters"):
+            # transparent compression left a view in place of the table, over a
+            # table of its own, and a config which mustn't outlive them
+            cur.execute("DROP VIEW chapters;")
+            cur.execute("DROP TABLE _chapters_zstd;")
+            cur.execute(
+                """
+                DELETE FROM _zstd_configs
+                WHERE json_extract(config, '$.table') = 'chapters';
+                """
+            )
+        else:
+            cur.execute("DROP TABLE chapters;")
+        cur.execute("DROP TABLE chapter_hashes;")
+        cur.execute(CHAPTERS_VIEW)
+    except BaseException:
+        cur.execute("ROLLBACK;")
+        raise
+    cur.execute("COMMIT;")
+
+
+# schema changes made to databases created by earlier versions, applied in
+# order and tracked by `PRAGMA user_version`, which `init_db` starts at the
+# last of them. Those which are functions rewrite stored data, manage their own
+# transactions and are only run by the `migrate` command, rather than whenever
+# a database is opened.
+MIGRATIONS = [
+    # crawl frontier
+    """
+    CREATE TABLE crawls (
+        id INTEGER PRIMARY KEY,
+        search TEXT NOT NULL,
+        started INTEGER NOT NULL,
+        finished INTEGER
+    );
+
+    CREATE TABLE crawl_pages (
+        crawl_id INTEGER NOT NULL,
+        page INTEGER NOT NULL,
+        state TEXT NOT NULL,
+        works INTEGER,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (crawl_id, page),
+        FOREIGN KEY (crawl_id) REFERENCES crawls (id)
+    );
+
+    CREATE TABLE crawl_works (
+        crawl_id INTEGER NOT NULL,
+        work_id INTEGER NOT NULL,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        PRIMARY KEY (crawl_id, work_id),
+        FOREIGN KEY (crawl_id) REFERENCES crawls (id)
+    );
+
+    CREATE INDEX crawls_by_search ON crawls (search);
+    CREATE INDEX crawl_works_by_state ON crawl_works (crawl_id, state);
+    """,
+    # pages and works given up on
+    """
+    CREATE TABLE dead_letters (
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        item INTEGER NOT NULL,
+        search TEXT,
+        error TEXT NOT NULL,
+        failed INTEGER NOT NULL
+    );
+    """,
+    # works being downloaded a chapter at a time
+    """
+    CREATE TABLE partial_works (
+        work_id INTEGER PRIMARY KEY,
+        started INTEGER NOT NULL,
+        FOREIGN KEY (work_id) REFERENCES works (id)
+    );
+    """,
+    # tags stored once and referred to by id
+    """
+    CREATE TABLE tags (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        type TEXT NOT NULL,
+        UNIQUE (name, type)
+    );
+
+    INSERT INTO tags (name, type) SELECT DISTINCT tag, type FROM taggings;
+
+    CREATE TABLE tag_ids (
+        tag_id INTEGER NOT NULL,
+        work_id INTEGER NOT NULL,
+        PRIMARY KEY (tag_id, work_id),
+        FOREIGN KEY (tag_id) REFERENCES tags (id),
+        FOREIGN KEY (work_id) REFERENCES works (id)
+    ) WITHOUT ROWID;
+
+    INSERT INTO tag_ids
+    SELECT tags.id, work_id FROM taggings
+    JOIN tags ON tags.name = taggings.tag AND tags.type = taggings.type;
+
+    DROP TABLE taggings;
+    ALTER TABLE tag_ids RENAME TO taggings;
+
+    CREATE INDEX taggings_by_work_id ON taggings (work_id);
+    """,
+    # hashes of stored chapters, so that unchanged chapters aren't compressed
+    # again; chapters stored before this have none until they're rewritten
+    """
+    CREATE TABLE chapter_hashes (
+        chapter_id INTEGER PRIMARY KEY,
+        hash BLOB NOT NULL
+    );
+    """,
+    # content stored once however many chapters have it
+    share_chapter_contents,
+    # dead letters looked up by what failed, to tell whether a shard's letters
+    # were already merged
+    """
+    CREATE INDEX dead_letters_by_item ON dead_letters (kind, item);
+    """,
+]
+
+
+def migrate(conn: sqlite3.Connection, rewrite: bool = False):
+    cur = conn.cursor()
+
+    (version,) = cur.execute("PRAGMA user_version;").fetchone()
+    for version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        if not callable(migration):
+            cur.executescript(
+                f"""
+                BEGIN TRANSACTION;
+                {migration}
+                PRAGMA user_version = {version};
+                COMMIT;
+                """
+            )
+            continue
+
+        if not rewrite:
+            (_, _, path) = cur.execute("PRAGMA database_list;").fetchone()
+            raise OutdatedDatabaseError(path)
+
+        migration(conn)
+        cur.execute(f"PRAGMA user_version = {version};")
+
+
 def init_db(conn: sqlite3.Connection):
     cur = conn.cursor()
 
     cur.executescript(
-        """
+        f"""
         CREATE TABLE works (
             id INTEGER PRIMARY KEY, title TEXT NOT NULL,
             author TEXT NOT NULL,
@@ -49,51 +407,137 @@ def init_db(conn: sqlite3.Connection):
             bookmarks INTEGER NOT NULL
         );
 
-        CREATE TABLE chapters (
+        {CHAPTER_TABLES}
+
+        CREATE TABLE tags (
             id INTEGER PRIMARY KEY,
-            work_id INTEGER NOT NULL,
-            title TEXT NOT NULL,
-            content TEXT NOT NULL,
-            FOREIGN KEY (work_id) REFERENCES works (id)
+            name TEXT NOT NULL,
+            type TEXT NOT NULL,
+            UNIQUE (name, type)
         );
 
         CREATE TABLE taggings (
-            tag TEXT NOT NULL,
+            tag_id INTEGER NOT NULL,
             work_id INTEGER NOT NULL,
-            type TEXT NOT NULL,
-            PRIMARY KEY (tag, work_id),
+            PRIMARY KEY (tag_id, work_id),
+            FOREIGN KEY (tag_id) REFERENCES tags (id),
             FOREIGN KEY (work_id) REFERENCES works (id)
+        ) WITHOUT ROWID;
+
+        CREATE TABLE crawls (
+            id INTEGER PRIMARY KEY,
+            search TEXT NOT NULL,
+            started INTEGER NOT NULL,
+            finished INTEGER
         );
 
-        CREATE INDEX works_by_published ON works (published);
-        CREATE INDEX works_by_updated ON works (updated);
-        CREATE INDEX works_by_words ON works (words);
-        CREATE INDEX works_by_language ON works (language);
-        CREATE INDEX works_by_hits ON works (hits);
-        CREATE INDEX works_by_kudos ON works (kudos);
-        CREATE INDEX works_by_comments ON works (comments);
-        CREATE INDEX works_by_bookmarks ON works (bookmarks);
+        CREATE TABLE crawl_pages (
+            crawl_id INTEGER NOT NULL,
+            page INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            works INTEGER,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (crawl_id, page),
+            FOREIGN KEY (crawl_id) REFERENCES crawls (id)
+        );
 
-        CREATE INDEX chapters_by_work_id ON chapters (work_id);
+        CREATE TABLE crawl_works (
+            crawl_id INTEGER NOT NULL,
+            work_id INTEGER NOT NULL,
+            state TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            PRIMARY KEY (crawl_id, work_id),
+            FOREIGN KEY (crawl_id) REFERENCES crawls (id)
+        );
+
+        CREATE INDEX crawls_by_search ON crawls (search);
+        CREATE INDEX crawl_works_by_state ON crawl_works (crawl_id, state);
 
-        CREATE INDEX taggings_by_work_id ON taggings (work_id);
-        CREATE INDEX taggings_by_tag ON taggings (tag);
+        -- pages and works given up on
+        CREATE TABLE dead_letters (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            item INTEGER NOT NULL,
+            search TEXT,
+            error TEXT NOT NULL,
+            failed INTEGER NOT NULL
+        );
 
-        SELECT zstd_enable_transparent('{
-            \"table\": \"chapters\",
-            \"column\": \"content\",
-            \"compression_level\": 19,
-            \"dict_chooser\": \"SELECT language FROM works WHERE id = work_id LIMIT 1\"
-        }');
+        -- looked up by what failed, to tell whether a shard's letters were
+        -- already merged
+        CREATE INDEX dead_letters_by_item ON dead_letters (kind, item);
+
+        -- works being downloaded a chapter at a time
+        CREATE TABLE partial_works (
+            work_id INTEGER PRIMARY KEY,
+            started INTEGER NOT NULL,
+            FOREIGN KEY (work_id) REFERENCES works (id)
+        );
+
+        PRAGMA user_version = {len(MIGRATIONS)};
         """
     )
+    cur.execute(COMPRESS_CHAPTER_CONTENTS)
+    cur.execute(CHAPTERS_VIEW)
+
+    build_indexes(conn)
+
+
+# indexes only needed to query the data, which a bulk load builds once at the
+# end instead of updating on every insert
+SECONDARY_INDEXES = {
+    "works_by_published": "works (published)",
+    "works_by_updated": "works (updated)",
+    "works_by_words": "works (words)",
+    "works_by_language": "works (language)",
+    "works_by_hits": "works (hits)",
+    "works_by_kudos": "works (kudos)",
+    "works_by_comments": "works (comments)",
+    "works_by_bookmarks": "works (bookmarks)",
+    "taggings_by_work_id": "taggings (work_id)",
+}
+
+# trades durability against power loss (though not the database's integrity)
+# and memory for faster writes, for the duration of a bulk load
+BULK_LOAD_PRAGMAS = {
+    "synchronous": "normal",
+    "cache_size": -1024 * 1024,
+    "mmap_size": 1024 * 1024 * 1024,
+    "temp_store": "memory",
+}
+
+
+def build_indexes(conn: sqlite3.Connection):
+    cur = conn.cursor()
+
+    for name, columns in SECONDARY_INDEXES.items():
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {columns};")
+
+
+def drop_indexes(conn: sqlite3.Connection):
+    cur = conn.cursor()
+
+    for name in SECONDARY_INDEXES:
+        cur.execute(f"DROP INDEX IF EXISTS {name};")
+
+
+def set_pragmas(conn: sqlite3.Connection, pragmas: dict[str, Any]):
+    cur = conn.cursor()
+
+    for name, value in pragmas.items():
+        cur.execute(f"PRAGMA {name} = {value};")
 
 
 def write_work(conn: sqlite3.Connection, work: Work):
     cur = conn.cursor()
 
     cur.execute("BEGIN TRANSACTION;")
+    insert_work(cur, work)
+    cur.execute("COMMIT;")
 
+
+def insert_work(cur: sqlite3.Cursor, work: Work):
     cur.execute(
         """
         INSERT OR REPLACE INTO works VALUES (
@@ -118,28 +562,14 @@ def write_work(conn: sqlite3.Connection, work: Work):
         work,
     )
 
-    cur.executemany(
-        f"""
-        INSERT OR REPLACE INTO chapters VALUES (
-            :id,
-            {work["id"]},
-            :title,
-            :content
-        );
-        """,
-        work["content"],
-    )
+    insert_chapters(cur, work["id"], work["content"])
+    cur.execute("DELETE FROM partial_works WHERE work_id = ?;", (work["id"],))
 
+    tag_ids = cur.connection.tag_ids
     cur.executemany(
-        """
-        INSERT OR REPLACE INTO taggings VALUES (
-            :tag,
-            :work_id,
-            :type
-        );
-        """,
+        "INSERT OR REPLACE INTO taggings VALUES (?, ?);",
         [
-            {"tag": tag, "work_id": work["id"], "type": ty}
+            (tag_ids.get(cur, tag, ty), work["id"])
             for ty, tags in {
                 "rating": work["rating_tags"],
                 "warning": work["warning_tags"],
@@ -153,25 +583,573 @@ def write_work(conn: sqlite3.Connection, work: Work):
         ],
     )
 
-    cur.execute("COMMIT;")
 
+def insert_chapters(cur: sqlite3.Cursor, work_id: int, chapters: list[Chapter]):
+    """
+    Store a work's chapters, leaving those which are stored already and
+    unchanged alone, and pointing those whose content is already stored for any
+    chapter at it, so that no content is stored or compressed twice.
+    """
+    hashes = {
+        int(chapter["id"]): content_hash(chapter["content"]) for chapter in chapters
+    }
+    cur.execute(
+        """
+        SELECT work_chapters.id, work_id, title, hash, content_id
+        FROM work_chapters JOIN chapter_contents
+        ON chapter_contents.id = work_chapters.content_id
+        WHERE work_chapters.id IN (SELECT value FROM json_each(?));
+        """,
+        (json.dumps(list(hashes)),),
+    )
+    stored = {row[0]: row[1:] for row in cur}
+
+    changed = [
+        chapter
+        for chapter in chapters
+        if stored.get(int(chapter["id"]), ())[:3]
+        != (work_id, chapter["title"], hashes[int(chapter["id"])])
+    ]
+    UNCHANGED_CHAPTERS.inc(len(chapters) - len(changed))
+
+    content_ids = {}
+    for chapter in changed:
+        digest = hashes[int(chapter["id"])]
+        if digest in content_ids:
+            DEDUPLICATED_CHAPTERS.inc()
+            continue
+
+        cur.execute("SELECT id FROM chapter_contents WHERE hash = ?;", (digest,))
+        row = cur.fetchone()
+        if row is None:
+            cur.execute(
+                """
+                INSERT INTO chapter_contents (hash, language, content)
+                VALUES (?, (SELECT language FROM works WHERE id = ?), ?);
+                """,
+                (digest, work_id, chapter["content"]),
+            )
+            # looked up rather than taken from lastrowid, which inserting
+            # through compression's view doesn't set
+            cur.execute("SELECT id FROM chapter_contents WHERE hash = ?;", (digest,))
+            row = cur.fetchone()
+        else:
+            DEDUPLICATED_CHAPTERS.inc()
+        (content_ids[digest],) = row
+
+    cur.executemany(
+        "INSERT OR REPLACE INTO work_chapters VALUES (?, ?, ?, ?);",
+        [
+            (
+                int(chapter["id"]),
+                work_id,
+                chapter["title"],
+                content_ids[hashes[int(chapter["id"])]],
+            )
+            for chapter in changed
+        ],
+    )
+
+    # content the changed chapters had before, unless another chapter has it
+    cur.executemany(
+        """
+        DELETE FROM chapter_contents WHERE id = ?
+        AND NOT EXISTS (SELECT 1 FROM work_chapters WHERE content_id = ?);
+        """,
+        [
+            (content_id, content_id)
+            for content_id in {
+                stored[int(chapter["id"])][3]
+                for chapter in changed
+                if int(chapter["id"]) in stored
+            }
+        ],
+    )
+
+
+def content_hash(content: str) -> bytes:
+    return hashlib.sha256(content.encode()).digest()
 
-def run_incremental_maintenance(conn: sqlite3.Connection, duration, load):
+
+def begin_partial_work(cur: sqlite3.Cursor, work: Work):
+    """
+    Store a work's metadata ahead of its chapters, marking it as partial until
+    it's stored again with `insert_work`.
+    """
+    insert_work(cur, {**work, "content": []})
+    cur.execute(
+        "INSERT OR IGNORE INTO partial_works VALUES (?, ?);",
+        (work["id"], int(time.time())),
+    )
+
+
+def stored_chapters(
+    conn: sqlite3.Connection, work_id: int
+) -> Tuple[Optional[str], bool, set[int]]:
+    """
+    The date the stored copy of a work was last updated (None if it isn't stored),
+    whether it's partial, and the ids of its stored chapters.
+    """
     cur = conn.cursor()
 
-    cur.executescript(
-        f"""
-        SELECT zstd_incremental_maintenance({duration}, {load});
+    cur.execute(
         """
+        SELECT
+            date(coalesce(updated, published), 'unixepoch'),
+            id IN (SELECT work_id FROM partial_works)
+        FROM works WHERE id = ?;
+        """,
+        (work_id,),
     )
+    updated, partial = cur.fetchone() or (None, False)
+
+    cur.execute("SELECT id FROM work_chapters WHERE work_id = ?;", (work_id,))
+
+    return updated, bool(partial), {chapter_id for (chapter_id,) in cur}
+
+
+def merge_shard(conn: sqlite3.Connection, path: str):
+    """
+    Copy every work in the database at `path` into this one in a single
+    transaction, replacing works which are already stored. Tags are matched by
+    name and chapters' content by hash, since each shard numbers them
+    differently.
+    """
+    # bring the shard's schema up to date
+    open_db(path).close()
+
+    cur = conn.cursor()
+    cur.execute("ATTACH DATABASE ? AS shard;", (path,))
+    try:
+        cur.executescript(
+            """
+            BEGIN TRANSACTION;
+
+            INSERT OR REPLACE INTO main.works SELECT * FROM shard.works;
+
+            -- content already stored, for the same chapter or any other, is left
+            -- alone
+            INSERT INTO main.chapter_contents (hash, language, content)
+            SELECT hash, language, content FROM shard.chapter_contents
+            WHERE hash NOT IN (SELECT hash FROM main.chapter_contents);
+
+            -- content the shard's chapters had before, which may no longer be used
+            CREATE TEMP TABLE replaced_contents AS
+            SELECT content_id FROM main.work_chapters
+            WHERE id IN (SELECT id FROM shard.work_chapters);
+            -- content is numbered differently in each shard, so it's matched by hash
+            INSERT OR REPLACE INTO main.work_chapters
+            SELECT shard_chapters.id, work_id, title, main_contents.id
+            FROM shard.work_chapters AS shard_chapters
+            JOIN shard.chapter_contents AS shard_contents
+                ON shard_contents.id = shard_chapters.content_id
+            JOIN main.chapter_contents AS main_contents
+                ON main_contents.hash = shard_contents.hash;
+            DELETE FROM main.chapter_contents
+            WHERE id IN (SELECT content_id FROM temp.replaced_contents)
+            AND id NOT IN (SELECT content_id FROM main.work_chapters);
+            DROP TABLE temp.replaced_contents;
+
+            INSERT OR IGNORE INTO main.tags (name, type)
+            SELECT name, type FROM shard.tags;
+            INSERT OR REPLACE INTO main.taggings
+            SELECT main_tags.id, shard_taggings.work_id
+            FROM shard.taggings AS shard_taggings
+            JOIN shard.tags AS shard_tags ON shard_tags.id = shard_taggings.tag_id
+            JOIN main.tags AS main_tags
+                ON main_tags.name = shard_tags.name
+                AND main_tags.type = shard_tags.type;
+
+            INSERT OR REPLACE INTO main.partial_works SELECT * FROM shard.partial_works;
+            -- letters already copied by an earlier merge of the shard are left
+            -- alone
+            INSERT INTO main.dead_letters (kind, item, search, error, failed)
+            SELECT kind, item, search, error, failed FROM shard.dead_letters AS letters
+            WHERE NOT EXISTS (
+                SELECT 1 FROM main.dead_letters AS merged
+                WHERE merged.kind = letters.kind AND merged.item = letters.item
+                AND merged.search IS letters.search
+                AND merged.failed = letters.failed AND merged.error = letters.error
+            );
+
+            COMMIT;
+            """
+        )
+    except BaseException:
+        # a failed statement leaves the transaction open
+        if conn.in_transaction:
+            cur.execute("ROLLBACK;")
+        raise
+    finally:
+        cur.execute("DETACH DATABASE shard;")
+
 
+WriteOp = Callable[..., None]
 
-async def incremental_maintenance_worker(
-    conn: sqlite3.Connection,
-    interval: float = 300,
-    pause: float = 60,
-    load: float = 0.75,
+
+def update_work_stats(cur: sqlite3.Cursor, results: list[SearchResult]):
+    """
+    Update the hits, kudos, comments and bookmarks of already stored works.
+    """
+    cur.executemany(
+        """
+        UPDATE works SET
+            hits = :hits,
+            kudos = :kudos,
+            comments = :comments,
+            bookmarks = :bookmarks
+        WHERE id = :id;
+        """,
+        results,
+    )
+
+
+def insert_dead_letter(
+    cur: sqlite3.Cursor, kind: str, item: int, search: Optional[str], error: str
 ):
-    while True:
-        run_incremental_maintenance(conn, pause, load)
-        await asyncio.sleep(interval)
+    cur.execute(
+        """
+        INSERT INTO dead_letters (kind, item, search, error, failed)
+        VALUES (?, ?, ?, ?, ?);
+        """,
+        (kind, item, search, error, int(time.time())),
+    )
+
+
+# what a write which failed is recorded as in the dead letters: its kind and
+# the page or work it was for
+DeadLetter = Tuple[str, int]
+Write = Tuple[WriteOp, tuple, Optional[DeadLetter]]
+
+
+class DatabaseWriter:
+    """
+    Writes to the database from a dedicated thread with its own connection.
+
+    Operations are taken off a bounded queue, so producers are slowed down
+    once the writer falls behind, and are committed in batches of up to
+    `batch_size` operations, or whatever has arrived within `flush_interval`
+    seconds of the first operation in the batch.
+
+    Batches which find the database locked by another connection, like the
+    maintenance worker's, wait up to `busy_timeout` seconds for it and are then
+    retried as `retry` allows. Operations which still fail are recorded in the
+    dead letters.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        queue_size: int = 256,
+        batch_size: int = 64,
+        flush_interval: float = 5,
+        pragmas: Optional[dict[str, Any]] = None,
+        busy_timeout: float = 5,
+        retry: RetryPolicy = RetryPolicy(
+            attempts=10, base_delay=0.1, max_delay=10, deadline=120
+        ),
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pragmas = {"busy_timeout": int(busy_timeout * 1000), **(pragmas or {})}
+        self.retry = retry
+
+        self.queue: asyncio.Queue[Write] = asyncio.Queue(maxsize=queue_size)
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="database-writer"
+        )
+        self._conn: Optional[sqlite3.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        # a failure of the writer itself, rather than of an operation
+        self._error: Optional[BaseException] = None
+
+    async def start(self):
+        self._conn = await self.run(open_db, self.path)
+        await self.run(set_pragmas, self._conn, self.pragmas)
+        self._task = asyncio.create_task(self._write_batches())
+
+    async def close(self):
+        try:
+            await self.flush()
+        finally:
+            self._task.cancel()
+            await self.run(self._conn.close)
+            self._executor.shutdown()
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        """
+        Run `func` on the writer thread, outside of any batch.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def query(self, func: Callable[..., T], *args) -> T:
+        """
+        Run `func` with the writer's connection on the writer thread.
+        """
+        return await self.run(func, self._conn, *args)
+
+    async def submit(
+        self, op: WriteOp, *args, dead_letter: Optional[DeadLetter] = None
+    ):
+        """
+        Queue `op` to be called with a cursor and `args` in the next batch.
+        `dead_letter` is what it's recorded as if it fails, or else a write of
+        no particular page or work.
+        """
+        await self.queue.put((op, args, dead_letter))
+        WRITER_QUEUE_DEPTH.set(self.queue.qsize())
+
+    async def write_work(self, work: Work):
+        await self.submit(insert_work, work, dead_letter=("work", work["id"]))
+
+    async def begin_partial_work(self, work: Work):
+        await self.submit(begin_partial_work, work, dead_letter=("work", work["id"]))
+
+    async def write_chapters(self, work_id: int, chapters: list[Chapter]):
+        await self.submit(
+            insert_chapters, work_id, chapters, dead_letter=("work", work_id)
+        )
+
+    async def update_work_stats(self, results: list[SearchResult]):
+        await self.submit(update_work_stats, results)
+
+    async def write_dead_letter(
+        self, kind: str, item: int, search: Optional[str], error: BaseException
+    ):
+        await self.submit(insert_dead_letter, kind, item, search, repr(error))
+
+    async def flush(self):
+        """
+        Wait for everything queued so far to be written, raising whatever
+        stopped the writer from writing it.
+        """
+        await self.queue.join()
+
+        if self._error is not None:
+            raise RuntimeError("The database writer failed.") from self._error
+
+    async def _write_batches(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(
+                        await asyncio.wait_for(
+                            self.queue.get(), timeout=deadline - loop.time()
+                        )
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+            WRITER_QUEUE_DEPTH.set(self.queue.qsize())
+
+            try:
+                await self.run(self._commit_batch, batch)
+            except Exception as error:
+                # the operations' own failures are dead-lettered, so this is the
+                # writer failing, which flush raises again for the producers
+                traceback.print_exception(error)
+                self._error = error
+            finally:
+                # otherwise flush and producers waiting on a full queue would
+                # wait forever
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _commit_batch(self, batch: list[Write]):
+        start = time.time()
+
+        try:
+            self._commit(batch)
+        except Exception as error:
+            # find the culprit by committing the operations one by one
+            print(f"Failed to commit batch of {len(batch)} writes: {error!r}")
+            for write in batch:
+                try:
+                    self._commit([write])
+                except Exception as error:
+                    self._dead_letter(write, error)
+
+        WRITE_BATCH_SIZE.observe(len(batch))
+        COMMIT_TIME.observe(time.time() - start)
+
+    def _commit(self, batch: list[Write]):
+        start = time.monotonic()
+        attempt = 0
+
+        while True:
+            try:
+                commit(self._conn, [(op, args) for op, args, _ in batch])
+                return
+            except sqlite3.OperationalError as error:
+                if not is_busy(error):
+                    raise
+
+                attempt += 1
+                backoff = self.retry.backoff(attempt, time.monotonic() - start)
+                if backoff is None:
+                    raise
+
+                WRITE_RETRIES.inc()
+                time.sleep(backoff)
+
+    def _dead_letter(self, write: Write, error: Exception):
+        op, args, dead_letter = write
+        kind, item = dead_letter or ("write", 0)
+
+        print(f"Failed to write {op.__name__}{args!r:.80}:")
+        traceback.print_exception(error)
+
+        DEAD_LETTERS.labels(kind=kind).inc()
+        try:
+            self._commit(
+                [
+                    (
+                        insert_dead_letter,
+                        (kind, item, None, f"{op.__name__}: {error!r}"),
+                        None,
+                    )
+                ]
+            )
+        except Exception as dead_letter_error:
+            # with nowhere to record failures, the writer itself has failed
+            traceback.print_exception(dead_letter_error)
+            self._error = dead_letter_error
+
+
+def is_busy(error: sqlite3.OperationalError) -> bool:
+    """
+    Whether `error` is from another connection holding a lock, rather than from
+    anything wrong with what was written.
+    """
+    return error.sqlite_errorcode & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+
+def commit(conn: Connection, batch: list[Tuple[WriteOp, tuple]]):
+    cur = conn.cursor()
+
+    cur.execute("BEGIN TRANSACTION;")
+    try:
+        for op, args in batch:
+            op(cur, *args)
+        # a commit can find the database busy too, and has to be rolled back
+        # before it's tried again
+        cur.execute("COMMIT;")
+    except BaseException:
+        # some errors roll the transaction back themselves
+        if conn.in_transaction:
+            cur.execute("ROLLBACK;")
+        conn.tag_ids.clear()
+        raise
+
+
+class WorkIndex:
+    """
+    An in-memory fingerprint of every stored work's update date, word count and
+    chapter count, so search results can be checked against the database without
+    querying it.
+    """
+
+    def __init__(self):
+        self._fingerprints: dict[int, int] = {}
+
+    @classmethod
+    def load(cls, conn: sqlite3.Connection) -> "WorkIndex":
+        index = cls()
+
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, date(coalesce(updated, published), 'unixepoch'), words, chapters_published
+            FROM works WHERE id NOT IN (SELECT work_id FROM partial_works);
+            """
+        )
+        for work_id, updated, words, chapters_published in cur:
+            index._fingerprints[work_id] = hash((updated, words, chapters_published))
+
+        return index
+
+    def __len__(self) -> int:
+        return len(self._fingerprints)
+
+    def add(self, work: Work):
+        self._fingerprints[work["id"]] = hash(
+            (
+                work["updated"] or work["published"],
+                work["words"],
+                work["chapters_published"],
+            )
+        )
+
+    def is_unchanged(self, result: SearchResult) -> bool:
+        fingerprint = hash(
+            (result["updated"], result["words"], result["chapters_published"])
+        )
+        return self._fingerprints.get(result["id"]) == fingerprint
+
+
+def train_dictionaries(
+    conn: sqlite3.Connection, dict_size: int, samples: int, min_works: int
+) -> dict[str, int]:
+    """
+    Train a zstd dictionary for every language with at least `min_works` works
+    and no dictionary yet, from up to `samples` randomly chosen chapters, saved
+    under the language so that chapter_contents' dict_chooser picks it. Returns the
+    number of chapters each dictionary was trained on.
+    """
+    cur = conn.cursor()
+
+    trained = set()
+    if has_table(conn, "_zstd_dicts"):
+        cur.execute("SELECT chooser_key FROM _zstd_dicts;")
+        trained = {key for (key,) in cur}
+
+    cur.execute(
+        "SELECT language FROM works GROUP BY language HAVING count(*) >= ?;",
+        (min_works,),
+    )
+    languages = [language for (language,) in cur if language not in trained]
+
+    sampled = {}
+    for language in languages:
+        # pick ids first so that only the sampled chapters get decompressed
+        cur.execute(
+            """
+            SELECT work_chapters.id FROM work_chapters
+            JOIN works ON works.id = work_chapters.work_id
+            WHERE language = ? ORDER BY random() LIMIT ?;
+            """,
+            (language, samples),
+        )
+        chapter_ids = [chapter_id for (chapter_id,) in cur]
+
+        cur.execute(
+            """
+            SELECT zstd_train_dict_and_save(content, ?, ?, ?) FROM chapters
+            WHERE id IN (SELECT value FROM json_each(?));
+            """,
+            (dict_size, len(chapter_ids), language, json.dumps(chapter_ids)),
+        )
+        sampled[language] = len(chapter_ids)
+
+    return sampled
+
+
+def run_incremental_maintenance(conn: sqlite3.Connection, duration, load) -> bool:
+    """
+    Compress rows for up to `duration` seconds, spending `load` of the time working
+    and the rest sleeping. Returns whether there's anything left to compress.
+    """
+    cur = conn.cursor()
+
+    cur.execute("SELECT zstd_incremental_maintenance(?, ?);", (duration, load))
+    (more,) = cur.fetchone()
+    return bool(more)
+
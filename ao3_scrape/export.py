@@ -0,0 +1,212 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+from pathlib import Path
+import sqlite3
+import threading
+from typing import Iterator
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from ao3_scrape.database import open_db
+
+# every table is split into directories by the month each work was published
+# in and its language, like `works/month=2023-08/language=English/`
+PARTITIONING = ds.partitioning(
+    pa.schema([("month", pa.string()), ("language", pa.string())]), flavor="hive"
+)
+
+WORKS_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("title", pa.string()),
+        ("author", pa.string()),
+        ("author_pseud", pa.string()),
+        ("summary", pa.string()),
+        ("notes", pa.string()),
+        ("published", pa.timestamp("s", tz="UTC")),
+        ("updated", pa.timestamp("s", tz="UTC")),
+        ("words", pa.int64()),
+        ("chapters_published", pa.int64()),
+        ("chapters_total", pa.int64()),
+        ("hits", pa.int64()),
+        ("kudos", pa.int64()),
+        ("comments", pa.int64()),
+        ("bookmarks", pa.int64()),
+        ("month", pa.string()),
+        ("language", pa.string()),
+    ]
+)
+TAGGINGS_SCHEMA = pa.schema(
+    [
+        ("work_id", pa.int64()),
+        ("tag", pa.string()),
+        ("type", pa.string()),
+        ("month", pa.string()),
+        ("language", pa.string()),
+    ]
+)
+CHAPTERS_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("work_id", pa.int64()),
+        ("title", pa.string()),
+        ("content", pa.string()),
+        ("month", pa.string()),
+        ("language", pa.string()),
+    ]
+)
+
+# the partition columns of a work, joined onto the tables which belong to it
+PARTITION_COLUMNS = "strftime('%Y-%m', works.published, 'unixepoch'), works.language"
+# works still being downloaded a chapter at a time are left out
+COMPLETE = "works.id NOT IN (SELECT work_id FROM partial_works)"
+
+
+def export(
+    db: str,
+    out: Path,
+    chapters: bool = False,
+    batch_size: int = 10_000,
+    chapter_batch_size: int = 200,
+    threads: int = 4,
+):
+    """
+    Write the works, their taggings and optionally their chapters to partitioned
+    Parquet datasets under `out`, a batch of works at a time.
+
+    Chapters are read `chapter_batch_size` works at a time, split between
+    `threads` connections so that they're decompressed in parallel.
+    """
+    # batches are pulled from pyarrow's threads, though only one at a time
+    conn = open_db(db, check_same_thread=False)
+
+    write_table(
+        out / "works",
+        WORKS_SCHEMA,
+        (
+            query_batch(
+                conn,
+                WORKS_SCHEMA,
+                f"""
+                SELECT
+                    id, title, author, author_pseud, summary, notes,
+                    published, updated, words, chapters_published, chapters_total,
+                    hits, kudos, comments, bookmarks, {PARTITION_COLUMNS}
+                FROM works WHERE id IN (SELECT value FROM json_each(?));
+                """,
+                work_ids,
+            )
+            for work_ids in work_id_batches(conn, batch_size)
+        ),
+    )
+
+    write_table(
+        out / "taggings",
+        TAGGINGS_SCHEMA,
+        (
+            query_batch(
+                conn,
+                TAGGINGS_SCHEMA,
+                f"""
+                SELECT work_id, tags.name, tags.type, {PARTITION_COLUMNS}
+                FROM taggings
+                JOIN tags ON tags.id = taggings.tag_id
+                JOIN works ON works.id = taggings.work_id
+                WHERE work_id IN (SELECT value FROM json_each(?));
+                """,
+                work_ids,
+            )
+            for work_ids in work_id_batches(conn, batch_size)
+        ),
+    )
+
+    if chapters:
+        with ThreadPoolExecutor(
+            threads, initializer=open_reader, initargs=(db,)
+        ) as pool:
+            write_table(
+                out / "chapters",
+                CHAPTERS_SCHEMA,
+                (
+                    batch
+                    for work_ids in work_id_batches(conn, chapter_batch_size)
+                    for batch in pool.map(read_chapters, split(work_ids, threads))
+                ),
+            )
+
+    conn.close()
+
+
+def write_table(path: Path, schema: pa.Schema, batches: Iterator[pa.RecordBatch]):
+    ds.write_dataset(
+        (batch for batch in batches if batch.num_rows),
+        path,
+        schema=schema,
+        format="parquet",
+        partitioning=PARTITIONING,
+        # replace what an earlier export wrote to the same partitions
+        existing_data_behavior="delete_matching",
+    )
+
+
+def work_id_batches(conn: sqlite3.Connection, batch_size: int) -> Iterator[list[int]]:
+    """
+    The ids of complete works in order, `batch_size` at a time, paged by id so
+    that no query has to skip over the batches before it.
+    """
+    cur = conn.cursor()
+
+    last_id = -1
+    while True:
+        cur.execute(
+            f"""
+            SELECT id FROM works WHERE id > ? AND {COMPLETE}
+            ORDER BY id LIMIT ?;
+            """,
+            (last_id, batch_size),
+        )
+        work_ids = [work_id for (work_id,) in cur]
+        if not work_ids:
+            return
+
+        yield work_ids
+        last_id = work_ids[-1]
+
+
+def query_batch(
+    conn: sqlite3.Connection, schema: pa.Schema, sql: str, work_ids: list[int]
+) -> pa.RecordBatch:
+    rows = conn.execute(sql, (json.dumps(work_ids),)).fetchall()
+    columns = zip(*rows) if rows else [[] for _ in schema]
+    return pa.RecordBatch.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+_reader = threading.local()
+
+
+def open_reader(db: str):
+    _reader.conn = open_db(db)
+
+
+def read_chapters(work_ids: list[int]) -> pa.RecordBatch:
+    # sqlite lets go of the GIL while reading, so each thread decompresses its
+    # share of the chapters in parallel
+    return query_batch(
+        _reader.conn,
+        CHAPTERS_SCHEMA,
+        f"""
+        SELECT chapters.id, work_id, chapters.title, content, {PARTITION_COLUMNS}
+        FROM chapters JOIN works ON works.id = chapters.work_id
+        WHERE work_id IN (SELECT value FROM json_each(?));
+        """,
+        work_ids,
+    )
+
+
+def split(items: list, parts: int) -> list[list]:
+    size = -(-len(items) // parts)
+    return [items[i : i + size] for i in range(0, len(items), size)]
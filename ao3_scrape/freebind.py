@@ -0,0 +1,94 @@
+import asyncio
+from ipaddress import ip_address
+from itertools import chain, zip_longest
+import socket
+from typing import Any, Dict, List, Optional, Tuple, Type
+import aiohttp
+
+IP_FREEBIND = 15
+
+
+class FreebindTCPConnector(aiohttp.TCPConnector):
+    async def _resolve_host(
+        self, host: str, port: int, traces: Optional[List["aiohttp.Trace"]] = None
+    ) -> List[Dict[str, Any]]:
+        hosts = await super()._resolve_host(host, port, traces=traces)
+
+        # aiohttp leaves the family of IP literals up to the connector
+        hosts = [
+            {**hinfo, "family": hinfo["family"] or address_family(hinfo["host"])}
+            for hinfo in hosts
+        ]
+
+        # a socket bound to a local address can only reach its own family
+        if self._local_addr:
+            family = address_family(str(self._local_addr))
+            hosts = [hinfo for hinfo in hosts if hinfo["family"] == family]
+            if not hosts:
+                raise OSError(
+                    f"{host} has no address in the family of {self._local_addr}"
+                )
+
+        # alternate families as in RFC 8305, so that a broken
+        # family costs at most one connect timeout before we try the other
+        by_family: dict[int, list] = {}
+        for hinfo in hosts:
+            by_family.setdefault(hinfo["family"], []).append(hinfo)
+
+        return [
+            hinfo
+            for hinfo in chain.from_iterable(zip_longest(*by_family.values()))
+            if hinfo is not None
+        ]
+
+    async def _wrap_create_connection(
+        self,
+        factory,
+        host,
+        port,
+        req: "aiohttp.ClientRequest",
+        timeout: "aiohttp.ClientTimeout",
+        client_error: Type[Exception] = aiohttp.ClientConnectorError,
+        # added
+        ssl=None,
+        family: int = 0,
+        proto: int = 0,
+        flags: int = 0,
+        server_hostname: str | None = None,
+        local_addr=None,
+    ) -> Tuple[asyncio.Transport, Any]:
+        try:
+            sock = socket.socket(family=family, type=socket.SOCK_STREAM, proto=proto)
+            try:
+                sock.setblocking(False)
+
+                if local_addr:
+                    sock.setsockopt(socket.SOL_IP, IP_FREEBIND, 1)
+                    sock.bind((str(local_addr), 0))
+
+                async with aiohttp.helpers.ceil_timeout(timeout.sock_connect):
+                    await self._loop.sock_connect(sock, (host, port))
+
+                    return await self._loop.create_connection(
+                        factory,
+                        ssl=ssl,
+                        sock=sock,
+                        server_hostname=server_hostname,
+                    )  # type: ignore[return-value]  # noqa
+            except BaseException:
+                sock.close()
+                raise
+        except aiohttp.client_exceptions.cert_errors as exc:
+            raise aiohttp.ClientConnectorCertificateError(
+                req.connection_key, exc
+            ) from exc
+        except aiohttp.client_exceptions.ssl_errors as exc:
+            raise aiohttp.ClientConnectorSSLError(req.connection_key, exc) from exc
+        except OSError as exc:
+            if exc.errno is None and isinstance(exc, asyncio.TimeoutError):
+                raise
+            raise client_error(req.connection_key, exc) from exc
+
+
+def address_family(host: str) -> int:
+    return socket.AF_INET if ip_address(host).version == 4 else socket.AF_INET6
@@ -0,0 +1,257 @@
+from dataclasses import dataclass
+import sqlite3
+import time
+from typing import Iterator, Optional
+
+from ao3_scrape.database import DatabaseWriter, insert_work
+from ao3_scrape.scrape.search import LAST_PAGE
+from ao3_scrape.scrape.work import Work
+
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+# times a work is tried, across resumed runs of its crawl, before it's left to
+# the dead letters and no longer keeps the crawl from finishing
+WORK_ATTEMPTS = 3
+
+
+@dataclass
+class Frontier:
+    """
+    The persistent progress of one crawl over a search, kept in the `crawls`,
+    `crawl_pages` and `crawl_works` tables so that an interrupted crawl can be
+    resumed without downloading finished pages or works again.
+
+    Every state change is written through the database writer, and a work is
+    marked done in the same transaction which stores it.
+    """
+
+    db: DatabaseWriter
+    crawl_id: int
+
+    # left over from an interrupted run of the crawl
+    pending_pages: list[int]
+    pending_works: list[int]
+
+    next_page: int
+    exhausted: bool
+
+    @classmethod
+    async def open(
+        cls, db: DatabaseWriter, search: str, start_page: int = 1, resume: bool = True
+    ) -> "Frontier":
+        """
+        Resume the last unfinished crawl over `search`, or else start a new one.
+        """
+        return cls(db, *await db.query(open_crawl, search, start_page, resume))
+
+    def pages(self) -> Iterator[int]:
+        yield from self.pending_pages
+
+        while not self.exhausted and self.next_page <= LAST_PAGE:
+            self.next_page += 1
+            yield self.next_page - 1
+
+    async def lease_page(self, page: int):
+        await self.db.submit(
+            set_page_state, self.crawl_id, page, IN_FLIGHT, dead_letter=("page", page)
+        )
+
+    async def complete_page(self, page: int, found: int, work_ids: list[int]):
+        """
+        Mark a page with `found` results done and queue the works on it which are
+        to be downloaded. A page without results means the search has run out.
+        """
+        if found == 0:
+            self.exhausted = True
+
+        await self.db.submit(
+            complete_page,
+            self.crawl_id,
+            page,
+            found,
+            work_ids,
+            dead_letter=("page", page),
+        )
+
+    async def fail_page(self, page: int):
+        """
+        Mark a page which couldn't be downloaded, so that it's tried again when
+        the crawl is resumed.
+        """
+        await self.db.submit(
+            set_page_state, self.crawl_id, page, FAILED, dead_letter=("page", page)
+        )
+
+    async def lease_work(self, work_id: int):
+        await self.db.submit(
+            set_work_state,
+            self.crawl_id,
+            work_id,
+            IN_FLIGHT,
+            dead_letter=("work", work_id),
+        )
+
+    async def complete_work(self, work_id: int, work: Optional[Work]):
+        """
+        Store a work and mark it done, or just mark it done if it wasn't found.
+        """
+        await self.db.submit(
+            complete_work, self.crawl_id, work_id, work, dead_letter=("work", work_id)
+        )
+
+    async def fail_work(self, work_id: int, error: BaseException):
+        await self.db.submit(
+            fail_work,
+            self.crawl_id,
+            work_id,
+            repr(error),
+            dead_letter=("work", work_id),
+        )
+
+    async def finish(self):
+        await self.db.submit(finish_crawl, self.crawl_id)
+
+
+def open_crawl(
+    conn: sqlite3.Connection, search: str, start_page: int, resume: bool
+) -> tuple[int, list[int], list[int], int, bool]:
+    cur = conn.cursor()
+
+    crawl = None
+    if resume:
+        cur.execute(
+            """
+            SELECT id FROM crawls
+            WHERE search = ? AND finished IS NULL
+            ORDER BY started DESC LIMIT 1;
+            """,
+            (search,),
+        )
+        crawl = cur.fetchone()
+
+    if crawl is None:
+        cur.execute(
+            "INSERT INTO crawls (search, started) VALUES (?, ?);",
+            (search, int(time.time())),
+        )
+        return cur.lastrowid, [], [], start_page, False
+
+    (crawl_id,) = crawl
+    print(f"Resuming crawl {crawl_id} of {search}.")
+
+    # this process is the only one writing to the database, so anything left
+    # in flight was abandoned when the last run stopped
+    cur.execute(
+        "SELECT page FROM crawl_pages WHERE crawl_id = ? AND state IN (?, ?, ?) "
+        "ORDER BY page;",
+        (crawl_id, PENDING, IN_FLIGHT, FAILED),
+    )
+    pending_pages = [page for (page,) in cur]
+
+    cur.execute(
+        """
+        SELECT work_id FROM crawl_works
+        WHERE crawl_id = ? AND (state IN (?, ?) OR state = ? AND attempts < ?);
+        """,
+        (crawl_id, PENDING, IN_FLIGHT, FAILED, WORK_ATTEMPTS),
+    )
+    pending_works = [work_id for (work_id,) in cur]
+
+    cur.execute(
+        "SELECT max(page), count(CASE WHEN works = 0 THEN 1 END) "
+        "FROM crawl_pages WHERE crawl_id = ?;",
+        (crawl_id,),
+    )
+    last_page, empty_pages = cur.fetchone()
+
+    return (
+        crawl_id,
+        pending_pages,
+        pending_works,
+        start_page if last_page is None else last_page + 1,
+        empty_pages > 0,
+    )
+
+
+def set_page_state(cur: sqlite3.Cursor, crawl_id: int, page: int, state: str):
+    cur.execute(
+        """
+        INSERT INTO crawl_pages (crawl_id, page, state, attempts) VALUES (?, ?, ?, 1)
+        ON CONFLICT (crawl_id, page) DO UPDATE
+        SET state = excluded.state, attempts = attempts + 1;
+        """,
+        (crawl_id, page, state),
+    )
+
+
+def complete_page(
+    cur: sqlite3.Cursor, crawl_id: int, page: int, found: int, work_ids: list[int]
+):
+    cur.execute(
+        """
+        INSERT INTO crawl_pages (crawl_id, page, state, works) VALUES (?, ?, ?, ?)
+        ON CONFLICT (crawl_id, page) DO UPDATE
+        SET state = excluded.state, works = excluded.works;
+        """,
+        (crawl_id, page, DONE, found),
+    )
+    cur.executemany(
+        "INSERT OR IGNORE INTO crawl_works (crawl_id, work_id, state) VALUES (?, ?, ?);",
+        [(crawl_id, work_id, PENDING) for work_id in work_ids],
+    )
+
+
+def set_work_state(cur: sqlite3.Cursor, crawl_id: int, work_id: int, state: str):
+    cur.execute(
+        "UPDATE crawl_works SET state = ? WHERE crawl_id = ? AND work_id = ?;",
+        (state, crawl_id, work_id),
+    )
+
+
+def complete_work(
+    cur: sqlite3.Cursor, crawl_id: int, work_id: int, work: Optional[Work]
+):
+    if work is not None:
+        insert_work(cur, work)
+
+    cur.execute(
+        """
+        UPDATE crawl_works SET state = ?, attempts = attempts + 1
+        WHERE crawl_id = ? AND work_id = ?;
+        """,
+        (DONE, crawl_id, work_id),
+    )
+
+
+def fail_work(cur: sqlite3.Cursor, crawl_id: int, work_id: int, error: str):
+    cur.execute(
+        """
+        UPDATE crawl_works SET state = ?, attempts = attempts + 1, error = ?
+        WHERE crawl_id = ? AND work_id = ?;
+        """,
+        (FAILED, error, crawl_id, work_id),
+    )
+
+
+def finish_crawl(cur: sqlite3.Cursor, crawl_id: int):
+    # only failures are worth keeping once a crawl is over
+    cur.execute(
+        "DELETE FROM crawl_works WHERE crawl_id = ? AND state = ?;", (crawl_id, DONE)
+    )
+
+    # a crawl with failed pages, or with works yet to be downloaded or tried
+    # again, is left to be resumed
+    cur.execute(
+        """
+        UPDATE crawls SET finished = ? WHERE id = ? AND NOT EXISTS (
+            SELECT * FROM crawl_pages WHERE crawl_id = ? AND state = ?
+        ) AND NOT EXISTS (
+            SELECT * FROM crawl_works WHERE crawl_id = ?
+            AND (state != ? OR attempts < ?)
+        );
+        """,
+        (int(time.time()), crawl_id, crawl_id, FAILED, crawl_id, FAILED, WORK_ATTEMPTS),
+    )
@@ -0,0 +1,216 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import hashlib
+import itertools
+import os
+from pathlib import Path
+import sqlite3
+import time
+from typing import Iterator, Optional
+
+from ao3_scrape.metrics import ARCHIVED_BYTES, ARCHIVED_DOCUMENTS
+
+# the kinds of response archived, by how they were requested
+WORK = "work"
+WORK_PAGE = "work_page"
+CHAPTER = "chapter"
+
+
+@dataclass
+class WorkDocuments:
+    """
+    The archived documents a work can be parsed from: either a full work page,
+    or its first page and whichever of its chapters were downloaded one at a
+    time.
+    """
+
+    work_id: int
+    kind: str
+    page: bytes
+    # (chapter id, hash) in order of chapter id
+    chapters: list[tuple[int, bytes]] = field(default_factory=list)
+
+
+class HtmlArchive:
+    """
+    Raw work pages and chapters as they were downloaded, so that works can be
+    parsed again without downloading them again.
+
+    Every distinct document is compressed on its own as a zstd frame and
+    appended to the current segment file in `directory`, starting a new one
+    once it's over `segment_size` bytes. Documents are addressed by the sha256
+    of their HTML, so one downloaded again unchanged is only stored once. An
+    index database alongside the segments records where each document is and
+    every response which returned it.
+    """
+
+    def __init__(self, directory: Path, segment_size: int = 1024**3, level: int = 10):
+        # zstandard is an optional dependency
+        import zstandard
+
+        self.directory = directory
+        self.segment_size = segment_size
+
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+        directory.mkdir(parents=True, exist_ok=True)
+        # written from the archive's own thread
+        self._conn = sqlite3.connect(directory / "index.db", check_same_thread=False)
+        self._conn.isolation_level = None
+        self._conn.executescript(
+            """
+            PRAGMA journal_mode = wal;
+            PRAGMA synchronous = normal;
+
+            CREATE TABLE IF NOT EXISTS documents (
+                hash BLOB PRIMARY KEY,
+                segment INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS responses (
+                work_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                chapter_id INTEGER,
+                fetched REAL NOT NULL,
+                hash BLOB NOT NULL REFERENCES documents (hash)
+            );
+
+            CREATE INDEX IF NOT EXISTS responses_by_work_id
+            ON responses (work_id, fetched);
+            """
+        )
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="html-archive"
+        )
+        self._segment: Optional[int] = None
+        self._segment_file = None
+        self._read_fds: dict[int, int] = {}
+
+    async def store(
+        self, work_id: int, kind: str, html: str, chapter_id: Optional[int] = None
+    ):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self._executor, self.put, work_id, kind, html, chapter_id
+        )
+
+    def put(self, work_id: int, kind: str, html: str, chapter_id: Optional[int] = None):
+        data = html.encode()
+        digest = hashlib.sha256(data).digest()
+
+        cur = self._conn.cursor()
+        cur.execute("BEGIN TRANSACTION;")
+        try:
+            cur.execute("SELECT 1 FROM documents WHERE hash = ?;", (digest,))
+            if cur.fetchone() is None:
+                self._append(cur, digest, data)
+                ARCHIVED_DOCUMENTS.labels(outcome="stored").inc()
+            else:
+                ARCHIVED_DOCUMENTS.labels(outcome="duplicate").inc()
+
+            cur.execute(
+                "INSERT INTO responses VALUES (?, ?, ?, ?, ?);",
+                (work_id, kind, chapter_id, time.time(), digest),
+            )
+        except BaseException:
+            cur.execute("ROLLBACK;")
+            raise
+        cur.execute("COMMIT;")
+
+    def get(self, digest: bytes) -> str:
+        row = self._conn.execute(
+            "SELECT segment, offset, length FROM documents WHERE hash = ?;", (digest,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(digest.hex())
+
+        segment, offset, length = row
+        fd = self._read_fds.get(segment)
+        if fd is None:
+            fd = self._read_fds[segment] = os.open(
+                self._segment_path(segment), os.O_RDONLY
+            )
+
+        return self._decompressor.decompress(os.pread(fd, length, offset)).decode()
+
+    def work_documents(self) -> Iterator[WorkDocuments]:
+        """
+        For every archived work in order of id, the documents of its most
+        recent download.
+        """
+        cur = self._conn.execute(
+            """
+            SELECT work_id, kind, chapter_id, hash FROM responses
+            ORDER BY work_id, fetched;
+            """
+        )
+        for work_id, responses in itertools.groupby(cur, key=lambda row: row[0]):
+            page = None
+            chapters = {}
+            for _, kind, chapter_id, digest in responses:
+                if kind == CHAPTER:
+                    chapters[chapter_id] = digest
+                else:
+                    page = (kind, digest)
+
+            # chapters only ever come from downloads which also fetched a first
+            # page, but one which failed might not have got that far
+            if page is None:
+                continue
+
+            kind, digest = page
+            yield WorkDocuments(
+                work_id,
+                kind,
+                digest,
+                sorted(chapters.items()) if kind == WORK_PAGE else [],
+            )
+
+    def close(self):
+        # waits for any documents still being stored
+        self._executor.shutdown()
+
+        if self._segment_file is not None:
+            self._segment_file.close()
+        for fd in self._read_fds.values():
+            os.close(fd)
+        self._conn.close()
+
+    def _append(self, cur: sqlite3.Cursor, digest: bytes, data: bytes):
+        if self._segment_file is None or self._segment_file.tell() >= self.segment_size:
+            self._next_segment()
+
+        frame = self._compressor.compress(data)
+        offset = self._segment_file.tell()
+        self._segment_file.write(frame)
+        # the index mustn't point at bytes still buffered in this process
+        self._segment_file.flush()
+
+        cur.execute(
+            "INSERT INTO documents VALUES (?, ?, ?, ?, ?);",
+            (digest, self._segment, offset, len(frame), len(data)),
+        )
+        ARCHIVED_BYTES.inc(len(frame))
+
+    def _next_segment(self):
+        if self._segment_file is not None:
+            self._segment_file.close()
+            self._segment += 1
+        else:
+            # carry on with the last segment left by an earlier run, which may
+            # end in a frame that was never indexed but is otherwise harmless
+            segments = sorted(self.directory.glob("segment-*.zst"))
+            self._segment = int(segments[-1].stem.split("-")[1]) if segments else 1
+
+        self._segment_file = open(self._segment_path(self._segment), "ab")
+        if self._segment_file.tell() >= self.segment_size:
+            self._next_segment()
+
+    def _segment_path(self, segment: int) -> Path:
+        return self.directory / f"segment-{segment:06d}.zst"
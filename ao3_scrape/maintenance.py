@@ -0,0 +1,125 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import time
+from typing import Callable, Optional, TypeVar
+
+from ao3_scrape.database import DatabaseWriter, open_db, run_incremental_maintenance
+from ao3_scrape.metrics import (
+    MAINTENANCE_RECLAIMED,
+    MAINTENANCE_TIME,
+    MAINTENANCE_YIELDS,
+)
+
+T = TypeVar("T")
+
+
+class MaintenanceWorker:
+    """
+    Compresses chapters, checkpoints the WAL and gives free pages back to the
+    filesystem every `interval` seconds, on its own thread and connection so
+    that the event loop and the database writer carry on meanwhile.
+
+    Work is done in steps of about `step` seconds, and a round is cut short
+    whenever the writer's queue is more than `max_queue_fill` full or requests
+    take longer than `max_latency` seconds on average, so that maintenance
+    only uses the database while scraping leaves it idle.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        writer: DatabaseWriter,
+        latency: Callable[[], Optional[float]] = lambda: None,
+        interval: float = 300,
+        duration: float = 60,
+        load: float = 0.5,
+        step: float = 5,
+        vacuum_pages: int = 1024,
+        max_queue_fill: float = 0.5,
+        max_latency: float = 5,
+    ):
+        self.path = path
+        self.writer = writer
+        self.latency = latency
+        self.interval = interval
+        self.duration = duration
+        self.load = load
+        self.step = step
+        self.vacuum_pages = vacuum_pages
+        self.max_queue_fill = max_queue_fill
+        self.max_latency = max_latency
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="database-maintenance"
+        )
+        self._conn: Optional[sqlite3.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._conn = await self._run(open_db, self.path)
+        self._task = asyncio.create_task(self._maintain())
+
+    async def close(self):
+        self._task.cancel()
+        # let a step in progress finish before closing its connection
+        await self._run(self._conn.close)
+        self._executor.shutdown()
+
+    def busy(self) -> bool:
+        queue = self.writer.queue
+        if queue.maxsize and queue.qsize() > self.max_queue_fill * queue.maxsize:
+            return True
+
+        latency = self.latency()
+        return latency is not None and latency > self.max_latency
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._round()
+
+    async def _round(self):
+        deadline = time.monotonic() + self.duration
+        for task, step in [
+            ("checkpoint", self._checkpoint),
+            # pages freed by the last round's compression
+            ("vacuum", self._vacuum),
+            ("compress", self._compress),
+        ]:
+            more = True
+            while more and time.monotonic() < deadline:
+                # the rest of the round waits for the next one
+                if self.busy():
+                    MAINTENANCE_YIELDS.inc()
+                    return
+
+                start = time.monotonic()
+                more = await self._run(step)
+                MAINTENANCE_TIME.labels(task=task).inc(time.monotonic() - start)
+
+    def _compress(self) -> bool:
+        return run_incremental_maintenance(self._conn, self.step, self.load)
+
+    def _checkpoint(self) -> bool:
+        # copies what it can into the database without waiting on readers or
+        # the writer
+        self._conn.execute("PRAGMA wal_checkpoint(PASSIVE);")
+        return False
+
+    def _vacuum(self) -> bool:
+        (page_size,) = self._conn.execute("PRAGMA page_size;").fetchone()
+        (before,) = self._conn.execute("PRAGMA freelist_count;").fetchone()
+
+        # frees a page per step, so all of its (empty) results have to be fetched
+        self._conn.execute(
+            f"PRAGMA incremental_vacuum({self.vacuum_pages});"
+        ).fetchall()
+
+        (after,) = self._conn.execute("PRAGMA freelist_count;").fetchone()
+        MAINTENANCE_RECLAIMED.inc((before - after) * page_size)
+        return after > 0 and after < before
+
+    async def _run(self, func: Callable[..., T], *args) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
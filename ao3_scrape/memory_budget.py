@@ -0,0 +1,55 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from ao3_scrape.metrics import MEMORY_BUDGET_USED
+from ao3_scrape.scrape.work import WorkParser
+
+# rough peak memory taken by downloading and parsing a work, per word of it,
+# as measured on a work of 700k words
+BYTES_PER_WORD = {
+    WorkParser.HTML_PARSER: 600,
+    WorkParser.LXML: 200,
+    WorkParser.LXML_STREAM: 32,
+}
+# assumed for works whose length isn't known
+DEFAULT_WORK_SIZE = 1024 * 1024
+
+
+class MemoryBudget:
+    """
+    Limits how many bytes the works being downloaded at once are estimated to
+    take, so that a few huge works wait for each other instead of all being
+    held at once. A work estimated at more than the whole budget waits until
+    nothing else is using it.
+    """
+
+    def __init__(self, limit: int, parser: WorkParser = WorkParser.HTML_PARSER):
+        self.limit = limit
+        self.bytes_per_word = BYTES_PER_WORD[parser]
+        self.used = 0
+
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(self, words: Optional[int]):
+        """
+        Hold an estimate of the memory a work of `words` words takes.
+        """
+        size = min(
+            self.limit,
+            DEFAULT_WORK_SIZE if words is None else words * self.bytes_per_word,
+        )
+
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+            MEMORY_BUDGET_USED.set(self.used)
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.used -= size
+                MEMORY_BUDGET_USED.set(self.used)
+                self._condition.notify_all()
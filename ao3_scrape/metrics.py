@@ -4,16 +4,49 @@ from telnetlib import GA
 from prometheus_client import Counter, Gauge, Histogram
 
 PAGE_CONCURRENCY = Gauge("page_concurrency", "Number of pages downloaded concurrently.")
+WORK_CONCURRENCY = Gauge(
+    "work_concurrency", "Number of works downloaded concurrently per page."
+)
+MAX_IN_FLIGHT = Gauge("max_in_flight", "Maximum number of requests in flight.")
+IN_FLIGHT = Gauge("in_flight", "Number of requests currently in flight.")
 
 DOWNLOADED = Counter("downloaded", "Number of documents downloaded.", ["doc_type"])
 DOWNLOADED.labels(doc_type="page")
 DOWNLOADED.labels(doc_type="work")
+DOWNLOADED.labels(doc_type="navigate")
+DOWNLOADED.labels(doc_type="chapter")
+
+MEMORY_BUDGET_USED = Gauge(
+    "memory_budget_used", "Estimated bytes taken by the works being downloaded."
+)
+
+RETRIES = Counter("retries", "Number of failed requests which were retried.")
+DEAD_LETTERS = Counter(
+    "dead_letters", "Number of pages, works and writes given up on.", ["kind"]
+)
+DEAD_LETTERS.labels(kind="page")
+DEAD_LETTERS.labels(kind="work")
+DEAD_LETTERS.labels(kind="write")
+
+SKIPPED_WORKS = Counter(
+    "skipped_works", "Number of works not downloaded because they were unchanged."
+)
+UNCHANGED_CHAPTERS = Counter(
+    "unchanged_chapters",
+    "Number of chapters downloaded again whose stored content was left alone.",
+)
+DEDUPLICATED_CHAPTERS = Counter(
+    "deduplicated_chapters",
+    "Number of chapters written whose content was already stored for a chapter.",
+)
 
 DOWNLOADED_BYTES = Counter(
     "downloaded_bytes", "Number of bytes downloaded.", ["doc_type"]
 )
 DOWNLOADED_BYTES.labels(doc_type="page")
 DOWNLOADED_BYTES.labels(doc_type="work")
+DOWNLOADED_BYTES.labels(doc_type="navigate")
+DOWNLOADED_BYTES.labels(doc_type="chapter")
 
 DOWNLOAD_TIME = Histogram(
     "download_time",
@@ -23,11 +56,125 @@ DOWNLOAD_TIME = Histogram(
 )
 DOWNLOAD_TIME.labels(doc_type="page")
 DOWNLOAD_TIME.labels(doc_type="work")
+DOWNLOAD_TIME.labels(doc_type="navigate")
+DOWNLOAD_TIME.labels(doc_type="chapter")
+
+SESSION_POOL_HITS = Counter(
+    "session_pool_hits", "Number of requests served by an already pooled session."
+)
+SESSION_POOL_MISSES = Counter(
+    "session_pool_misses", "Number of requests which had to open a new session."
+)
+SESSION_POOL_EVICTIONS = Counter(
+    "session_pool_evictions", "Number of sessions removed from the pool.", ["reason"]
+)
+SESSION_POOL_EVICTIONS.labels(reason="idle")
+SESSION_POOL_EVICTIONS.labels(reason="rotated")
+SESSION_POOL_EVICTIONS.labels(reason="closed")
+SESSION_POOL_EVICTIONS.labels(reason="capacity")
+SESSION_POOL_SIZE = Gauge("session_pool_size", "Number of pooled sessions.")
+
+RATELIMITED = Counter("ratelimited", "Number of requests answered with a 429.")
+REQUEST_RATE = Gauge(
+    "request_rate", "Requests per second allowed across all source addresses."
+)
+THROTTLED_ADDRESSES = Gauge(
+    "throttled_addresses", "Number of source addresses cooling down after a 429."
+)
+
+ADDRESS_REQUESTS = Counter(
+    "address_requests",
+    "Number of requests sent from each source address.",
+    ["address", "outcome"],
+)
+ADDRESS_LATENCY = Gauge(
+    "address_latency",
+    "Moving average of the time to response headers from each source address.",
+    ["address"],
+)
+ADDRESS_ERROR_RATE = Gauge(
+    "address_error_rate",
+    "Moving average of the share of failed requests from each source address.",
+    ["address"],
+)
+ADDRESS_REQUEST_RATE = Gauge(
+    "address_request_rate",
+    "Requests per second allowed from each source address.",
+    ["address"],
+)
+QUARANTINED_ADDRESSES = Gauge(
+    "quarantined_addresses", "Number of source addresses quarantined for failing."
+)
+ADDRESS_REPLACEMENTS = Counter(
+    "address_replacements", "Number of failing source addresses swapped for new ones."
+)
+
+LEASES = Gauge("leases", "Number of coordinator leases in each state.", ["state"])
+LEASES.labels(state="pending")
+LEASES.labels(state="leased")
+LEASES.labels(state="done")
 
 PAGE = Gauge("page", "Start of current chunk of pages being downloaded.")
 
+SHARDS = Gauge("shards", "Number of shards the current date range was split into.")
+SHARDS_DONE = Gauge("shards_done", "Number of shards of the current date range done.")
+
 WORK_UPDATED_TIME = Gauge("work_updated", "Update time of last work downloaded.")
 
+WRITER_QUEUE_DEPTH = Gauge(
+    "writer_queue_depth", "Number of writes waiting for the database writer."
+)
+WRITE_BATCH_SIZE = Histogram(
+    "write_batch_size",
+    "Number of writes committed per transaction.",
+    buckets=[1, 2, 4, 8, 16, 32, 64, 128, 256],
+)
+WRITE_RETRIES = Counter(
+    "write_retries", "Number of write batches retried because the database was busy."
+)
+COMMIT_TIME = Histogram(
+    "commit_time",
+    "Time taken to write and commit a batch of writes.",
+    buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10],
+)
+
+MAINTENANCE_TIME = Counter(
+    "maintenance_time", "Seconds spent on database maintenance.", ["task"]
+)
+MAINTENANCE_TIME.labels(task="compress")
+MAINTENANCE_TIME.labels(task="checkpoint")
+MAINTENANCE_TIME.labels(task="vacuum")
+MAINTENANCE_RECLAIMED = Counter(
+    "maintenance_reclaimed", "Bytes of free pages given back by the database."
+)
+MAINTENANCE_YIELDS = Counter(
+    "maintenance_yields", "Number of times maintenance stopped early for load."
+)
+
+SEARCH_CACHE_REQUESTS = Counter(
+    "search_cache_requests",
+    "Number of search pages looked up in the search cache, by outcome.",
+    ["outcome"],
+)
+SEARCH_CACHE_REQUESTS.labels(outcome="hit")
+SEARCH_CACHE_REQUESTS.labels(outcome="revalidated")
+SEARCH_CACHE_REQUESTS.labels(outcome="miss")
+SEARCH_CACHE_EVICTIONS = Counter(
+    "search_cache_evictions", "Number of search pages dropped from the search cache."
+)
+SEARCH_CACHE_SIZE = Gauge("search_cache_size", "Bytes of search pages cached.")
+
+ARCHIVED_DOCUMENTS = Counter(
+    "archived_documents",
+    "Number of responses archived, by whether their document was already stored.",
+    ["outcome"],
+)
+ARCHIVED_DOCUMENTS.labels(outcome="stored")
+ARCHIVED_DOCUMENTS.labels(outcome="duplicate")
+ARCHIVED_BYTES = Counter(
+    "archived_bytes", "Number of compressed bytes written to the HTML archive."
+)
+
 DATABASE_SIZE = Gauge("database_size", "Size of database in bytes.")
 
 
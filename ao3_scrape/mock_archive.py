@@ -0,0 +1,120 @@
+import asyncio
+import hashlib
+from pathlib import Path
+import random
+import re
+from typing import Optional
+from aiohttp import web
+
+# what a search page past the last one looks like
+EMPTY_PAGE = (
+    '<html><body><div id="main"><h3 class="heading">0 Found</h3>'
+    '<ol class="work index group"></ol></div></body></html>'
+)
+
+WORK_ID = re.compile(r"(?<=work_)\d+|(?<=/works/)\d+")
+CHAPTER_CONTENT = '<div class="userstuff module" role="article">'
+FILLER = "<p>" + "All work and no play makes Jack a dull boy. " * 20 + "</p>\n"
+
+
+class MockArchive:
+    """
+    Serves recorded search and work pages like the archive would, for
+    benchmarking the scraper without going near the real site.
+
+    Recordings are `page_*.html` search pages and `work_*.html` work pages in
+    one directory, as saved by `bench record` or on parse errors. Search pages
+    are served in turn up to page `pages`, with their work ids rewritten so that
+    every page lists different works, and each work is served from a recording
+    picked by its id.
+
+    Every response is held back `latency` seconds, `ratelimit` of them are 429s
+    with a Retry-After of `retry_after` seconds, and each chapter is padded with
+    about `padding` bytes of text. Search pages have ETags, and are answered
+    with a 304 when asked for again with a matching one.
+    """
+
+    def __init__(
+        self,
+        recordings: Path,
+        pages: int = 50,
+        latency: float = 0,
+        ratelimit: float = 0,
+        retry_after: float = 1,
+        padding: int = 0,
+    ):
+        self.pages = pages
+        self.latency = latency
+        self.ratelimit = ratelimit
+        self.retry_after = retry_after
+
+        self.search_pages = [
+            path.read_text() for path in sorted(recordings.glob("page_*.html"))
+        ]
+        filler = FILLER * (padding // len(FILLER))
+        self.work_pages = [
+            path.read_text().replace(CHAPTER_CONTENT, CHAPTER_CONTENT + filler)
+            for path in sorted(recordings.glob("work_*.html"))
+            # chapter indexes and single chapters aren't served
+            if re.fullmatch(r"work_\d+", path.stem)
+        ]
+        if not self.search_pages or not self.work_pages:
+            raise ValueError(f"No recorded search and work pages in {recordings}.")
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/works/search", self.search)
+        app.router.add_get("/works/{id:\\d+}", self.work)
+        return app
+
+    async def search(self, request: web.Request) -> web.Response:
+        response = await self._delay()
+        if response is not None:
+            return response
+
+        page = int(request.query.get("page", 1))
+        if page > self.pages:
+            return html_response(EMPTY_PAGE)
+
+        html = self.search_pages[(page - 1) % len(self.search_pages)]
+
+        # number the works on page n from n * 1000
+        work_ids = {}
+        for match in WORK_ID.finditer(html):
+            work_ids.setdefault(match.group(), str(page * 1000 + len(work_ids)))
+
+        html = WORK_ID.sub(lambda match: work_ids[match.group()], html)
+        etag = f'"{hashlib.sha1(html.encode()).hexdigest()}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+
+        response = html_response(html)
+        response.headers["ETag"] = etag
+        return response
+
+    async def work(self, request: web.Request) -> web.Response:
+        response = await self._delay()
+        if response is not None:
+            return response
+
+        work_id = request.match_info["id"]
+        html = self.work_pages[int(work_id) % len(self.work_pages)]
+        return html_response(WORK_ID.sub(work_id, html))
+
+    async def _delay(self) -> Optional[web.Response]:
+        await asyncio.sleep(self.latency)
+
+        if random.random() < self.ratelimit:
+            return web.Response(
+                status=429, headers={"Retry-After": f"{self.retry_after:g}"}
+            )
+
+        return None
+
+
+def html_response(html: str) -> web.Response:
+    return web.Response(text=html, content_type="text/html")
+
+
+def serve(archive: MockArchive, port: int):
+    web.run_app(archive.app(), host="127.0.0.1", port=port, print=None)
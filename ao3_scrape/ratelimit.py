@@ -0,0 +1,104 @@
+from dataclasses import dataclass, field
+import time
+from typing import Optional
+
+from ao3_scrape.metrics import RATELIMITED, REQUEST_RATE, THROTTLED_ADDRESSES
+from ao3_scrape.session_pool import LocalAddress
+
+
+@dataclass
+class AddressBucket:
+    """
+    A token bucket for one source address, refilled at `rate` requests a second.
+    """
+
+    rate: float
+    tokens: float = 1
+    refilled: float = field(default_factory=time.monotonic)
+    # no requests are sent from the address before this time
+    cooldown_until: float = 0
+
+    def refill(self, now: float):
+        # allow a burst of up to a second's worth of requests, and at least one
+        self.tokens = min(
+            max(self.rate, 1), self.tokens + (now - self.refilled) * self.rate
+        )
+        self.refilled = now
+
+    def wait(self, now: float) -> float:
+        """
+        Seconds until a request may be sent from the address.
+        """
+        self.refill(now)
+        return max(self.cooldown_until - now, (1 - self.tokens) / self.rate, 0)
+
+
+class RateLimiter:
+    """
+    A token bucket for each source address, whose rate is adapted AIMD-style: it
+    goes up by `increase` after every successful request and is multiplied by
+    `decrease` after a 429, when the address also rests for the response's
+    Retry-After (or `cooldown`).
+    """
+
+    def __init__(
+        self,
+        initial_rate: float = 1,
+        min_rate: float = 0.05,
+        max_rate: float = 10,
+        increase: float = 0.05,
+        decrease: float = 0.5,
+        cooldown: float = 600,
+    ):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+
+        self._buckets: dict[LocalAddress, AddressBucket] = {}
+
+    def wait(self, address: LocalAddress, now: float) -> float:
+        return self._bucket(address).wait(now)
+
+    def take(self, address: LocalAddress):
+        self._bucket(address).tokens -= 1
+
+    def rate(self, address: LocalAddress) -> float:
+        return self._bucket(address).rate
+
+    def succeeded(self, address: LocalAddress):
+        bucket = self._bucket(address)
+        bucket.rate = min(self.max_rate, bucket.rate + self.increase)
+        self._update_metrics()
+
+    def throttled(self, address: LocalAddress, retry_after: Optional[float] = None):
+        print(f"Ratelimited on {address or 'default address'}, cooling down.")
+        RATELIMITED.inc()
+
+        bucket = self._bucket(address)
+        bucket.rate = max(self.min_rate, bucket.rate * self.decrease)
+        bucket.tokens = 0
+        bucket.cooldown_until = time.monotonic() + (
+            self.cooldown if retry_after is None else retry_after
+        )
+        self._update_metrics()
+
+    def remove(self, address: LocalAddress):
+        self._buckets.pop(address, None)
+        self._update_metrics()
+
+    def _bucket(self, address: LocalAddress) -> AddressBucket:
+        if address not in self._buckets:
+            self._buckets[address] = AddressBucket(self.initial_rate)
+            self._update_metrics()
+
+        return self._buckets[address]
+
+    def _update_metrics(self):
+        now = time.monotonic()
+        REQUEST_RATE.set(sum(bucket.rate for bucket in self._buckets.values()))
+        THROTTLED_ADDRESSES.set(
+            sum(bucket.cooldown_until > now for bucket in self._buckets.values())
+        )
@@ -0,0 +1,102 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import itertools
+import os
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from ao3_scrape import database
+from ao3_scrape.html_archive import WORK, HtmlArchive, WorkDocuments
+from ao3_scrape.scrape import ParseError
+from ao3_scrape.scrape.work import (
+    Work,
+    WorkParser,
+    parse_chapter_html,
+    parse_work_html,
+)
+
+# each parse process's own reader of the archive
+_archive: Optional[HtmlArchive] = None
+
+
+def reparse(
+    directory: Path,
+    db: str,
+    processes: Optional[int] = None,
+    parser: WorkParser = WorkParser.HTML_PARSER,
+    batch_size: int = 64,
+) -> tuple[int, int]:
+    """
+    Parse every work in the archive in `directory` again from its most recent
+    download, across `processes` processes, and store it in `db` over whatever
+    was stored before, `batch_size` works to a transaction.
+
+    Returns the number of works stored and the number which failed to parse.
+    """
+    archive = HtmlArchive(directory)
+    conn = database.open_db(db)
+    if not database.has_table(conn, "works"):
+        database.init_db(conn)
+
+    processes = processes or os.cpu_count()
+    stored = failed = 0
+    with ProcessPoolExecutor(
+        processes, initializer=open_archive, initargs=(directory,)
+    ) as pool:
+        # only a few batches are handed out at once, so that parsed works don't
+        # pile up while they're written
+        for documents in chunks(archive.work_documents(), batch_size * processes):
+            works = []
+            for work in pool.map(
+                partial(parse_documents, parser=parser), documents, chunksize=16
+            ):
+                if work is None:
+                    failed += 1
+                else:
+                    works.append(work)
+
+            for batch in chunks(works, batch_size):
+                database.commit(
+                    conn, [(database.insert_work, (work,)) for work in batch]
+                )
+            stored += len(works)
+            print(f"Stored {stored} works.")
+
+    archive.close()
+    conn.close()
+    return stored, failed
+
+
+def open_archive(directory: Path):
+    global _archive
+    _archive = HtmlArchive(directory)
+
+
+def parse_documents(documents: WorkDocuments, parser: WorkParser) -> Optional[Work]:
+    try:
+        if documents.kind == WORK:
+            return parse_work_html(
+                _archive.get(documents.page), documents.work_id, parser
+            )
+
+        # a first page is small enough not to be worth streaming
+        if parser == WorkParser.LXML_STREAM:
+            parser = WorkParser.LXML
+        work = parse_work_html(_archive.get(documents.page), documents.work_id, parser)
+
+        chapters = {int(chapter["id"]): chapter for chapter in work["content"]}
+        for chapter_id, digest in documents.chapters:
+            chapters[chapter_id] = parse_chapter_html(
+                _archive.get(digest), documents.work_id, chapter_id
+            )
+    except ParseError as error:
+        print(f"{error} Saved as {error.doc_shortname}.html.")
+        return None
+
+    return {**work, "content": list(chapters.values())}
+
+
+def chunks(items: Iterable, size: int) -> Iterator[list]:
+    items = iter(items)
+    while chunk := list(itertools.islice(items, size)):
+        yield chunk
@@ -1,18 +1,42 @@
 import asyncio
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
 import random
 import time
-from typing import Awaitable, Callable
+from typing import Awaitable, Callable, Optional
+import aiohttp
 from aiohttp import ClientResponse
 import ssl
 import certifi
 
-from bs4 import BeautifulSoup
-
 from ao3_scrape.metrics import DOWNLOAD_TIME, DOWNLOADED, DOWNLOADED_BYTES
 
 
 class RatelimitError(Exception):
-    pass
+    # seconds to wait before retrying, if the response said
+    retry_after: Optional[float]
+
+    def __init__(self, retry_after: Optional[float] = None):
+        super().__init__(f"Ratelimited, retry after {retry_after} seconds.")
+
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        return (type(self), (self.retry_after,))
+
+
+class HTTPError(Exception):
+    status: int
+    reason: Optional[str]
+
+    def __init__(self, status: int, reason: Optional[str]):
+        super().__init__(f"HTTP {status} {reason}")
+
+        self.status = status
+        self.reason = reason
+
+    def __reduce__(self):
+        return (type(self), (self.status, self.reason))
 
 
 class ParseError(Exception):
@@ -25,50 +49,131 @@ class ParseError(Exception):
         self.doc_name = doc_name
         self.doc_shortname = doc_shortname
 
-    def save_html(self, soup: BeautifulSoup):
+    def __reduce__(self):
+        # lets the error cross process boundaries when parsing in a pool
+        return (type(self), (self.doc_name, self.doc_shortname))
+
+    def save_html(self, html: str):
         with open(f"{self.doc_shortname}.html", "w") as f:
-            f.write(soup.prettify())
+            f.write(html)
 
 
 BASE_URL = "https://archiveofourown.org"
 
-RATELIMIT_TIMEOUT = 600
-RATELIMIT_JITTER = 60
-
 ssl_context = ssl.create_default_context(cafile=certifi.where())
 
 
+@dataclass
+class RetryPolicy:
+    """
+    How requests which failed in a way that might not happen again are retried:
+    up to `attempts` times in all, waiting a random time of up to `base_delay`
+    seconds doubled for every failed attempt, but at most `max_delay`, and
+    giving up once `deadline` seconds have passed since the first attempt.
+
+    Anything else, like a parse error or a 4xx response, fails straight away.
+    """
+
+    attempts: int = 5
+    base_delay: float = 1
+    max_delay: float = 60
+    deadline: Optional[float] = 600
+
+    def retryable(self, error: BaseException) -> bool:
+        if isinstance(error, HTTPError):
+            return error.status >= 500 or error.status == 408
+
+        return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+    def backoff(self, attempt: int, elapsed: float) -> Optional[float]:
+        """
+        Seconds to wait after `attempt` failed attempts taking `elapsed` seconds,
+        or None to give up.
+        """
+        if attempt >= self.attempts:
+            return None
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        if self.deadline is not None and elapsed + delay >= self.deadline:
+            return None
+
+        return delay
+
+
 def downloader(
     doc_type: str = None,
-) -> Callable[[Callable[..., Awaitable[ClientResponse]]], Awaitable[BeautifulSoup]]:
+) -> Callable[[Callable[..., Awaitable[ClientResponse]]], Awaitable[Optional[str]]]:
+    """
+    Wrap a function making a request so that it returns the response body as text,
+    or None if the function itself returned None. Raises `RatelimitError` on a 429,
+    leaving it to the caller to back off.
+    """
+
     def decorator(func: Callable[..., Awaitable[ClientResponse]]):
         async def wrapper(*args, **kwargs):
-            try:
-                start = time.time()
-                res = await func(*args, **kwargs)
+            start = time.time()
+            res = await func(*args, **kwargs)
 
-                if res.status == 429:
-                    raise RatelimitError()
+            if res is None:
+                return None
 
-                if res.status != 200:
-                    raise Exception(f"HTTP {res.status_code} {res.reason}")
+            check_response(res)
 
-                text = await res.text()
-                elapsed = time.time() - start
+            text = await res.text()
+            record_download(doc_type, len(text), time.time() - start)
 
-                DOWNLOADED.labels(doc_type=doc_type).inc()
-                DOWNLOADED_BYTES.labels(doc_type=doc_type).inc(len(text))
-                DOWNLOAD_TIME.labels(doc_type=doc_type).observe(elapsed)
+            return text
 
-                return BeautifulSoup(text, "html.parser")
+        return wrapper
 
-            except RatelimitError:
-                backoff = RATELIMIT_TIMEOUT + RATELIMIT_JITTER * random.random()
-                print(f"Ratelimited, sleeping for {backoff} seconds...")
-                await asyncio.sleep(backoff)
+    return decorator
 
-                return await wrapper(*args, **kwargs)
 
-        return wrapper
+def check_response(res: ClientResponse):
+    """
+    Raise if the response isn't a 200, first releasing its connection, whose body
+    will never be read, back to the pool.
+    """
+    if res.status == 429:
+        retry_after = parse_retry_after(res)
+        res.release()
+        raise RatelimitError(retry_after)
 
-    return decorator
+    if res.status != 200:
+        res.release()
+        raise HTTPError(res.status, res.reason)
+
+
+def is_not_found(res: ClientResponse) -> bool:
+    """
+    Whether the response is a 404, releasing its connection back to the pool if
+    so, since its body will never be read.
+    """
+    if res.status != 404:
+        return False
+
+    res.release()
+    return True
+
+
+def record_download(doc_type: str, size: int, elapsed: float):
+    DOWNLOADED.labels(doc_type=doc_type).inc()
+    DOWNLOADED_BYTES.labels(doc_type=doc_type).inc(size)
+    DOWNLOAD_TIME.labels(doc_type=doc_type).observe(elapsed)
+
+
+def parse_retry_after(res: ClientResponse) -> Optional[float]:
+    """
+    The Retry-After header in seconds, whether given as seconds or as a date.
+    """
+    value = res.headers.get("Retry-After")
+    if value is None:
+        return None
+
+    if value.strip().isdigit():
+        return float(value)
+
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -1,8 +1,33 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from enum import Enum
+import json
+import re
+import time
+from typing import Callable, Optional, TypedDict, TypeVar, Union
 import aiohttp
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
 
-from . import BASE_URL, ssl_context, ParseError, RatelimitError, downloader
+from ao3_scrape.search_cache import SearchCache
+from . import (
+    ssl_context,
+    ParseError,
+    check_response,
+    downloader,
+    record_download,
+)
+
+T = TypeVar("T")
+
+RESULT_COUNT = re.compile(r"of ([\d,]+)|([\d,]+) (?:Works )?[Ff]ound")
+
+# search results past this page can't be reached
+LAST_PAGE = 5000
+RESULTS_PER_PAGE = 20
+RESULT_CAP = LAST_PAGE * RESULTS_PER_PAGE
+
+# nothing was posted to the archive before its open beta
+ARCHIVE_START = datetime(2008, 9, 1, tzinfo=timezone.utc)
 
 
 class TimeUnit(Enum):
@@ -11,55 +36,270 @@ class TimeUnit(Enum):
     MONTH = "month"
     YEAR = "year"
 
+    def timedelta(self, count: int = 1) -> timedelta:
+        """
+        Roughly how long `count` of this unit is, taking months as 30 days.
+        """
+        days = {"day": 1, "week": 7, "month": 30, "year": 365}[self.value]
+        return timedelta(days=days * count)
+
+
+class SearchResult(TypedDict):
+    id: int
+
+    updated: str
+    words: int
+    chapters_published: int
+    chapters_total: Optional[int]
+
+    hits: int
+    kudos: int
+    comments: int
+    bookmarks: int
+
+
+@dataclass(frozen=True)
+class RelativeSearch:
+    """
+    Works updated `time_ago` units ago. Which works these are changes as time
+    passes, so prefer a `DateRangeSearch` for anything long running.
+    """
+
+    time_ago: int
+    time_unit: TimeUnit
+
+    def __str__(self) -> str:
+        return f"{self.time_ago} {self.time_unit.value}"
+
+    def describe(self) -> str:
+        return f"works updated {self.time_ago} {self.time_unit.value}s ago"
+
+    def shortname(self) -> str:
+        return f"{self.time_ago}_{self.time_unit.value}"
+
+    def params(self) -> dict[str, str]:
+        return {
+            "work_search[revised_at]": f"{self.time_ago}+{self.time_unit.value}",
+            "work_search[query]": "",
+        }
+
+
+@dataclass(frozen=True)
+class DateRangeSearch:
+    """
+    Works last updated from `start` up to but not including `end`, both in UTC.
+    """
+
+    start: datetime
+    end: datetime
+
+    def __str__(self) -> str:
+        return f"{format_date(self.start)}/{format_date(self.end)}"
+
+    def describe(self) -> str:
+        return f"works updated from {self.start} until {self.end}"
+
+    def shortname(self) -> str:
+        return f"{self.start:%Y%m%dT%H%M%S}_{self.end:%Y%m%dT%H%M%S}"
+
+    def params(self) -> dict[str, str]:
+        # the revised_at field only takes relative times, but the query is passed
+        # to Elasticsearch, which takes a half-open range of absolute ones
+        return {
+            "work_search[revised_at]": "",
+            "work_search[query]": (
+                f'revised_at:["{format_date(self.start)}" '
+                f'TO "{format_date(self.end)}"}}'
+            ),
+        }
+
+    def split(self) -> tuple["DateRangeSearch", "DateRangeSearch"]:
+        middle = self.start + (self.end - self.start) / 2
+        middle = middle.replace(microsecond=0)
+        return DateRangeSearch(self.start, middle), DateRangeSearch(middle, self.end)
+
+
+Search = Union[RelativeSearch, DateRangeSearch]
+
+
+def format_date(date: datetime) -> str:
+    return date.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
 
 async def get_page(
-    client: aiohttp.ClientSession, time_ago: int, time_unit: TimeUnit, page: int
-) -> list[int]:
-    soup = await download_page(client, time_ago, time_unit, page)
+    client: aiohttp.ClientSession,
+    search: Search,
+    page: int,
+    cache: Optional[SearchCache] = None,
+) -> list[SearchResult]:
+    return await get_parsed(client, search, page, parse_page, cache)
+
+
+async def get_result_count(
+    client: aiohttp.ClientSession, search: Search, cache: Optional[SearchCache] = None
+) -> int:
+    """
+    The number of works a search finds, read from the heading of its first page.
+    """
+    return await get_parsed(client, search, 1, parse_result_count, cache)
+
+
+async def get_parsed(
+    client: aiohttp.ClientSession,
+    search: Search,
+    page: int,
+    parse: Callable[[BeautifulSoup], T],
+    cache: Optional[SearchCache] = None,
+) -> T:
+    """
+    Download a search page and parse it with `parse`. With a cache, a cached
+    copy of the page is asked for again with its validators and used without
+    parsing anything if the server says it's unchanged, and whatever else is
+    downloaded is cached.
+    """
+    if cache is None:
+        html = await download_page(client, search, page)
+        return parse_html(html, search, page, parse)
+
+    key = cache_key(search, page, parse)
+    cached = cache.get(key)
+
+    start = time.time()
+    res = await request_page(
+        client, search, page, cached.validators() if cached is not None else {}
+    )
+
     try:
-        return parse_page(soup)
+        if res.status == 304 and cached is not None:
+            cache.revalidated(key)
+            return cached.value
+
+        check_response(res)
+        html = await res.text()
+    finally:
+        # does nothing once the body is read, but gives the connection back to
+        # the pool on every path which doesn't read it
+        res.release()
+    record_download("page", len(html), time.time() - start)
+
+    value = parse_html(html, search, page, parse)
+    cache.put(key, value, res.headers.get("ETag"), res.headers.get("Last-Modified"))
+    return value
+
+
+def cache_key(search: Search, page: int, parse: Callable[[BeautifulSoup], T]) -> str:
+    # the same page parsed in different ways is cached once for each
+    return f"{parse.__name__} {json.dumps(page_params(search, page), sort_keys=True)}"
+
+
+def parse_html(
+    html: str, search: Search, page: int, parse: Callable[[BeautifulSoup], T]
+) -> T:
+    try:
+        return parse(BeautifulSoup(html, "html.parser"))
     except Exception as underlying:
         error = ParseError(
-            f"page {page} of search of works updated {time_ago} {time_unit.value}s ago",
-            f"page_{time_ago}_{time_unit.value}_{page}",
+            f"page {page} of search of {search.describe()}",
+            f"page_{search.shortname()}_{page}",
         )
-        error.save_html(soup)
+        error.save_html(html)
         raise error from underlying
 
 
 @downloader(doc_type="page")
 async def download_page(
-    client: aiohttp.ClientSession, time_ago: int, time_unit: TimeUnit, page: int
-) -> BeautifulSoup:
+    client: aiohttp.ClientSession, search: Search, page: int
+) -> str:
+    return await request_page(client, search, page)
+
+
+async def request_page(
+    client: aiohttp.ClientSession,
+    search: Search,
+    page: int,
+    headers: Optional[dict[str, str]] = None,
+) -> aiohttp.ClientResponse:
     return await client.get(
-        f"{BASE_URL}/works/search",
-        params={
-            "work_search[revised_at]": f"{str(time_ago)}+{time_unit.value}",
-            "page": page,
-            "work_search[query]": "",
-            "work_search[title]": "",
-            "work_search[creators]": "",
-            "work_search[complete]": "",
-            "work_search[crossover]": "",
-            "work_search[single_chapter]": 0,
-            "work_search[word_count]": "",
-            "work_search[language_id]": "",
-            "work_search[fandom_names]": "",
-            "work_search[rating_ids]": "",
-            "work_search[character_names]": "",
-            "work_search[relationship_names]": "",
-            "work_search[freeform_names]": "",
-            "work_search[hits]": "",
-            "work_search[kudos_count]": "",
-            "work_search[comments_count]": "",
-            "work_search[bookmarks_count]": "",
-            "work_search[sort_column]": "revised_at",
-            "work_search[sort_direction]": "desc",
-            "commit": "Search",
-        },
+        "/works/search",
+        params=page_params(search, page),
+        headers=headers,
         ssl=ssl_context,
     )
 
 
-def parse_page(soup: BeautifulSoup) -> list[int]:
-    return [int(li["id"][5:]) for li in soup.select("li.work.blurb.group")]
+def page_params(search: Search, page: int) -> dict[str, Union[str, int]]:
+    return {
+        "work_search[revised_at]": "",
+        "page": page,
+        "work_search[query]": "",
+        "work_search[title]": "",
+        "work_search[creators]": "",
+        "work_search[complete]": "",
+        "work_search[crossover]": "",
+        "work_search[single_chapter]": 0,
+        "work_search[word_count]": "",
+        "work_search[language_id]": "",
+        "work_search[fandom_names]": "",
+        "work_search[rating_ids]": "",
+        "work_search[character_names]": "",
+        "work_search[relationship_names]": "",
+        "work_search[freeform_names]": "",
+        "work_search[hits]": "",
+        "work_search[kudos_count]": "",
+        "work_search[comments_count]": "",
+        "work_search[bookmarks_count]": "",
+        "work_search[sort_column]": "revised_at",
+        "work_search[sort_direction]": "desc",
+        "commit": "Search",
+        **search.params(),
+    }
+
+
+def parse_page(soup: BeautifulSoup) -> list[SearchResult]:
+    return [parse_blurb(li) for li in soup.select("li.work.blurb.group")]
+
+
+def parse_result_count(soup: BeautifulSoup) -> int:
+    # a search without results still says "0 Found", so a page without the
+    # heading is an error page or one whose markup has changed
+    heading = soup.select_one("#main h3.heading")
+    if heading is None:
+        raise ValueError("no result count heading")
+
+    # "1 - 20 of 1,234 Works found" or, with a single page, "12 Found"
+    match = RESULT_COUNT.search(heading.text)
+    if match is None:
+        raise ValueError(f"no result count in {heading.text!r}")
+
+    return int((match.group(1) or match.group(2)).replace(",", ""))
+
+
+def parse_blurb(li: Tag) -> SearchResult:
+    chapters = li.find("dd", class_="chapters").text.split("/")
+
+    return {
+        "id": int(li["id"][5:]),
+        "updated": parse_blurb_date(li),
+        "words": parse_blurb_count(li, "words"),
+        "chapters_published": int(chapters[0].replace(",", "")),
+        "chapters_total": (
+            None if chapters[1] == "?" else int(chapters[1].replace(",", ""))
+        ),
+        "hits": parse_blurb_count(li, "hits"),
+        "kudos": parse_blurb_count(li, "kudos"),
+        "comments": parse_blurb_count(li, "comments"),
+        "bookmarks": parse_blurb_count(li, "bookmarks"),
+    }
+
+
+def parse_blurb_date(li: Tag) -> str:
+    text = li.find("p", class_="datetime").text.strip()
+    return datetime.strptime(text, "%d %b %Y").date().isoformat()
+
+
+def parse_blurb_count(li: Tag, name: str) -> int:
+    tag = li.find("dd", class_=name)
+    if tag is None or not tag.text.strip():
+        return 0
+
+    return int(tag.text.replace(",", ""))
@@ -1,11 +1,24 @@
+import asyncio
+from concurrent.futures import Executor
+from enum import Enum
 import re
+import time
 from typing import Optional, TypedDict
 
 import aiohttp
 from bs4 import BeautifulSoup, PageElement
 from urllib.parse import unquote
 
-from . import BASE_URL, ssl_context, ParseError, downloader
+from ao3_scrape import html_archive
+from ao3_scrape.html_archive import HtmlArchive
+from . import (
+    ssl_context,
+    ParseError,
+    check_response,
+    downloader,
+    is_not_found,
+    record_download,
+)
 
 
 class Work(TypedDict):
@@ -48,35 +61,250 @@ class Chapter(TypedDict):
     content: str
 
 
-async def get_work(client: aiohttp.ClientSession, work_id: int) -> Optional[Work]:
-    soup = await download_work(client, work_id)
-    if soup is None:
+class ChapterLink(TypedDict):
+    id: int
+    # when the chapter was posted, as an ISO date
+    posted: str
+
+
+class WorkParser(Enum):
+    HTML_PARSER = "html.parser"
+    LXML = "lxml"
+    # lxml, parsing the page as it's downloaded
+    LXML_STREAM = "lxml-stream"
+
+
+# bytes of a work page fed to the streaming parser at once
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+async def get_work(
+    client: aiohttp.ClientSession,
+    work_id: int,
+    parse_pool: Optional[Executor] = None,
+    parser: WorkParser = WorkParser.HTML_PARSER,
+    archive: Optional[HtmlArchive] = None,
+) -> Optional[Work]:
+    """
+    Download and parse a work, parsing in `parse_pool` if given or else in place.
+    The streaming parser always parses in place, as the page comes in, and so
+    its pages are never archived.
+    """
+    if parser == WorkParser.LXML_STREAM:
+        return await stream_work(client, work_id)
+
+    html = await download_work(client, work_id)
+    if html is None:
         return None
 
+    if archive is not None:
+        await archive.store(work_id, html_archive.WORK, html)
+
+    if parse_pool is None:
+        return parse_work_html(html, work_id, parser)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        parse_pool, parse_work_html, html, work_id, parser
+    )
+
+
+def parse_work_html(
+    html: str, work_id: int, parser: WorkParser = WorkParser.HTML_PARSER
+) -> Work:
+    if parser in (WorkParser.LXML, WorkParser.LXML_STREAM):
+        # lxml is an optional dependency
+        from .work_lxml import WorkStreamParser, parse_work_lxml
+
     try:
-        return parse_work(soup, work_id)
+        if parser == WorkParser.LXML:
+            return parse_work_lxml(html, work_id)
+
+        if parser == WorkParser.LXML_STREAM:
+            stream_parser = WorkStreamParser(work_id)
+            data = html.encode()
+            for start in range(0, len(data), STREAM_CHUNK_SIZE):
+                stream_parser.feed(data[start : start + STREAM_CHUNK_SIZE])
+            return stream_parser.close()
+
+        return parse_work(BeautifulSoup(html, "html.parser"), work_id)
     except Exception as underlying:
         error = ParseError(f"work {work_id}", f"work_{work_id}")
-        error.save_html(soup)
+        error.save_html(html)
+        raise error from underlying
+
+
+async def get_work_page(
+    client: aiohttp.ClientSession,
+    work_id: int,
+    parser: WorkParser = WorkParser.HTML_PARSER,
+    archive: Optional[HtmlArchive] = None,
+) -> Optional[Work]:
+    """
+    Download and parse the first page of a work, which has all of its metadata
+    but only the content of its first chapter.
+    """
+    html = await download_work(client, work_id, full=False)
+    if html is None:
+        return None
+
+    if archive is not None:
+        await archive.store(work_id, html_archive.WORK_PAGE, html)
+
+    if parser == WorkParser.LXML_STREAM:
+        # the first page is small enough to parse whole
+        parser = WorkParser.LXML
+
+    return parse_work_html(html, work_id, parser)
+
+
+async def get_chapter_links(
+    client: aiohttp.ClientSession, work_id: int
+) -> Optional[list[ChapterLink]]:
+    """
+    The chapters of a work, in order, from its chapter index.
+    """
+    html = await download_chapter_index(client, work_id)
+    if html is None:
+        return None
+
+    try:
+        return parse_chapter_index(BeautifulSoup(html, "html.parser"))
+    except Exception as underlying:
+        error = ParseError(
+            f"chapter index of work {work_id}", f"work_{work_id}_navigate"
+        )
+        error.save_html(html)
+        raise error from underlying
+
+
+async def get_chapter(
+    client: aiohttp.ClientSession,
+    work_id: int,
+    chapter_id: int,
+    archive: Optional[HtmlArchive] = None,
+) -> Optional[Chapter]:
+    html = await download_chapter(client, work_id, chapter_id)
+    if html is None:
+        return None
+
+    if archive is not None:
+        await archive.store(work_id, html_archive.CHAPTER, html, chapter_id)
+
+    return parse_chapter_html(html, work_id, chapter_id)
+
+
+def parse_chapter_html(html: str, work_id: int, chapter_id: int) -> Chapter:
+    try:
+        return parse_work_content(BeautifulSoup(html, "html.parser"))[0]
+    except Exception as underlying:
+        error = ParseError(
+            f"chapter {chapter_id} of work {work_id}",
+            f"work_{work_id}_chapter_{chapter_id}",
+        )
+        error.save_html(html)
         raise error from underlying
 
 
 @downloader(doc_type="work")
 async def download_work(
+    client: aiohttp.ClientSession, work_id: int, full: bool = True
+) -> Optional[str]:
+    res = await request_work(client, work_id, full)
+
+    if is_not_found(res):
+        return None
+
+    return res
+
+
+async def stream_work(client: aiohttp.ClientSession, work_id: int) -> Optional[Work]:
+    """
+    Download and parse a work a chunk at a time, without ever holding its whole
+    page or its whole tree.
+    """
+    # lxml is an optional dependency
+    from .work_lxml import WorkStreamParser
+
+    start = time.time()
+    async with await request_work(client, work_id) as res:
+        if res.status == 404:
+            return None
+
+        check_response(res)
+
+        parser = WorkStreamParser(work_id, res.charset or "utf-8")
+        size = 0
+        try:
+            async for chunk in res.content.iter_chunked(STREAM_CHUNK_SIZE):
+                size += len(chunk)
+                parser.feed(chunk)
+
+            work = parser.close()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise
+        except Exception as underlying:
+            # the page was never held whole, so there's nothing to save
+            raise ParseError(f"work {work_id}", f"work_{work_id}") from underlying
+
+    record_download("work", size, time.time() - start)
+
+    return work
+
+
+async def request_work(
+    client: aiohttp.ClientSession, work_id: int, full: bool = True
+) -> aiohttp.ClientResponse:
+    return await client.get(
+        f"/works/{work_id}",
+        params={"view_adult": "true", "view_full_work": "true" if full else "false"},
+        ssl=ssl_context,
+    )
+
+
+@downloader(doc_type="navigate")
+async def download_chapter_index(
     client: aiohttp.ClientSession, work_id: int
-) -> Optional[BeautifulSoup]:
+) -> Optional[str]:
     res = await client.get(
-        f"{BASE_URL}/works/{work_id}",
-        params={"view_adult": "true", "view_full_work": "true"},
+        f"/works/{work_id}/navigate",
+        params={"view_adult": "true"},
         ssl=ssl_context,
     )
 
-    if res.status == 404:
+    if is_not_found(res):
         return None
 
     return res
 
 
+@downloader(doc_type="chapter")
+async def download_chapter(
+    client: aiohttp.ClientSession, work_id: int, chapter_id: int
+) -> Optional[str]:
+    res = await client.get(
+        f"/works/{work_id}/chapters/{chapter_id}",
+        params={"view_adult": "true"},
+        ssl=ssl_context,
+    )
+
+    if is_not_found(res):
+        return None
+
+    return res
+
+
+def parse_chapter_index(soup: BeautifulSoup) -> list[ChapterLink]:
+    return [
+        {
+            "id": int(li.a["href"].split("/")[4]),
+            # "(2023-01-02)"
+            "posted": li.find("span", class_="datetime").text.strip("() "),
+        }
+        for li in soup.select("ol.chapter.index li")
+    ]
+
+
 def parse_work(soup: BeautifulSoup, work_id: int) -> Work:
     title = parse_work_title(soup)
 
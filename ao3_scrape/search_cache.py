@@ -0,0 +1,159 @@
+from dataclasses import dataclass
+import json
+from pathlib import Path
+import sqlite3
+import time
+from typing import Any, Optional
+
+from ao3_scrape.metrics import (
+    SEARCH_CACHE_EVICTIONS,
+    SEARCH_CACHE_REQUESTS,
+    SEARCH_CACHE_SIZE,
+)
+
+
+@dataclass
+class CachedResponse:
+    value: Any
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched: float
+
+    def validators(self) -> dict[str, str]:
+        """
+        Headers asking the server to answer with a 304 if the response hasn't
+        changed since it was cached.
+        """
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class SearchCache:
+    """
+    Parsed search pages kept on disk, so that pages fetched before, by an
+    earlier run or an overlapping window, are neither downloaded nor parsed
+    again.
+
+    Pages cached less than `ttl` seconds ago are used as they are. Older ones
+    are asked for again with the validators they were served with, and used
+    as they are if the server says they're unchanged. Once the cached pages
+    take up more than `max_size` bytes, those used longest ago are dropped.
+
+    The cache is small enough to be queried in place on the event loop.
+    """
+
+    def __init__(self, path: Path, ttl: float = 3600, max_size: int = 256 * 1024**2):
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._conn = sqlite3.connect(path)
+        self._conn.isolation_level = None
+        self._conn.executescript(
+            """
+            PRAGMA journal_mode = wal;
+            PRAGMA synchronous = normal;
+
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched REAL NOT NULL,
+                used REAL NOT NULL
+            );
+
+            CREATE INDEX IF NOT EXISTS responses_by_used ON responses (used);
+            """
+        )
+
+        (self._size,) = self._conn.execute(
+            "SELECT coalesce(sum(length(value)), 0) FROM responses;"
+        ).fetchone()
+        SEARCH_CACHE_SIZE.set(self._size)
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        row = self._conn.execute(
+            "SELECT value, etag, last_modified, fetched FROM responses WHERE key = ?;",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+
+        self._conn.execute(
+            "UPDATE responses SET used = ? WHERE key = ?;", (time.time(), key)
+        )
+        value, etag, last_modified, fetched = row
+        return CachedResponse(json.loads(value), etag, last_modified, fetched)
+
+    def fresh(self, key: str) -> Optional[Any]:
+        """
+        The cached value of `key` if it was fetched less than `ttl` ago.
+        """
+        cached = self.get(key)
+        if cached is None or time.time() - cached.fetched >= self.ttl:
+            return None
+
+        SEARCH_CACHE_REQUESTS.labels(outcome="hit").inc()
+        return cached.value
+
+    def put(
+        self,
+        key: str,
+        value: Any,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ):
+        SEARCH_CACHE_REQUESTS.labels(outcome="miss").inc()
+
+        encoded = json.dumps(value)
+        now = time.time()
+
+        cur = self._conn.cursor()
+        cur.execute("BEGIN TRANSACTION;")
+        cur.execute("SELECT length(value) FROM responses WHERE key = ?;", (key,))
+        replaced = cur.fetchone()
+        cur.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?);",
+            (key, encoded, etag, last_modified, now, now),
+        )
+        cur.execute("COMMIT;")
+
+        self._size += len(encoded) - (replaced[0] if replaced else 0)
+        if self._size > self.max_size:
+            self._evict()
+        SEARCH_CACHE_SIZE.set(self._size)
+
+    def revalidated(self, key: str):
+        """
+        Note that the server said the cached value of `key` is still current.
+        """
+        SEARCH_CACHE_REQUESTS.labels(outcome="revalidated").inc()
+        self._conn.execute(
+            "UPDATE responses SET fetched = ? WHERE key = ?;", (time.time(), key)
+        )
+
+    def close(self):
+        self._conn.close()
+
+    def _evict(self):
+        cur = self._conn.cursor()
+        cur.execute("BEGIN TRANSACTION;")
+
+        # down to nine tenths of the limit, so that eviction isn't needed again
+        # on the very next page
+        evicted = []
+        for key, size in cur.execute(
+            "SELECT key, length(value) FROM responses ORDER BY used;"
+        ).fetchall():
+            if self._size <= 0.9 * self.max_size:
+                break
+            evicted.append((key,))
+            self._size -= size
+
+        cur.executemany("DELETE FROM responses WHERE key = ?;", evicted)
+        cur.execute("COMMIT;")
+        SEARCH_CACHE_EVICTIONS.inc(len(evicted))
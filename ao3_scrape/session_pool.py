@@ -0,0 +1,189 @@
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
+import random
+import time
+from typing import AsyncIterator, Optional
+import aiohttp
+
+from ao3_scrape.freebind import FreebindTCPConnector
+from ao3_scrape.metrics import (
+    SESSION_POOL_EVICTIONS,
+    SESSION_POOL_HITS,
+    SESSION_POOL_MISSES,
+    SESSION_POOL_SIZE,
+)
+from ao3_scrape.scrape import BASE_URL
+
+LocalAddress = Optional[IPv4Address | IPv6Address]
+
+
+@dataclass
+class PooledSession:
+    local_addr: LocalAddress
+    client: aiohttp.ClientSession
+
+    created: float = field(default_factory=time.monotonic)
+    last_used: float = field(default_factory=time.monotonic)
+    requests: int = 0
+    active: int = 0
+    retired: bool = False
+
+
+class SessionPool:
+    """
+    Long-lived `aiohttp.ClientSession`s keyed by the local address they bind to,
+    so that consecutive pages and works reuse warm keep-alive TLS connections.
+
+    A new address (and session) is only drawn from `ip_network` while the pool
+    has fewer than `max_sessions` sessions; otherwise an existing one is reused.
+    A session for an address the caller picked makes room for itself by evicting
+    the least recently used one.
+    Sessions are rotated out after `max_session_requests` requests or
+    `max_session_age` seconds, and closed after `idle_timeout` seconds unused.
+    Each request times out after `request_timeout` seconds, and goes to a path
+    under `base_url`, which is the archive unless a mirror or mock is given.
+    """
+
+    def __init__(
+        self,
+        ip_network: Optional[IPv4Network | IPv6Network],
+        max_sessions: int = 16,
+        connections_per_session: int = 8,
+        idle_timeout: float = 60,
+        request_timeout: Optional[float] = 60,
+        max_session_requests: Optional[int] = None,
+        max_session_age: Optional[float] = None,
+        trace_configs: Optional[list[aiohttp.TraceConfig]] = None,
+        base_url: str = BASE_URL,
+    ):
+        self.ip_network = ip_network
+        self.max_sessions = max_sessions if ip_network else 1
+        self.connections_per_session = connections_per_session
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.max_session_requests = max_session_requests
+        self.max_session_age = max_session_age
+        self.trace_configs = list(trace_configs or [])
+        self.base_url = base_url
+
+        self._sessions: dict[LocalAddress, PooledSession] = {}
+
+    @asynccontextmanager
+    async def session(
+        self, local_addr: LocalAddress = None
+    ) -> AsyncIterator[PooledSession]:
+        """
+        Borrow a session, bound to `local_addr` if given or else chosen by the pool.
+        """
+        await self._evict_idle()
+
+        pooled = await self._checkout(local_addr)
+        pooled.active += 1
+        pooled.requests += 1
+        try:
+            yield pooled
+        finally:
+            pooled.active -= 1
+            pooled.last_used = time.monotonic()
+
+            if self._should_rotate(pooled):
+                await self._evict(pooled, reason="rotated")
+
+    async def close(self):
+        for pooled in list(self._sessions.values()):
+            await self._evict(pooled, reason="closed")
+
+    def random_address(self) -> LocalAddress:
+        if self.ip_network is None:
+            return None
+
+        return self.ip_network[random.randint(0, self.ip_network.num_addresses - 1)]
+
+    def sample_addresses(self, count: int) -> list[LocalAddress]:
+        """
+        Up to `count` distinct addresses to send requests from.
+        """
+        if self.ip_network is None:
+            return [None]
+
+        count = min(count, self.ip_network.num_addresses)
+        addresses = set()
+        while len(addresses) < count:
+            addresses.add(self.random_address())
+
+        return list(addresses)
+
+    async def _checkout(self, local_addr: LocalAddress) -> PooledSession:
+        if local_addr is None and len(self._sessions) >= self.max_sessions:
+            local_addr = random.choice(list(self._sessions))
+        elif local_addr is None:
+            local_addr = self.random_address()
+
+        pooled = self._sessions.get(local_addr)
+        if pooled is not None and not pooled.retired:
+            SESSION_POOL_HITS.inc()
+            return pooled
+
+        SESSION_POOL_MISSES.inc()
+
+        if pooled is None and len(self._sessions) >= self.max_sessions:
+            await self._evict(
+                min(self._sessions.values(), key=lambda pooled: pooled.last_used),
+                reason="capacity",
+            )
+
+        connector = FreebindTCPConnector(
+            local_addr=local_addr,
+            limit=self.connections_per_session,
+            keepalive_timeout=self.idle_timeout,
+        )
+        pooled = PooledSession(
+            local_addr=local_addr,
+            client=aiohttp.ClientSession(
+                self.base_url,
+                connector=connector,
+                # covers reading the body too, so it's a deadline for the request
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+                trace_configs=self.trace_configs,
+            ),
+        )
+        self._sessions[local_addr] = pooled
+        SESSION_POOL_SIZE.set(len(self._sessions))
+
+        return pooled
+
+    def _should_rotate(self, pooled: PooledSession) -> bool:
+        if pooled.retired:
+            return True
+
+        if (
+            self.max_session_requests is not None
+            and pooled.requests >= self.max_session_requests
+        ):
+            return True
+
+        if (
+            self.max_session_age is not None
+            and time.monotonic() - pooled.created >= self.max_session_age
+        ):
+            return True
+
+        return False
+
+    async def _evict_idle(self):
+        now = time.monotonic()
+        for pooled in list(self._sessions.values()):
+            if pooled.active == 0 and now - pooled.last_used >= self.idle_timeout:
+                await self._evict(pooled, reason="idle")
+
+    async def _evict(self, pooled: PooledSession, reason: str):
+        # stop handing the session out, but only close it once it's unused
+        pooled.retired = True
+        if self._sessions.get(pooled.local_addr) is pooled:
+            del self._sessions[pooled.local_addr]
+            SESSION_POOL_EVICTIONS.labels(reason=reason).inc()
+            SESSION_POOL_SIZE.set(len(self._sessions))
+
+        if pooled.active == 0 and not pooled.client.closed:
+            await pooled.client.close()
@@ -0,0 +1,278 @@
+from functools import partial
+import sqlite3
+
+import pytest
+
+from ao3_scrape import database
+
+
+def make_work(work_id: int, chapters: list[tuple[int, str, str]], language="English"):
+    return {
+        "id": work_id,
+        "title": f"Work {work_id}",
+        "author": "Writer",
+        "author_pseud": "Writer",
+        "summary": None,
+        "notes": None,
+        "published": "2023-01-01",
+        "updated": None,
+        "words": 100,
+        "chapters_published": len(chapters),
+        "chapters_total": len(chapters),
+        "language": language,
+        "hits": 1,
+        "kudos": 0,
+        "comments": 0,
+        "bookmarks": 0,
+        "rating_tags": [],
+        "warning_tags": [],
+        "category_tags": [],
+        "fandom_tags": ["Fandom"],
+        "relationship_tags": [],
+        "character_tags": [],
+        "freeform_tags": [],
+        "content": [
+            {"id": chapter_id, "title": title, "content": content}
+            for chapter_id, title, content in chapters
+        ],
+    }
+
+
+def new_db(path: str) -> sqlite3.Connection:
+    conn = database.open_db(path)
+    database.init_db(conn)
+    return conn
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = new_db(str(tmp_path / "ao3.db"))
+    yield conn
+    conn.close()
+
+
+def chapters(conn: sqlite3.Connection) -> list[tuple]:
+    return conn.execute(
+        "SELECT id, work_id, title, content FROM chapters ORDER BY id;"
+    ).fetchall()
+
+
+def contents(conn: sqlite3.Connection) -> list[tuple]:
+    return conn.execute(
+        "SELECT content, language FROM chapter_contents ORDER BY content;"
+    ).fetchall()
+
+
+def test_content_shared_across_works_is_stored_once(conn):
+    database.write_work(conn, make_work(1, [(10, "A", "<p>same</p>")]))
+    database.write_work(
+        conn,
+        make_work(2, [(20, "B", "<p>same</p>"), (21, "C", "<p>other</p>")], "Français"),
+    )
+
+    assert chapters(conn) == [
+        (10, 1, "A", "<p>same</p>"),
+        (20, 2, "B", "<p>same</p>"),
+        (21, 2, "C", "<p>other</p>"),
+    ]
+    # the language of the work the content was first stored for
+    assert contents(conn) == [("<p>other</p>", "Français"), ("<p>same</p>", "English")]
+
+
+def test_replaced_content_is_dropped_once_unused(conn):
+    database.write_work(conn, make_work(1, [(10, "A", "old"), (11, "B", "kept")]))
+    database.write_work(conn, make_work(2, [(20, "C", "kept")]))
+
+    database.write_work(conn, make_work(1, [(10, "A", "new"), (11, "B", "changed")]))
+
+    assert chapters(conn) == [
+        (10, 1, "A", "new"),
+        (11, 1, "B", "changed"),
+        (20, 2, "C", "kept"),
+    ]
+    # still the content of chapter 20
+    assert [content for content, _ in contents(conn)] == ["changed", "kept", "new"]
+
+
+def test_retitled_chapter_keeps_its_content(conn):
+    database.write_work(conn, make_work(1, [(10, "A", "text")]))
+    database.write_work(conn, make_work(1, [(10, "Renamed", "text")]))
+
+    assert chapters(conn) == [(10, 1, "Renamed", "text")]
+    assert contents(conn) == [("text", "English")]
+
+
+def test_merge_shares_content_and_drops_replaced(tmp_path, conn):
+    database.write_work(conn, make_work(1, [(10, "A", "old"), (11, "B", "shared")]))
+
+    shard = new_db(str(tmp_path / "shard.db"))
+    database.write_work(shard, make_work(1, [(10, "A", "new"), (11, "B", "shared")]))
+    database.write_work(shard, make_work(2, [(20, "C", "shared")]))
+    shard.close()
+
+    database.merge_shard(conn, str(tmp_path / "shard.db"))
+
+    assert chapters(conn) == [
+        (10, 1, "A", "new"),
+        (11, 1, "B", "shared"),
+        (20, 2, "C", "shared"),
+    ]
+    assert [content for content, _ in contents(conn)] == ["new", "shared"]
+    assert database.stored_chapters(conn, 2)[2] == {20}
+
+
+def test_merging_a_shard_again_keeps_one_copy_of_its_dead_letters(tmp_path, conn):
+    shard = new_db(str(tmp_path / "shard.db"))
+    database.write_work(shard, make_work(1, [(10, "A", "text")]))
+    database.insert_dead_letter(shard.cursor(), "work", 2, None, "HTTPError(503)")
+    database.insert_dead_letter(shard.cursor(), "page", 3, "1 day", "ParseError()")
+    shard.close()
+
+    for _ in range(2):
+        database.merge_shard(conn, str(tmp_path / "shard.db"))
+
+    assert conn.execute(
+        "SELECT kind, item, search FROM dead_letters ORDER BY id;"
+    ).fetchall() == [("work", 2, None), ("page", 3, "1 day")]
+
+
+def test_failed_merge_is_rolled_back(tmp_path, conn):
+    shard = new_db(str(tmp_path / "shard.db"))
+    database.write_work(shard, make_work(1, [(10, "A", "text")]))
+    # a chapter of a work the shard doesn't have
+    shard.execute("PRAGMA foreign_keys = off;")
+    shard.execute("INSERT INTO work_chapters VALUES (20, 2, 'B', 1);")
+    shard.close()
+
+    with pytest.raises(sqlite3.IntegrityError):
+        database.merge_shard(conn, str(tmp_path / "shard.db"))
+
+    assert not conn.in_transaction
+    assert "shard" not in [name for _, name, _ in conn.execute("PRAGMA database_list;")]
+    assert chapters(conn) == []
+    assert conn.execute("SELECT count(*) FROM works;").fetchone() == (0,)
+
+
+def old_db(path: str) -> sqlite3.Connection:
+    """
+    A database as created before content was shared, with its chapters in a
+    table of their own.
+    """
+    conn = database.open_db(path)
+    conn.executescript(
+        """
+        CREATE TABLE works (
+            id INTEGER PRIMARY KEY, title TEXT NOT NULL,
+            author TEXT NOT NULL,
+            author_pseud TEXT NOT NULL,
+            summary TEXT,
+            notes TEXT,
+            published INTEGER NOT NULL,
+            updated INTEGER,
+            words INTEGER NOT NULL,
+            chapters_published INTEGER NOT NULL,
+            chapters_total INTEGER,
+            language TEXT NOT NULL,
+            hits INTEGER NOT NULL,
+            kudos INTEGER NOT NULL,
+            comments INTEGER NOT NULL,
+            bookmarks INTEGER NOT NULL
+        );
+
+        CREATE TABLE chapters (
+            id INTEGER PRIMARY KEY,
+            work_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            content TEXT NOT NULL,
+            FOREIGN KEY (work_id) REFERENCES works (id)
+        );
+
+        CREATE TABLE taggings (
+            tag TEXT NOT NULL,
+            work_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            PRIMARY KEY (tag, work_id),
+            FOREIGN KEY (work_id) REFERENCES works (id)
+        );
+
+        CREATE INDEX chapters_by_work_id ON chapters (work_id);
+
+        INSERT INTO works VALUES (
+            1, 'T', 'a', 'a', NULL, NULL, 0, NULL, 1, 2, 2, 'English', 0, 0, 0, 0
+        );
+        INSERT INTO works VALUES (
+            2, 'U', 'b', 'b', NULL, NULL, 0, NULL, 1, 1, 1, 'Deutsch', 0, 0, 0, 0
+        );
+        INSERT INTO chapters VALUES (10, 1, 'A', 'shared');
+        INSERT INTO chapters VALUES (11, 1, 'B', 'own');
+        INSERT INTO chapters VALUES (20, 2, 'C', 'shared');
+        """
+    )
+    database.build_indexes(conn)
+    return conn
+
+
+def schema(conn: sqlite3.Connection) -> dict[str, tuple]:
+    return {
+        name: (type, conn.execute(f"PRAGMA table_info({name});").fetchall())
+        for type, name in conn.execute("SELECT type, name FROM sqlite_master;")
+    }
+
+
+def test_old_database_isnt_rewritten_when_opened(tmp_path):
+    path = str(tmp_path / "ao3.db")
+    old_db(path).close()
+
+    with pytest.raises(database.OutdatedDatabaseError):
+        database.open_db(path)
+
+    # still usable by an older version until it's migrated
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT count(*) FROM chapters;").fetchone() == (3,)
+    conn.close()
+
+
+def test_migration_moves_stored_chapters(tmp_path, conn):
+    path = str(tmp_path / "old.db")
+    old_db(path).close()
+
+    # stopped after the first batch, and picked up from there
+    with pytest.MonkeyPatch.context() as m:
+        migrations = [
+            partial(migration, batch_size=2) if callable(migration) else migration
+            for migration in database.MIGRATIONS
+        ]
+        m.setattr(database, "MIGRATIONS", migrations)
+        m.setattr(database, "run_incremental_maintenance", interrupt)
+        with pytest.raises(KeyboardInterrupt):
+            database.open_db(path, rewrite=True)
+
+    interrupted = sqlite3.connect(path)
+    assert interrupted.execute("SELECT id FROM work_chapters;").fetchall() == [
+        (10,),
+        (11,),
+    ]
+    interrupted.close()
+
+    migrated = database.open_db(path, rewrite=True)
+    assert chapters(migrated) == [
+        (10, 1, "A", "shared"),
+        (11, 1, "B", "own"),
+        (20, 2, "C", "shared"),
+    ]
+    assert contents(migrated) == [("own", "English"), ("shared", "English")]
+    # the same schema as a database created since
+    assert schema(migrated) == schema(conn)
+    assert migrated.execute("PRAGMA user_version;").fetchone() == (
+        len(database.MIGRATIONS),
+    )
+
+    # and stored the same way as anything written since
+    database.write_work(migrated, make_work(2, [(20, "C", "shared")]))
+    assert database.stored_chapters(migrated, 2)[2] == {20}
+    assert len(contents(migrated)) == 2
+    migrated.close()
+
+
+def interrupt(conn, duration, load):
+    raise KeyboardInterrupt
@@ -0,0 +1,107 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import pytest
+
+from ao3_scrape.scrape import HTTPError, RatelimitError, check_response, work
+
+
+async def error_server(status: int) -> TestServer:
+    async def handle(request: web.Request) -> web.StreamResponse:
+        res = web.StreamResponse(status=status, headers={"Retry-After": "5"})
+        await res.prepare(request)
+        # a body which doesn't end until the client reads it, so that the
+        # connection isn't released by being read to the end
+        for _ in range(64):
+            await res.write(b"x" * 1024**2)
+        return res
+
+    app = web.Application()
+    app.router.add_get("/{path:.*}", handle)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+@pytest.mark.parametrize(
+    "status, error", [(429, RatelimitError), (500, HTTPError), (404, HTTPError)]
+)
+def test_error_responses_release_their_connection(status, error):
+    async def run():
+        server = await error_server(status)
+        # with a single connection, a request which never gave it back would
+        # leave every later one waiting for it
+        client = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=1))
+        # kept, so that none is released by being garbage collected
+        responses = []
+        try:
+            for _ in range(3):
+                res = await asyncio.wait_for(client.get(server.make_url("/")), 5)
+                responses.append(res)
+                with pytest.raises(error):
+                    check_response(res)
+                assert res.closed
+        finally:
+            await client.close()
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_ratelimit_keeps_retry_after():
+    async def run():
+        server = await error_server(429)
+        async with aiohttp.ClientSession() as client:
+            res = await client.get(server.make_url("/"))
+            with pytest.raises(RatelimitError) as excinfo:
+                check_response(res)
+        await server.close()
+
+        return excinfo.value
+
+    assert asyncio.run(run()).retry_after == 5
+
+
+class KeepingClient:
+    """
+    Stands in for a client, keeping every response so that none is released by
+    being garbage collected.
+    """
+
+    def __init__(self, client: aiohttp.ClientSession):
+        self.client = client
+        self.responses = []
+
+    async def get(self, *args, **kwargs) -> aiohttp.ClientResponse:
+        res = await self.client.get(*args, **kwargs)
+        self.responses.append(res)
+        return res
+
+
+@pytest.mark.parametrize(
+    "download, args",
+    [
+        (work.download_work, (1,)),
+        (work.download_chapter_index, (1,)),
+        (work.download_chapter, (1, 2)),
+    ],
+    ids=["work", "navigate", "chapter"],
+)
+def test_not_found_releases_connection(download, args):
+    async def run():
+        server = await error_server(404)
+        client = aiohttp.ClientSession(
+            server.make_url(""), connector=aiohttp.TCPConnector(limit=1)
+        )
+        keeping = KeepingClient(client)
+        try:
+            for _ in range(3):
+                assert await asyncio.wait_for(download(keeping, *args), 5) is None
+            assert all(res.closed for res in keeping.responses)
+        finally:
+            await client.close()
+            await server.close()
+
+    asyncio.run(run())
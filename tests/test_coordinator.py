@@ -0,0 +1,164 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import shutil
+
+from aiohttp.test_utils import TestServer
+
+from ao3_scrape import ScrapeContext, coordinator, database
+from ao3_scrape.address_pool import AddressPool
+from ao3_scrape.mock_archive import MockArchive
+from ao3_scrape.ratelimit import RateLimiter
+from ao3_scrape.scrape.search import DateRangeSearch
+from ao3_scrape.session_pool import SessionPool
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+DATE_RANGE = DateRangeSearch(
+    datetime(2023, 1, 1, tzinfo=timezone.utc), datetime(2023, 1, 5, tzinfo=timezone.utc)
+)
+
+
+def recordings(path: Path) -> Path:
+    """
+    A search page listing two works, and a page every work is served from.
+    """
+    path.mkdir()
+    shutil.copy(FIXTURES / "archive" / "page_1.html", path / "page_1.html")
+    shutil.copy(FIXTURES / "works" / "single_chapter.html", path / "work_1.html")
+    return path
+
+
+def new_db(path: str) -> str:
+    conn = database.open_db(path)
+    database.init_db(conn)
+    conn.close()
+    return path
+
+
+async def worker(db: str, archive_url: str, coordinator_url: str, name: str):
+    """
+    A `scrape --coordinator` worker with a database of its own.
+    """
+    writer = database.DatabaseWriter(db, flush_interval=0.1)
+    await writer.start()
+
+    sessions = SessionPool(None, base_url=archive_url)
+    ctx = ScrapeContext(
+        db=writer,
+        sessions=sessions,
+        addresses=AddressPool(
+            sessions, RateLimiter(initial_rate=1000, max_rate=1000), size=1
+        ),
+        work_concurrency=2,
+        in_flight=asyncio.Semaphore(4),
+    )
+
+    client = coordinator.LeaseClient(coordinator_url, name)
+    try:
+        await coordinator.scrape_leases(ctx, client, 1, 1, poll_interval=0.1)
+    finally:
+        await client.close()
+        await sessions.close()
+        await writer.close()
+
+
+def test_workers_scrape_every_window_and_merge(tmp_path):
+    leases = coordinator.Coordinator(str(tmp_path / "coordinator.db"))
+    leases.add_windows(coordinator.windows(DATE_RANGE, timedelta(days=1)))
+    shards = [new_db(str(tmp_path / f"{name}.db")) for name in ["a", "b"]]
+
+    async def main():
+        archive = TestServer(
+            MockArchive(
+                recordings(tmp_path / "recordings"), pages=2, latency=0.01
+            ).app()
+        )
+        await archive.start_server()
+        coordinating = TestServer(leases.app())
+        await coordinating.start_server()
+
+        await asyncio.wait_for(
+            asyncio.gather(
+                *(
+                    worker(
+                        shard,
+                        str(archive.make_url("")),
+                        str(coordinating.make_url("")),
+                        name,
+                    )
+                    for shard, name in zip(shards, ["a", "b"])
+                )
+            ),
+            60,
+        )
+
+        await coordinating.close()
+        await archive.close()
+
+    asyncio.run(main())
+
+    assert leases.counts() == {"pending": 0, "leased": 0, "done": 4}
+    # both had a share of the windows
+    assert {
+        worker for (worker,) in leases.conn.execute("SELECT worker FROM leases;")
+    } == {"a", "b"}
+
+    conn = database.open_db(new_db(str(tmp_path / "ao3.db")))
+    for shard in shards:
+        database.merge_shard(conn, shard)
+
+    # every window lists the same pages of works
+    assert conn.execute("SELECT id FROM works ORDER BY id;").fetchall() == [
+        (1000,),
+        (1001,),
+        (2000,),
+        (2001,),
+    ]
+    assert conn.execute("SELECT count(*) FROM dead_letters;").fetchone() == (0,)
+    conn.close()
+
+
+class LosingClient:
+    """
+    Stands in for a `LeaseClient` given one lease, which it loses as soon as
+    it's first renewed.
+    """
+
+    def __init__(self):
+        self.leases = [
+            {"id": 1, "start": "2023-01-01", "end": "2023-01-02", "ttl": 0.3}
+        ]
+        self.updates = []
+
+    async def lease(self):
+        if self.leases:
+            return self.leases.pop(), False
+        return None, True
+
+    async def update(self, lease_id: int, action: str) -> bool:
+        self.updates.append(action)
+        return action != "renew"
+
+
+def test_lost_lease_stops_its_window(monkeypatch):
+    stopped = asyncio.Event()
+
+    async def scrape_forever(*args, **kwargs):
+        try:
+            await asyncio.sleep(60)
+        finally:
+            stopped.set()
+
+    monkeypatch.setattr(coordinator, "scrape_date_range", scrape_forever)
+    client = LosingClient()
+
+    async def main():
+        await asyncio.wait_for(
+            coordinator.scrape_leases(None, client, 1, 1, poll_interval=0), 5
+        )
+        return stopped.is_set()
+
+    assert asyncio.run(main())
+    # neither completed nor released, as it belongs to another worker now
+    assert client.updates == ["renew"]
@@ -0,0 +1,119 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+from ao3_scrape import database
+from ao3_scrape.scrape import RetryPolicy
+
+
+@pytest.fixture
+def db(tmp_path) -> str:
+    path = str(tmp_path / "ao3.db")
+    conn = database.open_db(path)
+    database.init_db(conn)
+    conn.close()
+    return path
+
+
+def dead_letters(db: str) -> list[tuple]:
+    conn = database.open_db(db)
+    rows = conn.execute("SELECT kind, item, error FROM dead_letters;").fetchall()
+    conn.close()
+    return rows
+
+
+def insert_crawl(cur: sqlite3.Cursor, search: str):
+    cur.execute(
+        "INSERT INTO crawls (search, started) VALUES (?, unixepoch());", (search,)
+    )
+
+
+def broken(cur: sqlite3.Cursor, work_id: int):
+    raise KeyError("title")
+
+
+def crawls(db: str) -> list[str]:
+    conn = database.open_db(db)
+    rows = conn.execute("SELECT search FROM crawls ORDER BY id;").fetchall()
+    conn.close()
+    return [search for (search,) in rows]
+
+
+def test_failed_op_is_dead_lettered_and_the_rest_written(db):
+    async def main():
+        writer = database.DatabaseWriter(db, flush_interval=0.1)
+        await writer.start()
+
+        await writer.submit(insert_crawl, "before")
+        await writer.submit(broken, 123, dead_letter=("work", 123))
+        await writer.submit(insert_crawl, "after")
+
+        await asyncio.wait_for(writer.close(), timeout=5)
+
+    asyncio.run(main())
+
+    assert crawls(db) == ["before", "after"]
+    [(kind, item, error)] = dead_letters(db)
+    assert (kind, item) == ("work", 123)
+    assert "broken" in error and "KeyError" in error
+
+
+def test_busy_database_is_retried_rather_than_dropped(db):
+    locked = threading.Event()
+
+    def hold_lock():
+        conn = sqlite3.connect(db)
+        conn.isolation_level = None
+        conn.execute("BEGIN IMMEDIATE;")
+        locked.set()
+        threading.Event().wait(0.5)
+        conn.execute("COMMIT;")
+        conn.close()
+
+    async def main():
+        writer = database.DatabaseWriter(
+            db,
+            flush_interval=0.1,
+            busy_timeout=0.01,
+            retry=RetryPolicy(attempts=100, base_delay=0.05, max_delay=0.1),
+        )
+        await writer.start()
+
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        locked.wait()
+
+        await writer.submit(insert_crawl, "while locked")
+        await asyncio.wait_for(writer.close(), timeout=5)
+        holder.join()
+
+    asyncio.run(main())
+
+    assert crawls(db) == ["while locked"]
+    assert dead_letters(db) == []
+
+
+def test_writer_failure_is_raised_instead_of_hanging(db):
+    def drop_dead_letters(cur: sqlite3.Cursor):
+        cur.execute("DROP TABLE dead_letters;")
+
+    async def main():
+        writer = database.DatabaseWriter(db, queue_size=2, flush_interval=0.1)
+        await writer.start()
+
+        await writer.submit(drop_dead_letters)
+        await writer.flush()
+
+        # with nowhere to put the dead letter, the writer itself has failed
+        await writer.submit(broken, 1)
+        for search in ["a", "b", "c"]:
+            await asyncio.wait_for(writer.submit(insert_crawl, search), timeout=5)
+
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(writer.close(), timeout=5)
+
+    asyncio.run(main())
+
+    assert crawls(db) == ["a", "b", "c"]
@@ -0,0 +1,198 @@
+import asyncio
+import ipaddress
+import socket
+import time
+
+import aiohttp
+import pytest
+
+from ao3_scrape.freebind import FreebindTCPConnector
+
+# how long the fake network takes to finish a handshake
+CONNECT_DELAY = 0.5
+CONNECTIONS = 8
+
+
+class FakeResolver(aiohttp.abc.AbstractResolver):
+    def __init__(self, addresses: list[tuple[int, str]]):
+        self.addresses = addresses
+
+    async def resolve(self, host: str, port: int = 0, family: int = 0):
+        return [
+            {
+                "hostname": host,
+                "host": address,
+                "port": port,
+                "family": address_family,
+                "proto": 0,
+                "flags": 0,
+            }
+            for address_family, address in self.addresses
+        ]
+
+    async def close(self):
+        pass
+
+
+async def delayed_server() -> tuple[asyncio.AbstractServer, int]:
+    """
+    A server which answers every request with an empty 200, after holding each
+    new connection for the connect delay before accepting any data from it.
+    """
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await asyncio.sleep(CONNECT_DELAY)
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def slow_handshakes(monkeypatch: pytest.MonkeyPatch, loop: asyncio.AbstractEventLoop):
+    """
+    Make every TCP handshake take the connect delay, as over a slow network:
+    a blocking connect sleeps through it, and the loop's non-blocking one waits
+    it out, so only a connector which never blocks can overlap them.
+    """
+    connect = socket.socket.connect
+
+    def slow_connect(sock: socket.socket, address):
+        if sock.getblocking():
+            time.sleep(CONNECT_DELAY)
+        return connect(sock, address)
+
+    monkeypatch.setattr(socket.socket, "connect", slow_connect)
+
+    sock_connect = loop.sock_connect
+
+    async def slow_sock_connect(sock: socket.socket, address):
+        await asyncio.sleep(CONNECT_DELAY)
+        return await sock_connect(sock, address)
+
+    monkeypatch.setattr(loop, "sock_connect", slow_sock_connect)
+
+
+@pytest.mark.parametrize("local_addr", [None, ipaddress.ip_address("127.0.0.1")])
+def test_concurrent_connects_overlap(monkeypatch, local_addr):
+    async def main() -> float:
+        slow_handshakes(monkeypatch, asyncio.get_running_loop())
+        server, port = await delayed_server()
+
+        connector = FreebindTCPConnector(
+            local_addr=local_addr, limit=CONNECTIONS, force_close=True
+        )
+        async with aiohttp.ClientSession(connector=connector) as client:
+
+            async def get():
+                async with client.get(f"http://127.0.0.1:{port}/") as res:
+                    assert res.status == 200
+
+            start = time.perf_counter()
+            await asyncio.gather(*(get() for _ in range(CONNECTIONS)))
+            elapsed = time.perf_counter() - start
+
+        server.close()
+        await server.wait_closed()
+        return elapsed
+
+    elapsed = asyncio.run(main())
+
+    # a connect delay and a server delay, rather than one of each per connection
+    assert elapsed < 4 * CONNECT_DELAY
+
+
+def test_event_loop_runs_while_connecting(monkeypatch):
+    async def main() -> int:
+        slow_handshakes(monkeypatch, asyncio.get_running_loop())
+        server, port = await delayed_server()
+
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        async with aiohttp.ClientSession(connector=FreebindTCPConnector()) as client:
+            async with client.get(f"http://127.0.0.1:{port}/") as res:
+                assert res.status == 200
+        ticker.cancel()
+
+        server.close()
+        await server.wait_closed()
+        return ticks
+
+    # the loop kept ticking through the handshake and the server's delay
+    assert asyncio.run(main()) > CONNECT_DELAY / 0.01
+
+
+def resolve(addresses: list[tuple[int, str]], local_addr=None) -> list[dict]:
+    async def main():
+        connector = FreebindTCPConnector(
+            resolver=FakeResolver(addresses), use_dns_cache=False, local_addr=local_addr
+        )
+        try:
+            return await connector._resolve_host("example.org", 443)
+        finally:
+            await connector.close()
+
+    return asyncio.run(main())
+
+
+def test_resolve_host_interleaves_families():
+    hosts = resolve(
+        [
+            (socket.AF_INET6, "2001:db8::1"),
+            (socket.AF_INET6, "2001:db8::2"),
+            (socket.AF_INET6, "2001:db8::3"),
+            (socket.AF_INET, "192.0.2.1"),
+            (socket.AF_INET, "192.0.2.2"),
+        ]
+    )
+
+    assert [hinfo["host"] for hinfo in hosts] == [
+        "2001:db8::1",
+        "192.0.2.1",
+        "2001:db8::2",
+        "192.0.2.2",
+        "2001:db8::3",
+    ]
+
+
+def test_resolve_host_keeps_family_of_local_address():
+    addresses = [
+        (socket.AF_INET6, "2001:db8::1"),
+        (socket.AF_INET, "192.0.2.1"),
+        (socket.AF_INET6, "2001:db8::2"),
+    ]
+
+    hosts = resolve(addresses, local_addr=ipaddress.ip_address("2001:db8::ff"))
+    assert [hinfo["host"] for hinfo in hosts] == ["2001:db8::1", "2001:db8::2"]
+
+    hosts = resolve(addresses, local_addr=ipaddress.ip_address("192.0.2.255"))
+    assert [hinfo["host"] for hinfo in hosts] == ["192.0.2.1"]
+
+
+def test_resolve_host_fails_without_address_in_family():
+    with pytest.raises(OSError):
+        resolve(
+            [(socket.AF_INET, "192.0.2.1")],
+            local_addr=ipaddress.ip_address("2001:db8::ff"),
+        )
+
+
+def test_resolve_host_fills_in_family_of_literals():
+    async def main():
+        connector = FreebindTCPConnector()
+        try:
+            return await connector._resolve_host("2001:db8::1", 443)
+        finally:
+            await connector.close()
+
+    (hinfo,) = asyncio.run(main())
+    assert hinfo["family"] == socket.AF_INET6
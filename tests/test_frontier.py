@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from ao3_scrape import database
+from ao3_scrape.frontier import IN_FLIGHT, WORK_ATTEMPTS, Frontier
+
+SEARCH = "2023-01-01T00:00:00+00:00 - 2023-01-02T00:00:00+00:00"
+
+
+@pytest.fixture
+def db(tmp_path) -> str:
+    path = str(tmp_path / "ao3.db")
+    conn = database.open_db(path)
+    database.init_db(conn)
+    conn.close()
+    return path
+
+
+def run(db: str, crawl) -> Frontier:
+    """
+    Resume the crawl over `SEARCH` and run `crawl` on its frontier, as one run
+    of `scrape` would.
+    """
+
+    async def main():
+        writer = database.DatabaseWriter(db, flush_interval=0.1)
+        await writer.start()
+
+        frontier = await Frontier.open(writer, SEARCH)
+        await crawl(frontier)
+
+        await asyncio.wait_for(writer.close(), timeout=5)
+        return frontier
+
+    return asyncio.run(main())
+
+
+def query(db: str, sql: str) -> list[tuple]:
+    conn = database.open_db(db)
+    rows = conn.execute(sql).fetchall()
+    conn.close()
+    return rows
+
+
+def test_taken_work_is_in_flight(db):
+    async def crawl(frontier: Frontier):
+        await frontier.complete_page(1, 2, [1, 2])
+        await frontier.lease_work(1)
+
+    run(db, crawl)
+
+    assert query(db, "SELECT work_id, state FROM crawl_works ORDER BY work_id;") == [
+        (1, IN_FLIGHT),
+        (2, "pending"),
+    ]
+
+
+def test_failed_work_is_retried_until_given_up(db):
+    async def first(frontier: Frontier):
+        await frontier.complete_page(1, 2, [1, 2])
+        await frontier.complete_page(2, 0, [])
+        await frontier.lease_work(1)
+        await frontier.fail_work(1, ValueError())
+        await frontier.complete_work(2, None)
+        await frontier.finish()
+
+    run(db, first)
+    # not finished while a failed work has attempts left
+    assert query(db, "SELECT finished FROM crawls;") == [(None,)]
+
+    async def retry(frontier: Frontier):
+        await frontier.fail_work(1, ValueError())
+        await frontier.finish()
+
+    for _ in range(WORK_ATTEMPTS - 1):
+        frontier = run(db, retry)
+        assert frontier.pending_works == [1]
+        assert frontier.exhausted
+
+    # given up on once out of attempts, but kept as a failure
+    assert query(db, "SELECT finished IS NOT NULL FROM crawls;") == [(1,)]
+    assert query(db, "SELECT work_id, attempts FROM crawl_works;") == [
+        (1, WORK_ATTEMPTS)
+    ]
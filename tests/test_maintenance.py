@@ -0,0 +1,26 @@
+import asyncio
+from types import SimpleNamespace
+
+from ao3_scrape.maintenance import MaintenanceWorker
+
+
+def test_busy_scraper_cuts_the_round_short():
+    # busy only once the checkpoint is done
+    latencies = iter([None, 10, None])
+    ran = []
+
+    async def main():
+        worker = MaintenanceWorker(
+            "unused.db",
+            SimpleNamespace(queue=asyncio.Queue()),
+            latency=lambda: next(latencies, None),
+            max_latency=5,
+        )
+        for task in ["checkpoint", "vacuum", "compress"]:
+            setattr(worker, f"_{task}", lambda task=task: ran.append(task) or False)
+
+        await worker._round()
+
+    asyncio.run(main())
+
+    assert ran == ["checkpoint"]
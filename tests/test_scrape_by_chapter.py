@@ -0,0 +1,118 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+
+import ao3_scrape
+from ao3_scrape import ScrapeContext, database
+from ao3_scrape.scrape import HTTPError, work
+
+WORK_ID = 2002
+CHAPTER_IDS = [5001, 5002, 5003, 5004]
+
+PAGE = Path(__file__).parent / "fixtures" / "works" / "series.html"
+
+BLURB = {"id": WORK_ID, "words": 1000001, "chapters_published": len(CHAPTER_IDS)}
+
+
+@pytest.fixture
+def db(tmp_path) -> str:
+    path = str(tmp_path / "ao3.db")
+    conn = database.open_db(path)
+    database.init_db(conn)
+    conn.close()
+    return path
+
+
+def fake_request(missing: set[int] = set(), failing: set[int] = set()):
+    """
+    Stands in for `ao3_scrape.request`, serving a work with four chapters, of
+    which those in `missing` aren't found and those in `failing` can't be
+    downloaded at all.
+    """
+
+    async def request(ctx, func, *args, **kwargs):
+        if func is work.get_work_page:
+            # only the first chapter comes with the first page
+            parsed = work.parse_work_html(PAGE.read_text(), WORK_ID)
+            return {**parsed, "content": parsed["content"][:1]}
+
+        if func is work.get_chapter_links:
+            return [{"id": id, "posted": "2020-03-03"} for id in CHAPTER_IDS]
+
+        if func is work.get_chapter:
+            _, chapter_id = args
+            if chapter_id in missing:
+                return None
+            if chapter_id in failing:
+                raise HTTPError(503, "Service Unavailable")
+            return {"id": chapter_id, "title": "", "content": f"<p>{chapter_id}</p>"}
+
+        raise AssertionError(f"unexpected request {func.__name__}")
+
+    return request
+
+
+def scrape(db: str):
+    async def main():
+        writer = database.DatabaseWriter(db, flush_interval=0.1)
+        await writer.start()
+
+        ctx = ScrapeContext(
+            db=writer,
+            sessions=None,
+            addresses=None,
+            work_concurrency=2,
+            in_flight=asyncio.Semaphore(4),
+            chapter_mode_chapters=2,
+        )
+        await ao3_scrape.scrape_work(ctx, WORK_ID, BLURB)
+
+        await asyncio.wait_for(writer.close(), timeout=5)
+
+    asyncio.run(main())
+
+
+def stored(db: str) -> tuple[bool, set[int], list[tuple]]:
+    conn = database.open_db(db)
+    _, partial, chapters = database.stored_chapters(conn, WORK_ID)
+    letters = conn.execute("SELECT kind, item, error FROM dead_letters;").fetchall()
+    conn.close()
+    return partial, chapters, letters
+
+
+def test_complete_work_is_no_longer_partial(db, monkeypatch):
+    monkeypatch.setattr(ao3_scrape, "request", fake_request())
+    scrape(db)
+
+    partial, chapters, letters = stored(db)
+    assert not partial
+    assert chapters == set(CHAPTER_IDS)
+    assert letters == []
+
+
+@pytest.mark.parametrize(
+    "missing, failing", [({5003}, set()), (set(), {5002}), ({5004}, {5002})]
+)
+def test_work_missing_chapters_stays_partial(db, monkeypatch, missing, failing):
+    monkeypatch.setattr(ao3_scrape, "request", fake_request(missing, failing))
+    scrape(db)
+
+    partial, chapters, letters = stored(db)
+    assert partial
+    # whatever was downloaded is kept for the next attempt
+    assert chapters == set(CHAPTER_IDS) - missing - failing
+    [(kind, item, error)] = letters
+    assert (kind, item) == ("work", WORK_ID)
+    assert "IncompleteWorkError" in error
+
+
+def test_partial_work_is_finished_by_a_later_attempt(db, monkeypatch):
+    monkeypatch.setattr(ao3_scrape, "request", fake_request(missing={5003}))
+    scrape(db)
+    monkeypatch.setattr(ao3_scrape, "request", fake_request())
+    scrape(db)
+
+    partial, chapters, _ = stored(db)
+    assert not partial
+    assert chapters == set(CHAPTER_IDS)
@@ -0,0 +1,131 @@
+import asyncio
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+import pytest
+
+from ao3_scrape.scrape import HTTPError, ParseError
+from ao3_scrape.scrape.search import (
+    DateRangeSearch,
+    get_parsed,
+    parse_html,
+    parse_result_count,
+)
+from ao3_scrape.search_cache import SearchCache
+
+SEARCH = DateRangeSearch(
+    datetime(2023, 1, 1, tzinfo=timezone.utc), datetime(2023, 1, 2, tzinfo=timezone.utc)
+)
+
+PAGE = '<div id="main"><h3 class="heading">12 Found</h3></div>'
+ETAG = '"page-1"'
+
+
+async def search_server(status: int = 200, slow: bool = False) -> TestServer:
+    """
+    A search page served with an ETag, answering a request carrying it with a
+    304. Any other status is sent with a body which doesn't end until the client
+    reads it, and a slow page with one which never ends.
+    """
+
+    async def handle(request: web.Request) -> web.StreamResponse:
+        if request.headers.get("If-None-Match") == ETAG or status == 304:
+            return web.Response(status=304, headers={"ETag": ETAG})
+        if status == 200 and not slow:
+            return web.Response(text=PAGE, headers={"ETag": ETAG})
+
+        res = web.StreamResponse(status=status, headers={"ETag": ETAG})
+        await res.prepare(request)
+        for _ in range(64):
+            await res.write(b"x" * 1024**2)
+            if slow:
+                await asyncio.sleep(1)
+        return res
+
+    app = web.Application()
+    app.router.add_get("/works/search", handle)
+    server = TestServer(app)
+    await server.start_server()
+    return server
+
+
+def single_connection_client(server: TestServer) -> aiohttp.ClientSession:
+    # a request which never gave its connection back would leave every later
+    # one waiting for it
+    return aiohttp.ClientSession(
+        server.make_url(""), connector=aiohttp.TCPConnector(limit=1)
+    )
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = SearchCache(tmp_path / "search.db", ttl=0)
+    yield cache
+    cache.close()
+
+
+def test_unchanged_page_is_revalidated(cache):
+    async def run():
+        server = await search_server()
+        async with single_connection_client(server) as client:
+            counts = [
+                await asyncio.wait_for(
+                    get_parsed(client, SEARCH, 1, parse_result_count, cache), 5
+                )
+                for _ in range(3)
+            ]
+        await server.close()
+        return counts
+
+    assert asyncio.run(run()) == [12, 12, 12]
+
+
+@pytest.mark.parametrize("status", [500, 404, 304])
+def test_error_releases_connection(cache, status):
+    async def run():
+        server = await search_server(status)
+        async with single_connection_client(server) as client:
+            for _ in range(3):
+                # a 304 without a cached page to use is an error like any other
+                with pytest.raises(HTTPError):
+                    await asyncio.wait_for(
+                        get_parsed(client, SEARCH, 1, parse_result_count, cache), 5
+                    )
+        await server.close()
+
+    asyncio.run(run())
+
+
+def test_cancelled_download_releases_connection(cache):
+    async def run():
+        server = await search_server(slow=True)
+        async with single_connection_client(server) as client:
+            for _ in range(3):
+                with pytest.raises(asyncio.TimeoutError):
+                    await asyncio.wait_for(
+                        get_parsed(client, SEARCH, 1, parse_result_count, cache), 0.5
+                    )
+        await server.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "heading, count",
+    [("1 - 20 of 1,234 Works found", 1234), ("12 Found", 12), ("0 Found", 0)],
+)
+def test_result_count(heading, count):
+    html = f'<div id="main"><h3 class="heading">{heading}</h3></div>'
+    assert parse_html(html, SEARCH, 1, parse_result_count) == count
+
+
+def test_page_without_result_count_is_a_parse_error(tmp_path, monkeypatch):
+    # where the page is saved
+    monkeypatch.chdir(tmp_path)
+
+    html = "<h1>The archive is down for maintenance.</h1>"
+    with pytest.raises(ParseError):
+        parse_html(html, SEARCH, 1, parse_result_count)
+    assert [path.read_text() for path in tmp_path.iterdir()] == [html]
@@ -0,0 +1,24 @@
+import asyncio
+from ipaddress import IPv4Network
+
+from ao3_scrape.session_pool import SessionPool
+
+NETWORK = IPv4Network("127.0.0.0/29")
+
+
+def test_picked_addresses_stay_within_max_sessions():
+    async def main():
+        pool = SessionPool(NETWORK, max_sessions=2)
+
+        sessions = []
+        for address in list(NETWORK)[:4]:
+            async with pool.session(address) as pooled:
+                sessions.append(pooled)
+            assert len(pool._sessions) <= 2
+
+        # the least recently used made room for the later ones
+        closed = [pooled.client.closed for pooled in sessions]
+        await pool.close()
+        return closed
+
+    assert asyncio.run(main()) == [True, True, False, False]
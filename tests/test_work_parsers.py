@@ -0,0 +1,146 @@
+from pathlib import Path
+
+import pytest
+
+from ao3_scrape.scrape.work import Work, WorkParser, parse_work_html
+
+pytest.importorskip("lxml")
+
+from ao3_scrape.scrape.work_lxml import WorkStreamParser  # noqa: E402
+
+FIXTURES = Path(__file__).parent / "fixtures" / "works"
+
+# fixture name to the id of the work it's a page of
+WORK_IDS = {
+    "single_chapter": 1001,
+    "multi_chapter": 123,
+    "anonymous": 1500,
+    "series": 2002,
+    "missing_stats": 3003,
+}
+
+
+def read_fixture(name: str) -> str:
+    return (FIXTURES / f"{name}.html").read_text()
+
+
+def parse(name: str, parser: WorkParser) -> Work:
+    return parse_work_html(read_fixture(name), WORK_IDS[name], parser)
+
+
+@pytest.fixture(params=WORK_IDS)
+def name(request) -> str:
+    return request.param
+
+
+@pytest.mark.parametrize("parser", [WorkParser.LXML, WorkParser.LXML_STREAM])
+def test_parsers_agree(name, parser):
+    expected = parse(name, WorkParser.HTML_PARSER)
+    work = parse(name, parser)
+
+    # field by field first, so that a failure names the field
+    assert work.keys() == expected.keys()
+    for field in expected:
+        assert work[field] == expected[field], field
+    assert work == expected
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 256])
+def test_stream_parser_agrees_across_chunk_boundaries(name, chunk_size):
+    expected = parse(name, WorkParser.HTML_PARSER)
+
+    stream_parser = WorkStreamParser(WORK_IDS[name])
+    data = read_fixture(name).encode()
+    for start in range(0, len(data), chunk_size):
+        stream_parser.feed(data[start : start + chunk_size])
+
+    assert stream_parser.close() == expected
+
+
+@pytest.mark.parametrize("parser", list(WorkParser))
+def test_single_chapter(parser):
+    work = parse("single_chapter", parser)
+
+    assert work["title"] == "Quiet Harbour"
+    assert (work["author"], work["author_pseud"]) == ("Writer", "Writer")
+    assert work["summary"] == "The tide goes out, the tide comes in."
+    assert work["notes"] is None
+    assert (work["published"], work["updated"]) == ("2021-06-30", None)
+    assert (work["words"], work["hits"]) == (2048, 10500)
+    assert (work["kudos"], work["comments"], work["bookmarks"]) == (1234, 12, 56)
+    assert (work["chapters_published"], work["chapters_total"]) == (1, 1)
+    assert work["category_tags"] == ["F/M", "Gen"]
+    assert work["freeform_tags"] == ["Hurt/Comfort", "Tea & Biscuits", "<3"]
+
+    [chapter] = work["content"]
+    assert (chapter["id"], chapter["title"]) == (1001, "Quiet Harbour")
+    assert "<pre>  kept\n    as is  </pre>" in chapter["content"]
+    assert 'href="https://example.com/?a=1&amp;b=2"' in chapter["content"]
+    assert 'rel="nofollow noopener"' in chapter["content"]
+
+
+@pytest.mark.parametrize("parser", list(WorkParser))
+def test_multi_chapter(parser):
+    work = parse("multi_chapter", parser)
+
+    assert work["title"] == "My   Title"
+    assert (work["author"], work["author_pseud"]) == ("Some One", "Pseudo")
+    assert work["updated"] == "2023-02-02"
+    assert (work["chapters_published"], work["chapters_total"]) == (2, None)
+    assert (work["kudos"], work["comments"], work["bookmarks"]) == (10, 3, 1)
+    assert work["fandom_tags"] == ["Fandom A", "Fandom & B"]
+
+    assert [(c["id"], c["title"]) for c in work["content"]] == [
+        ("456", "Beginning"),
+        ("789", "End"),
+    ]
+    assert "<!--" not in work["content"][0]["content"]
+    assert '<img alt="a&amp;b" src="a.png"/>' in work["content"][0]["content"]
+    assert "<script>if (a < b && c)" in work["content"][1]["content"]
+    assert "Thanks for reading!" not in work["content"][1]["content"]
+
+
+@pytest.mark.parametrize("parser", list(WorkParser))
+def test_anonymous(parser):
+    work = parse("anonymous", parser)
+
+    assert (work["author"], work["author_pseud"]) == ("Anonymous", "Anonymous")
+    assert work["summary"] is None
+    assert work["notes"] == "Written for the exchange."
+    assert work["language"] == "Français"
+    assert work["warning_tags"] == [
+        "Graphic Depictions Of Violence",
+        "Major Character Death",
+    ]
+    assert (work["kudos"], work["comments"], work["bookmarks"]) == (7, 0, 0)
+
+
+@pytest.mark.parametrize("parser", list(WorkParser))
+def test_series(parser):
+    work = parse("series", parser)
+
+    # the first of several authors
+    assert (work["author"], work["author_pseud"]) == ("Two Names", "First Name")
+    assert work["summary"] == "Continues Part One."
+    assert work["words"] == 1000001
+    assert (work["chapters_published"], work["chapters_total"]) == (3, 3)
+    assert work["fandom_tags"] == ["Fandom C", "Fandom D"]
+    assert work["relationship_tags"] == []
+
+    assert [(c["id"], c["title"]) for c in work["content"]] == [
+        ("5001", "One"),
+        ("5002", "Two & a Half"),
+        ("5003", "Three"),
+    ]
+
+
+@pytest.mark.parametrize("parser", list(WorkParser))
+def test_missing_stats(parser):
+    work = parse("missing_stats", parser)
+
+    assert work["summary"] is None
+    assert work["updated"] is None
+    assert (work["kudos"], work["comments"], work["bookmarks"]) == (0, 0, 0)
+    assert (work["chapters_published"], work["chapters_total"]) == (1, None)
+    assert work["warning_tags"] == []
+    assert work["content"] == [{"id": "9009", "title": "", "content": ""}]